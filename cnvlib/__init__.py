@@ -1,6 +1,10 @@
 from .cnary import CopyNumArray as _CNA
 from ._version import __version__
 
-def read(fname):
-    """Parse a file as a copy number or copy ratio table (.cnn, .cnr)."""
-    return _CNA.read(fname)
+def read(fname, compact=False):
+    """Parse a file as a copy number or copy ratio table (.cnn, .cnr).
+
+    With `compact`, store the table with smaller dtypes to save memory (see
+    `gary.compact_table`).
+    """
+    return _CNA.read(fname, compact=compact)
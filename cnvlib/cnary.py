@@ -6,7 +6,7 @@ import logging
 import numpy as np
 import pandas as pd
 
-from . import core, gary, metrics, params, smoothing
+from . import gary, metrics, params, smoothing
 
 
 class CopyNumArray(gary.GenomicArray):
@@ -27,11 +27,11 @@ class CopyNumArray(gary.GenomicArray):
 
     @property
     def log2(self):
-        return self.data["log2"]
+        return self["log2"]
 
     @log2.setter
     def log2(self, value):
-        self.data["log2"] = value
+        self["log2"] = value
 
     @property
     def _chr_x_label(self):
@@ -70,29 +70,52 @@ class CopyNumArray(gary.GenomicArray):
         Bins with names in `ignore` are treated as 'Background' bins, but retain
         their name.
         """
-        start_idx = end_idx = None
-        for _chrom, subgary in self.by_chromosome():
-            prev_idx = 0
-            for gene in pd.unique(subgary.data['gene']):
-                if not (gene == 'Background' or gene in ignore):
-                    gene_idx = (subgary.data['gene'] == gene).nonzero()[0]
-                    if not len(gene_idx):
-                        logging.warn("Specified gene name somehow missing: %s",
-                                     gene)
-                        continue
-                    start_idx = gene_idx[0]
-                    end_idx = gene_idx[-1] + 1
-                    if prev_idx < start_idx:
-                        # Include intergenic regions
-                        yield "Background", subgary.as_dataframe(
-                                subgary.data.iloc[prev_idx:start_idx])
-                    yield gene, subgary.as_dataframe(
-                            subgary.data.iloc[start_idx:end_idx])
-                    prev_idx = end_idx
-            if prev_idx < len(subgary) - 1:
-                # Include the telomere
-                yield "Background", subgary.as_dataframe(
-                        subgary.data.iloc[prev_idx:])
+        starts, ends, is_gene = self._gene_runs(ignore)
+        genes = self._data['gene']
+        for start, end, gene_run in zip(starts, ends, is_gene):
+            name = genes.iat[start] if gene_run else "Background"
+            yield name, self._row_view(start, end)
+
+    def _gene_runs(self, ignore=params.IGNORE_GENE_NAMES, groups=None):
+        """Locate the rows of each gene and of the Background bins between them.
+
+        A gene's run extends from its first to its last consecutive bin, except
+        for 'Background' (or ignored) bins, on the same chromosome -- and, if
+        `groups` is given as an array of row labels (e.g. segment indices),
+        with the same label.
+
+        Returns arrays of each group's start and end row indices and a boolean
+        array indicating which groups are genes (vs. Background).
+        """
+        if not len(self):
+            empty = np.array([], dtype=np.int_)
+            return empty, empty, np.array([], dtype=np.bool_)
+        genes = self._data['gene']
+        is_gene = ~(genes.isin(ignore) | (genes == 'Background')).values
+        chrom_codes = pd.factorize(self._data['chromosome'])[0]
+        if groups is not None:
+            # Number the blocks of rows with the same chromosome and label
+            chrom_codes = np.r_[0, np.cumsum((np.diff(chrom_codes) != 0) |
+                                             (np.diff(groups) != 0))]
+        gene_codes = pd.factorize(genes)[0]
+        # Runs of the same gene name, skipping any Background bins in between
+        gene_rows = is_gene.nonzero()[0]
+        new_run = np.ones(len(gene_rows), dtype=np.bool_)
+        new_run[1:] = ((np.diff(gene_codes[gene_rows]) != 0) |
+                       (np.diff(chrom_codes[gene_rows]) != 0))
+        run_starts = gene_rows[new_run]
+        run_ends = gene_rows[np.roll(new_run, -1)] + 1
+        # Each chromosome, gene run, and stretch of Background starts a group
+        breaks = np.zeros(len(self) + 1, dtype=np.bool_)
+        breaks[0] = True
+        breaks[1:-1] = (np.diff(chrom_codes) != 0)
+        breaks[run_starts] = True
+        breaks[run_ends] = True
+        starts = breaks[:-1].nonzero()[0]
+        ends = np.append(starts[1:], len(self))
+        is_run_start = np.zeros(len(self), dtype=np.bool_)
+        is_run_start[run_starts] = True
+        return starts, ends, is_run_start[starts]
 
     # Manipulation
 
@@ -112,7 +135,7 @@ class CopyNumArray(gary.GenomicArray):
                                  % ", ".join(map(repr, est_funcs)))
         table = (self.drop_low_coverage() if skip_low else self).autosomes()
         if table:
-            self.data['log2'] -= estimator(table['log2'])
+            self['log2'] = self._data['log2'] - estimator(table['log2'])
 
     def drop_low_coverage(self):
         """Drop bins with extremely low log2 coverage values.
@@ -121,7 +144,7 @@ class CopyNumArray(gary.GenomicArray):
         substituted with a small dummy log2 value to avoid divide-by-zero
         errors.
         """
-        return self.as_dataframe(self.data[self.data['log2'] >
+        return self.as_dataframe(self._data[self._data['log2'] >
                                            params.NULL_LOG2_COVERAGE -
                                            params.MIN_REF_COVERAGE])
 
@@ -137,31 +160,45 @@ class CopyNumArray(gary.GenomicArray):
         default this is the biweight location, but you might want median, mean,
         max, min or something else in some cases.
         """
-        def squash_rows(name, rows):
-            """Combine multiple rows (for the same gene) into one row."""
-            if len(rows) == 1:
-                return tuple(rows.iloc[0])
-            chrom = core.check_unique(rows.chromosome, 'chromosome')
-            start = rows.iloc[0]['start']
-            end = rows.iloc[-1]['end']
-            cvg = summary_func(rows.log2)
-            outrow = [chrom, start, end, name, cvg]
-            # Handle extra fields
-            # ENH - no coverage stat; do weighted average as appropriate
-            for xfield in ('gc', 'rmask', 'spread', 'weight'):
-                if xfield in self:
-                    outrow.append(summary_func(rows[xfield]))
-            if 'probes' in self:
-                outrow.append(sum(rows['probes']))
-            return tuple(outrow)
-
-        outrows = []
-        for name, subarr in self.by_gene(ignore):
-            if name == 'Background' and not squash_background:
-                outrows.extend(subarr.data.itertuples(index=False))
-            else:
-                outrows.append(squash_rows(name, subarr.data))
-        return self.as_rows(outrows)
+        if not len(self):
+            return self.copy()
+        starts, ends, is_gene = self._gene_runs(ignore)
+        # Each output row combines a group of bins, except that Background
+        # bins pass through individually unless squash_background is set
+        sizes = ends - starts
+        row_is_gene = np.repeat(is_gene, sizes)
+        breaks = np.zeros(len(self), dtype=np.bool_)
+        breaks[starts] = True
+        if not squash_background:
+            breaks[~row_is_gene] = True
+        out_starts = breaks.nonzero()[0]
+        out_ends = np.append(out_starts[1:], len(self))
+        ngroups = len(out_starts)
+        groups = np.cumsum(breaks) - 1
+        multi = (out_ends - out_starts > 1)
+
+        table = self._data.take(out_starts)
+        table['end'] = self._data['end'].values[out_ends - 1]
+        names = np.asarray(table['gene'], dtype=np.object_)
+        names[multi & ~row_is_gene[out_starts]] = 'Background'
+        table['gene'] = names
+        # Summarize the values of each multi-bin group
+        # ENH - no coverage stat; do weighted average as appropriate
+        for field in ('log2', 'gc', 'rmask', 'spread', 'weight', 'probes'):
+            if field in self:
+                if field == 'probes':
+                    summary = metrics.grouped_sum(self._data[field].values,
+                                                  groups, ngroups)
+                else:
+                    summary = metrics.grouped_summary(summary_func,
+                                                      self._data[field].values,
+                                                      groups, ngroups)
+                values = table[field].values.copy()
+                values[multi] = summary[multi]
+                table[field] = values
+        if gary._is_compact(self._data):
+            gary.compact_table(table)
+        return self._wrap(table, shared=False)
 
     # Chromosomal gender
 
@@ -260,13 +297,14 @@ class CopyNumArray(gary.GenomicArray):
         if not segments:
             resids = [subcna.log2 - subcna.log2.median()
                       for _chrom, subcna in self.by_chromosome()]
-        elif "log2" in segments:
-            resids = [subcna.log2 - seg.log2
-                      for seg, subcna in self.by_ranges(segments)]
+            return np.concatenate(resids) if resids else np.array([])
+        seg_idx, bin_idx = self.ranges_idx(segments)
+        log2s = self.log2.values[bin_idx]
+        if "log2" in segments:
+            centers = segments.log2.values
         else:
-            resids = [subcna.log2 - subcna.log2.median()
-                      for _seg, subcna in self.by_ranges(segments)]
-        return np.concatenate(resids) if resids else np.array([])
+            centers = metrics.grouped_median(log2s, seg_idx, len(segments))
+        return log2s - centers[seg_idx]
 
     def guess_average_depth(self, segments=None, window=100):
         """Estimate the effective average read depth from variance.
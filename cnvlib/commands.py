@@ -30,8 +30,9 @@ from matplotlib.backends.backend_pdf import PdfPages
 pyplot.ioff()
 
 from . import (core, ngfrills, parallel, params,
-               access, antitarget, call, coverage, export, fix, importers,
-               metrics, plots, reference, reports, segmentation, target)
+               access, antitarget, call, covcache, coverage, export, fix,
+               importers, metrics, npz, plots, reference, reports, segmentation,
+               target)
 from .cnary import CopyNumArray as _CNA
 from .vary import VariantArray as _VA
 from .rary import RegionArray as _RA
@@ -41,10 +42,44 @@ from ._version import __version__
 AP = argparse.ArgumentParser(
         description="CNVkit, a command-line toolkit for copy number analysis.",
         epilog="Contact Eric Talevich <eric.talevich@ucsf.edu> for help.")
+AP.add_argument('--full-precision', action='store_true',
+        help="""Keep 64-bit numbers and plain strings in the tables read from
+                .cnn/.cnr/.cns files, rather than the default compact types
+                (32-bit coordinates and floating-point values, categorical
+                chromosome and gene names), at the cost of more memory.""")
 AP_subparsers = AP.add_subparsers(
         help="Sub-commands (use with -h for more info)")
 
 
+def _add_format_option(parser):
+    """Add the option for the output file format of .cnn/.cnr/.cns files."""
+    parser.add_argument('--format', choices=('tab', 'npz'), default='tab',
+            help="""Output file format: tab-separated text, or a binary format
+                    (NumPy .npz) that is faster to load, written with the
+                    extra file extension .npz. Input files may be in either
+                    format. [Default: %(default)s]""")
+    parser.add_argument('--index', action='store_true',
+            help="""Along with each tab-separated output file, save an index
+                    of each chromosome's position in it (the same file name
+                    plus .idx), so that commands showing one chromosome or
+                    region (e.g. scatter -c) read just that part of the file.
+                    The index is ignored once the file changes.""")
+
+
+def _cna_fname(fname, out_format):
+    """Output file name for the format; binary files get the .npz extension."""
+    if fname and out_format == 'npz':
+        return npz.with_ext(fname)
+    return fname
+
+
+def _read_cna(infile, args, **kwargs):
+    """Read a .cnn/.cnr/.cns file, with compact dtypes unless --full-precision.
+    """
+    return _CNA.read(infile, compact=not getattr(args, 'full_precision', False),
+                     **kwargs)
+
+
 # _____________________________________________________________________________
 # Core pipeline
 
@@ -53,11 +88,13 @@ AP_subparsers = AP.add_subparsers(
 def _cmd_batch(args):
     """Run the complete CNVkit pipeline on one or more BAM files."""
     # Validate/restrict options, beyond what argparse mutual exclusion can do
+    any_cram = any(map(ngfrills.is_cram,
+                       (args.bam_files or []) + (args.normal or [])))
     if args.reference:
         bad_flags = [flag
                      for is_used, flag in (
                          (args.normal is not None,  '-n/--normal'),
-                         (args.fasta,               '-f/--fasta'),
+                         (args.fasta and not any_cram, '-f/--fasta'),
                          (args.targets,             '-t/--targets'),
                          (args.antitargets,         '-a/--antitargets'),
                          (args.access,              '-g/--access'),
@@ -87,6 +124,13 @@ def _cmd_batch(args):
                      % (sid, fname, seen_sids[sid]))
         seen_sids[sid] = fname
 
+    # CRAM files are decoded with the reference genome, either read directly
+    # from the FASTA file or shared by all processes through a local cache
+    cram_fasta, ref_cache = args.fasta, None
+    if any_cram and args.ref_cache:
+        ngfrills.ensure_ref_cache(args.fasta, args.ref_cache)
+        cram_fasta, ref_cache = None, args.ref_cache
+
     if not args.reference:
         # Build a copy number reference; update (anti)targets upon request
         args.reference, args.targets, args.antitargets = batch_make_reference(
@@ -94,10 +138,11 @@ def _cmd_batch(args):
             args.fasta, args.annotate, args.short_names, args.split,
             args.target_avg_size, args.access, args.antitarget_avg_size,
             args.antitarget_min_size, args.output_reference, args.output_dir,
-            args.processes, args.count_reads)
+            args.processes, args.count_reads, args.coverage_cache,
+            args.subsample, cram_fasta, ref_cache, args.format, args.index)
     elif args.targets is None and args.antitargets is None:
         # Extract (anti)target BEDs from the given, existing CN reference
-        ref_arr = _CNA.read(args.reference)
+        ref_arr = _read_cna(args.reference, args)
         target_coords, antitarget_coords = reference.reference2regions(ref_arr)
         ref_pfx = os.path.join(args.output_dir, core.fbase(args.reference))
         args.targets = ref_pfx + '.target-tmp.bed'
@@ -110,12 +155,21 @@ def _cmd_batch(args):
                      len(args.bam_files),
                      ("serial" if args.processes == 1
                       else ("%d processes" % args.processes)))
-        pool = parallel.pick_pool(args.processes)
+        if len(args.bam_files) == 1:
+            # Use the available processes within the one sample instead
+            pool = parallel.SerialPool()
+            cov_procs = args.processes
+        else:
+            pool = parallel.pick_pool(args.processes)
+            cov_procs = 1
         for bam in args.bam_files:
             pool.apply_async(batch_run_sample,
                              (bam, args.targets, args.antitargets, args.reference,
                               args.output_dir, args.male_reference, args.scatter,
-                              args.diagram, args.rlibpath, args.count_reads))
+                              args.diagram, args.rlibpath, args.count_reads,
+                              cov_procs, args.coverage_cache, args.subsample,
+                              cram_fasta, ref_cache, args.format,
+                              args.index))
         pool.close()
         pool.join()
 
@@ -123,7 +177,10 @@ def _cmd_batch(args):
 def batch_make_reference(normal_bams, target_bed, antitarget_bed, male_reference,
                          fasta, annotate, short_names, split, target_avg_size,
                          access, antitarget_avg_size, antitarget_min_size,
-                         output_reference, output_dir, processes, by_count):
+                         output_reference, output_dir, processes, by_count,
+                         cache_dir=None, subsample=None, cram_fasta=None,
+                         ref_cache=None, out_format='tab',
+                         write_index=False):
     """Build the CN reference from normal samples, targets and antitargets."""
     # To make temporary filenames for processed targets or antitargets
     tgt_name_base, tgt_name_ext = os.path.splitext(os.path.basename(target_bed))
@@ -162,59 +219,85 @@ def batch_make_reference(normal_bams, target_bed, antitarget_bed, male_reference
         logging.info("Building a copy number reference from normal samples...")
         target_fnames = []
         antitarget_fnames = []
-        # Run coverage on all normals
-        pool = parallel.pick_pool(processes)
+        # Run coverage on all normals; with just one, parallelize within it
+        if len(normal_bams) == 1:
+            pool = parallel.SerialPool()
+            cov_procs = processes
+        else:
+            pool = parallel.pick_pool(processes)
+            cov_procs = 1
         for nbam in normal_bams:
             sample_id = core.fbase(nbam)
             sample_pfx = os.path.join(output_dir, sample_id)
-            tgt_fname = sample_pfx + '.targetcoverage.cnn'
-            pool.apply_async(batch_write_coverage,
-                             (target_bed, nbam, tgt_fname, by_count))
+            tgt_fname = _cna_fname(sample_pfx + '.targetcoverage.cnn',
+                                   out_format)
+            anti_fname = _cna_fname(sample_pfx + '.antitargetcoverage.cnn',
+                                    out_format)
+            # Scan each BAM once for both targets and antitargets
+            pool.apply_async(batch_write_coverages,
+                             ((target_bed, antitarget_bed), nbam,
+                              (tgt_fname, anti_fname), by_count, cov_procs,
+                              cache_dir, subsample, cram_fasta, ref_cache,
+                              out_format, write_index))
             target_fnames.append(tgt_fname)
-            anti_fname = sample_pfx + '.antitargetcoverage.cnn'
-            pool.apply_async(batch_write_coverage,
-                             (antitarget_bed, nbam, anti_fname, by_count))
             antitarget_fnames.append(anti_fname)
         pool.close()
         pool.join()
         # Build reference from *.cnn
         ref_arr = do_reference(target_fnames, antitarget_fnames, fasta,
-                               male_reference)
+                               male_reference, processes=processes)
     if not output_reference:
         output_reference = os.path.join(output_dir, "reference.cnn")
+    output_reference = _cna_fname(output_reference, out_format)
     ngfrills.ensure_path(output_reference)
-    ref_arr.write(output_reference)
+    ref_arr.write(output_reference, out_format, write_index)
 
     return output_reference, target_bed, antitarget_bed
 
 
-def batch_write_coverage(bed_fname, bam_fname, out_fname, by_count):
-    """Run coverage on one sample, write to file."""
-    cnarr = do_coverage(bed_fname, bam_fname, by_count)
-    cnarr.write(out_fname)
+def batch_write_coverages(bed_fnames, bam_fname, out_fnames, by_count,
+                          processes=1, cache_dir=None, subsample=None,
+                          fasta=None, ref_cache=None, out_format='tab',
+                          write_index=False):
+    """Run coverage on one sample for each set of regions, write to files."""
+    cnarrs = do_coverages(bed_fnames, bam_fname, by_count, processes=processes,
+                          cache_dir=cache_dir, subsample=subsample,
+                          fasta=fasta, ref_cache=ref_cache)
+    for cnarr, out_fname in zip(cnarrs, out_fnames):
+        cnarr.write(out_fname, out_format, write_index)
 
 
 def batch_run_sample(bam_fname, target_bed, antitarget_bed, ref_fname,
                      output_dir, male_reference=False, scatter=False,
-                     diagram=False, rlibpath=None, by_count=False):
+                     diagram=False, rlibpath=None, by_count=False,
+                     processes=1, cache_dir=None, subsample=None,
+                     fasta=None, ref_cache=None, out_format='tab',
+                     write_index=False):
     """Run the pipeline on one BAM file."""
     # ENH - return probes, segments (cnarr, segarr)
     logging.info("Running the CNVkit pipeline on %s ...", bam_fname)
     sample_id = core.fbase(bam_fname)
     sample_pfx = os.path.join(output_dir, sample_id)
 
-    raw_tgt = do_coverage(target_bed, bam_fname, by_count)
-    raw_tgt.write(sample_pfx + '.targetcoverage.cnn')
-
-    raw_anti = do_coverage(antitarget_bed, bam_fname, by_count)
-    raw_anti.write(sample_pfx + '.antitargetcoverage.cnn')
+    raw_tgt, raw_anti = do_coverages((target_bed, antitarget_bed), bam_fname,
+                                     by_count, processes=processes,
+                                     cache_dir=cache_dir,
+                                     subsample=subsample, fasta=fasta,
+                                     ref_cache=ref_cache)
+    raw_tgt.write(_cna_fname(sample_pfx + '.targetcoverage.cnn', out_format),
+                  out_format, write_index)
+    raw_anti.write(_cna_fname(sample_pfx + '.antitargetcoverage.cnn',
+                              out_format),
+                   out_format, write_index)
 
     cnarr = do_fix(raw_tgt, raw_anti, _CNA.read(ref_fname))
-    cnarr.write(sample_pfx + '.cnr')
+    cnarr.write(_cna_fname(sample_pfx + '.cnr', out_format), out_format,
+                write_index)
 
     logging.info("Segmenting %s.cnr ...", sample_pfx)
     segments = segmentation.do_segmentation(cnarr, 'cbs', rlibpath=rlibpath)
-    segments.write(sample_pfx + '.cns')
+    segments.write(_cna_fname(sample_pfx + '.cns', out_format), out_format,
+                   write_index)
 
     if scatter:
         do_scatter(cnarr, segments)
@@ -232,7 +315,7 @@ def batch_run_sample(bam_fname, target_bed, antitarget_bed, ref_fname,
 
 P_batch = AP_subparsers.add_parser('batch', help=_cmd_batch.__doc__)
 P_batch.add_argument('bam_files', nargs='*',
-        help="Mapped sequence reads (.bam)")
+        help="Mapped sequence reads (.bam or .cram)")
 P_batch.add_argument('-y', '--male-reference', action='store_true',
         help="""Use or assume a male reference (i.e. female samples will have +1
                 log-CNR of chrX; otherwise male samples would have -1 chrX).""")
@@ -241,8 +324,24 @@ P_batch.add_argument('-c', '--count-reads', action='store_true',
                 (An alternative algorithm).""")
 P_batch.add_argument('-p', '--processes', type=int, default=1,
         help="""Number of subprocesses used to running each of the BAM files in
-                parallel. Give 0 or a negative value to use the maximum number
-                of available CPUs. [Default: process each BAM in serial]""")
+                parallel. If there is only one BAM file, its coverages are
+                calculated in parallel instead. Give 0 or a negative value to
+                use the maximum number of available CPUs.
+                [Default: process each BAM in serial]""")
+P_batch.add_argument('--ref-cache', metavar='DIR',
+        help="""Directory to cache the reference genome sequences for reading
+                CRAM files, populated from -f/--fasta if needed. The cached
+                sequences are shared by all subprocesses.""")
+P_batch.add_argument('--subsample', type=float, metavar='FRACTION',
+        help="""Count only this fraction of the reads in each BAM file,
+                selected by a hash of the read name, and scale the counts up
+                to match. Implies --count-reads. For quickly screening samples
+                at reduced accuracy.""")
+P_batch.add_argument('--coverage-cache', metavar='DIR',
+        help="""Directory to cache the bin-level coverages of each BAM file.
+                On reruns with the same BAM files, regions and coverage
+                options, the cached coverages are used instead of reading the
+                BAM files again.""")
 P_batch.add_argument("--rlibpath",
         help="Path to an alternative site-library to use for R packages.")
 
@@ -254,7 +353,9 @@ P_batch_newref.add_argument('-n', '--normal', nargs='*',
                 If this option is used but no files are given, a "flat"
                 reference will be built.""")
 P_batch_newref.add_argument('-f', '--fasta',
-        help="Reference genome, FASTA format (e.g. UCSC hg19.fa)")
+        help="""Reference genome, FASTA format (e.g. UCSC hg19.fa). Also used
+                to read CRAM files, in which case it can be given along with
+                -r/--reference.""")
 P_batch_newref.add_argument('-t', '--targets', #required=True,
         help="Target intervals (.bed or .list)")
 P_batch_newref.add_argument('-a', '--antitargets', #required=True,
@@ -297,6 +398,7 @@ P_batch_report.add_argument('--scatter', action='store_true',
         help="Create a whole-genome copy ratio profile as a PDF scatter plot.")
 P_batch_report.add_argument('--diagram', action='store_true',
         help="Create a diagram of copy ratios on chromosomes as a PDF.")
+_add_format_option(P_batch_report)
 
 P_batch.set_defaults(func=_cmd_batch)
 
@@ -431,36 +533,103 @@ P_anti.set_defaults(func=_cmd_antitarget)
 
 def _cmd_coverage(args):
     """Calculate coverage in the given regions from BAM read depths."""
-    pset = do_coverage(args.interval, args.bam_file, args.count, args.min_mapq)
-    if not args.output:
-        # Create an informative but unique name for the coverage output file
-        bambase = core.fbase(args.bam_file)
-        bedbase = core.rbase(args.interval)
-        tgtbase = ('antitargetcoverage'
-                   if 'anti' in bedbase.lower()
-                   else 'targetcoverage')
-        args.output = '%s.%s.cnn' % (bambase, tgtbase)
-        if os.path.exists(args.output):
-            args.output = '%s.%s.cnn' % (bambase, bedbase)
-    ngfrills.ensure_path(args.output)
-    pset.write(args.output)
-
-
-def do_coverage(bed_fname, bam_fname, by_count=False, min_mapq=0):
+    if args.output and len(args.interval) > 1:
+        sys.exit("Option -o/--output can only be used with a single "
+                 "interval file")
+    fasta, ref_cache = args.fasta, None
+    if args.ref_cache and ngfrills.is_cram(args.bam_file):
+        # Decode CRAM via the cached sequences instead of the FASTA file
+        ngfrills.ensure_ref_cache(args.fasta, args.ref_cache)
+        fasta, ref_cache = None, args.ref_cache
+    psets = do_coverages(args.interval, args.bam_file, args.count,
+                         args.min_mapq, args.processes, args.coverage_cache,
+                         args.subsample, fasta, ref_cache)
+    for bed_fname, pset in zip(args.interval, psets):
+        out_fname = _cna_fname(args.output or
+                               _coverage_fname(core.fbase(args.bam_file),
+                                               bed_fname),
+                               args.format)
+        ngfrills.ensure_path(out_fname)
+        pset.write(out_fname, args.format, args.index)
+
+
+def _coverage_fname(sample_id, bed_fname, output_dir=''):
+    """Create an informative but unique name for a coverage output file."""
+    bedbase = core.rbase(bed_fname)
+    tgtbase = ('antitargetcoverage'
+               if 'anti' in bedbase.lower()
+               else 'targetcoverage')
+    out_fname = os.path.join(output_dir, '%s.%s.cnn' % (sample_id, tgtbase))
+    if os.path.exists(out_fname):
+        out_fname = os.path.join(output_dir,
+                                 '%s.%s.cnn' % (sample_id, bedbase))
+    return out_fname
+
+
+def do_coverage(bed_fname, bam_fname, by_count=False, min_mapq=0,
+                processes=1, cache_dir=None, subsample=None, fasta=None,
+                ref_cache=None):
     """Calculate coverage in the given regions from BAM read depths."""
-    if not ngfrills.ensure_bam_sorted(bam_fname):
+    return do_coverages([bed_fname], bam_fname, by_count, min_mapq, processes,
+                        cache_dir, subsample, fasta, ref_cache)[0]
+
+
+def do_coverages(bed_fnames, bam_fname, by_count=False, min_mapq=0,
+                 processes=1, cache_dir=None, subsample=None, fasta=None,
+                 ref_cache=None):
+    """Calculate coverage in several sets of regions with one pass over a BAM.
+
+    If `cache_dir` is given, coverages already cached there are used without
+    reading the BAM file, and newly calculated coverages are added.
+
+    If `subsample` is given, count only that fraction of the reads (chosen by
+    read name), scaling the counts up to match, for a quick, rough result.
+
+    The input may be a CRAM file instead of BAM, decoded with the reference
+    genome sequence `fasta`, or else via the cache of reference sequences in
+    the directory `ref_cache` (see `ngfrills.ensure_ref_cache`).
+
+    Returns a list of CopyNumArrays, one for each BED file, in the same order.
+    """
+    if subsample is not None and not 0 < subsample <= 1:
+        raise ValueError("Subsample fraction must be between 0 and 1, not %s"
+                         % subsample)
+    results = [None] * len(bed_fnames)
+    if cache_dir:
+        keys = [covcache.cache_key(bed_fname, bam_fname, by_count, min_mapq,
+                                   subsample)
+                for bed_fname in bed_fnames]
+        for i, key in enumerate(keys):
+            results[i] = covcache.load(cache_dir, key, bam_fname)
+    todo = [i for i, cnarr in enumerate(results) if cnarr is None]
+    if todo:
+        with ngfrills.using_ref_cache(ref_cache):
+            _check_bam(bam_fname, fasta)
+            # ENH: count importers.TOO_MANY_NO_COVERAGE & warn
+            cnarrs = coverage.interval_coverages_multi(
+                [bed_fnames[i] for i in todo], bam_fname, by_count, min_mapq,
+                processes, subsample, fasta)
+        for i, cnarr in zip(todo, cnarrs):
+            results[i] = cnarr
+            if cache_dir:
+                covcache.store(cache_dir, keys[i], cnarr)
+    return results
+
+
+def _check_bam(bam_fname, fasta=None):
+    """Ensure the BAM or CRAM file is sorted and indexed."""
+    if not ngfrills.ensure_bam_sorted(bam_fname, fasta=fasta):
         raise RuntimeError("BAM file %s must be sorted by coordinates"
                             % bam_fname)
     ngfrills.ensure_bam_index(bam_fname)
-    # ENH: count importers.TOO_MANY_NO_COVERAGE & warn
-    cnarr = coverage.interval_coverages(bed_fname, bam_fname, by_count,
-                                        min_mapq)
-    return cnarr
 
 
 P_coverage = AP_subparsers.add_parser('coverage', help=_cmd_coverage.__doc__)
-P_coverage.add_argument('bam_file', help="Mapped sequence reads (.bam)")
-P_coverage.add_argument('interval', help="Intervals (.bed or .list)")
+P_coverage.add_argument('bam_file', help="Mapped sequence reads (.bam or .cram)")
+P_coverage.add_argument('interval', nargs='+',
+        help="""Intervals (.bed or .list). If several are given (e.g. targets
+                and antitargets), the BAM file is read only once and a
+                separate .cnn file is written for each.""")
 P_coverage.add_argument('-c', '--count', action='store_true',
         help="""Get read depths by counting read midpoints within each bin.
                 (An alternative algorithm).""")
@@ -468,6 +637,29 @@ P_coverage.add_argument('-q', '--min-mapq', type=int, default=0,
         help="""Minimum mapping quality score (phred scale 0-60) to count a read
                 for coverage depth.  [Default: %(default)s]""")
 P_coverage.add_argument('-o', '--output', help="""Output file name.""")
+P_coverage.add_argument('-p', '--processes', type=int, default=1,
+        help="""Number of subprocesses to calculate coverage in parallel,
+                splitting the regions into chunks. Give 0 or a negative value
+                to use the maximum number of available CPUs.
+                [Default: use 1 process]""")
+P_coverage.add_argument('-f', '--fasta',
+        help="""Reference genome, FASTA format (e.g. UCSC hg19.fa), to read a
+                CRAM file.""")
+P_coverage.add_argument('--ref-cache', metavar='DIR',
+        help="""Directory to cache the reference genome sequences for reading
+                CRAM files, populated from -f/--fasta if needed. The cached
+                sequences are shared by all subprocesses.""")
+P_coverage.add_argument('--subsample', type=float, metavar='FRACTION',
+        help="""Count only this fraction of the reads, selected by a hash of
+                the read name, and scale the counts up to match. Implies
+                --count. For a quick, rough preview of the coverages; the
+                bin-level variance increases by a factor of 1/FRACTION.""")
+P_coverage.add_argument('--coverage-cache', metavar='DIR',
+        help="""Directory to cache the bin-level coverages of each BAM file.
+                If the same BAM file, regions and options were already
+                processed, the cached coverages are used instead of reading
+                the BAM file again.""")
+_add_format_option(P_coverage)
 P_coverage.set_defaults(func=_cmd_coverage)
 
 
@@ -476,7 +668,17 @@ P_coverage.set_defaults(func=_cmd_coverage)
 def _cmd_reference(args):
     """Compile a coverage reference from the given files (normal samples)."""
     usage_err_msg = ("Give .cnn samples OR targets and antitargets.")
-    if args.targets and args.antitargets:
+    if args.remove and not args.update:
+        raise ValueError("--remove requires --update")
+    max_memory = (int(args.max_memory * 2**30) if args.max_memory else None)
+    if args.update:
+        # Add or remove samples in an existing reference store
+        assert not args.targets and not args.antitargets, usage_err_msg
+        targets, antitargets = _reference_fnames(args.references)
+        ref_probes = do_reference_update(args.update, targets, antitargets,
+                                         args.remove, args.processes,
+                                         max_memory)
+    elif args.targets and args.antitargets:
         # Flat refence
         assert not args.references, usage_err_msg
         ref_probes = do_reference_flat(args.targets, args.antitargets,
@@ -484,48 +686,76 @@ def _cmd_reference(args):
     elif args.references:
         # Pooled reference
         assert not args.targets and not args.antitargets, usage_err_msg
-        filenames = []
-        for path in args.references:
-            if os.path.isdir(path):
-                filenames.extend(os.path.join(path, f) for f in os.listdir(path)
-                                 if f.endswith('targetcoverage.cnn'))
-            else:
-                filenames.append(path)
-        targets = [f for f in filenames if 'antitarget' not in f]
-        antitargets = [f for f in filenames if 'antitarget' in f]
-        logging.info("Number of target and antitarget files: %d, %d",
-                     len(targets), len(antitargets))
+        targets, antitargets = _reference_fnames(args.references)
         if args.tthreshold and args.athreshold:
             print ("Thresholds for gender determination: ", args.tthreshold, "for target and", args.athreshold, "for antitarget.")
             ref_probes = do_reference(targets, antitargets, args.fasta,
                                       args.male_reference,
-                                      args.do_gc, args.do_edge, args.do_rmask, args.tthreshold, args.athreshold)
+                                      args.do_gc, args.do_edge, args.do_rmask, args.tthreshold, args.athreshold,
+                                      processes=args.processes,
+                                      store_dir=args.store,
+                                      max_memory=max_memory)
         if args.tthreshold and args.athreshold is None:
             print ("Threshold for gender determination by target:", args.tthreshold)
             ref_probes = do_reference(targets, antitargets, args.fasta,
                                       args.male_reference,
-                                      args.do_gc, args.do_edge, args.do_rmask, target_threshold = args.tthreshold)
+                                      args.do_gc, args.do_edge, args.do_rmask, target_threshold = args.tthreshold,
+                                      processes=args.processes,
+                                      store_dir=args.store,
+                                      max_memory=max_memory)
         if args.athreshold and args.tthreshold is None:
             print ("Threshold for gender determination by antitarget:", args.athreshold)
             ref_probes = do_reference(targets, antitargets, args.fasta,
                                       args.male_reference,
-                                      args.do_gc, args.do_edge, args.do_rmask, antitarget_threshold = args.athreshold)
+                                      args.do_gc, args.do_edge, args.do_rmask, antitarget_threshold = args.athreshold,
+                                      processes=args.processes,
+                                      store_dir=args.store,
+                                      max_memory=max_memory)
         elif args.tthreshold is None and args.athreshold is None:
             print ("No input threasolds for gender determination. Using standerd: -0.5 for raw target data and +0.5 for probe data already corrected on a male profile.")
             ref_probes = do_reference(targets, antitargets, args.fasta,
                                       args.male_reference,
-                                      args.do_gc, args.do_edge, args.do_rmask)
+                                      args.do_gc, args.do_edge, args.do_rmask,
+                                      processes=args.processes,
+                                      store_dir=args.store,
+                                      max_memory=max_memory)
     else:
         raise ValueError(usage_err_msg)
 
-    ref_fname = args.output or "cnv_reference.cnn"
+    ref_fname = _cna_fname(args.output or "cnv_reference.cnn", args.format)
     ngfrills.ensure_path(ref_fname)
-    ref_probes.write(ref_fname)
+    ref_probes.write(ref_fname, args.format, args.index)
+
+
+def _reference_fnames(paths):
+    """Find the target and antitarget .cnn files among files and directories."""
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(os.path.join(path, f) for f in os.listdir(path)
+                             if f.endswith(('targetcoverage.cnn',
+                                            'targetcoverage.cnn.npz')))
+        else:
+            filenames.append(path)
+    targets = [f for f in filenames if 'antitarget' not in f]
+    antitargets = [f for f in filenames if 'antitarget' in f]
+    logging.info("Number of target and antitarget files: %d, %d",
+                 len(targets), len(antitargets))
+    return targets, antitargets
 
 
 def do_reference(target_fnames, antitarget_fnames, fa_fname=None,
-                 male_reference=False, do_gc=True, do_edge=True, do_rmask=True, target_threshold=None, antitarget_threshold=None):
-    """Compile a coverage reference from the given files (normal samples)."""
+                 male_reference=False, do_gc=True, do_edge=True, do_rmask=True, target_threshold=None, antitarget_threshold=None,
+                 processes=1, store_dir=None, max_memory=None):
+    """Compile a coverage reference from the given files (normal samples).
+
+    With `store_dir`, also save the samples' bias-corrected coverages there, so
+    the reference can be updated later (see `do_reference_update`).
+
+    With `max_memory` (in bytes), if the samples' corrected coverages won't fit
+    in that much memory, keep them in a temporary file and summarize them in
+    chunks of bins instead. The result is the same.
+    """
     core.assert_equal("Unequal number of target and antitarget files given",
                       targets=len(target_fnames),
                       antitargets=len(antitarget_fnames))
@@ -536,10 +766,40 @@ def do_reference(target_fnames, antitarget_fnames, fa_fname=None,
     # Calculate & save probe centers
     ref_probes = reference.combine_probes(target_fnames, fa_fname,
                                           male_reference, True,
-                                          do_gc, do_edge, False, target_threshold)
+                                          do_gc, do_edge, False, target_threshold,
+                                          processes, store_dir, 'targets',
+                                          max_memory)
     ref_probes.add(reference.combine_probes(antitarget_fnames, fa_fname,
                                             male_reference, False,
-                                            do_gc, False, do_rmask, antitarget_threshold))
+                                            do_gc, False, do_rmask, antitarget_threshold,
+                                            processes, store_dir, 'antitargets',
+                                            max_memory))
+    ref_probes.center_all(skip_low=True)
+    ref_probes.sort_columns()
+    reference.warn_bad_probes(ref_probes)
+    return ref_probes
+
+
+def do_reference_update(store_dir, target_fnames=(), antitarget_fnames=(),
+                        remove_ids=(), processes=1, max_memory=None):
+    """Update a reference from its store of the samples' corrected coverages.
+
+    Only the new samples (target and antitarget files) are loaded and
+    corrected, with the options the store was built with. Samples given by ID
+    in `remove_ids` are dropped. The result is the same as rebuilding the
+    reference from the resulting set of samples with `do_reference`.
+
+    The stored coverages are memory-mapped and summarized within `max_memory`
+    bytes, if given.
+    """
+    core.assert_equal("Unequal number of target and antitarget files given",
+                      targets=len(target_fnames),
+                      antitargets=len(antitarget_fnames))
+    ref_probes = reference.update_probes(store_dir, 'targets', target_fnames,
+                                         remove_ids, processes, max_memory)
+    ref_probes.add(reference.update_probes(store_dir, 'antitargets',
+                                           antitarget_fnames, remove_ids,
+                                           processes, max_memory))
     ref_probes.center_all(skip_low=True)
     ref_probes.sort_columns()
     reference.warn_bad_probes(ref_probes)
@@ -596,6 +856,31 @@ P_reference.add_argument('--no-edge', dest='do_edge', action='store_false',
 P_reference.add_argument('--no-rmask', dest='do_rmask', action='store_false',
         help="Skip RepeatMasker correction.")
 P_reference.add_argument('-o', '--output', help="Output file name.")
+P_reference.add_argument('--store', metavar='DIR',
+        help="""Also save each normal sample's bias-corrected coverages in this
+                directory, so the reference can be updated later with
+                --update.""")
+P_reference.add_argument('--update', metavar='DIR',
+        help="""Update the reference from the samples saved in this directory
+                (with --store), adding the normal samples given as arguments.
+                Only the new samples are processed, with the options the
+                store was built with.""")
+P_reference.add_argument('--remove', action='append', default=[],
+        metavar='SAMPLE_ID',
+        help="""With --update, remove this sample from the reference (e.g. if
+                it failed QC). Can be used more than once.""")
+P_reference.add_argument('--max-memory', type=float, metavar='GB',
+        help="""Approximate memory limit, in gigabytes, for the matrix of the
+                normal samples' corrected coverages. A larger matrix is kept
+                in a temporary file instead (see TMPDIR), and each bin's
+                average and spread are calculated in chunks that fit the
+                limit. [Default: no limit]""")
+P_reference.add_argument('-p', '--processes', type=int, default=1,
+        help="""Number of subprocesses to load and bias-correct the normal
+                samples in parallel. Give 0 or a negative value to use the
+                maximum number of available CPUs.
+                [Default: process each sample in serial]""")
+_add_format_option(P_reference)
 P_reference.set_defaults(func=_cmd_reference)
 
 
@@ -608,15 +893,17 @@ def _cmd_fix(args):
     biases and re-center.
     """
     # Verify that target and antitarget are from the same sample
-    tgt_raw = _CNA.read(args.target)
-    anti_raw = _CNA.read(args.antitarget)
+    tgt_raw = _read_cna(args.target, args)
+    anti_raw = _read_cna(args.antitarget, args)
     if tgt_raw.sample_id != anti_raw.sample_id:
         raise ValueError("Sample IDs do not match:"
                          "'%s' (target) vs. '%s' (antitarget)"
                          % (tgt_raw.sample_id, anti_raw.sample_id))
-    target_table = do_fix(tgt_raw, anti_raw, _CNA.read(args.reference),
+    target_table = do_fix(tgt_raw, anti_raw, _read_cna(args.reference, args),
                           args.do_gc, args.do_edge, args.do_rmask)
-    target_table.write(args.output or tgt_raw.sample_id + '.cnr')
+    target_table.write(_cna_fname(args.output or tgt_raw.sample_id + '.cnr',
+                                  args.format),
+                       args.format, args.index)
 
 
 def do_fix(target_raw, antitarget_raw, reference,
@@ -669,6 +956,7 @@ P_fix.add_argument('--no-rmask', dest='do_rmask', action='store_false',
         help="Skip RepeatMasker correction.")
 P_fix.add_argument('-o', '--output',
         help="Output file name.")
+_add_format_option(P_fix)
 P_fix.set_defaults(func=_cmd_fix)
 
 
@@ -676,7 +964,7 @@ P_fix.set_defaults(func=_cmd_fix)
 
 def _cmd_segment(args):
     """Infer copy number segments from the given coverage table."""
-    cnarr = _CNA.read(args.filename)
+    cnarr = _read_cna(args.filename, args)
     variants = (_VA.read_vcf(args.vcf, skip_hom=True, skip_somatic=True)
                 if args.vcf else None)
     results = segmentation.do_segmentation(cnarr, args.method, args.threshold,
@@ -692,7 +980,9 @@ def _cmd_segment(args):
         logging.info("Wrote %s", args.dataframe)
     else:
         segments = results
-    segments.write(args.output or segments.sample_id + '.cns')
+    segments.write(_cna_fname(args.output or segments.sample_id + '.cns',
+                              args.format),
+                   args.format, args.index)
 
 
 P_segment = AP_subparsers.add_parser('segment', help=_cmd_segment.__doc__)
@@ -724,6 +1014,7 @@ P_segment.add_argument("--drop-outliers",
                 [Default: %(default)g]""")
 P_segment.add_argument("--rlibpath",
         help="Path to an alternative site-library to use for R packages.")
+_add_format_option(P_segment)
 P_segment.set_defaults(func=_cmd_segment)
 
 
@@ -737,7 +1028,7 @@ def _cmd_rescale(args):
     if args.purity and not 0.0 < args.purity <= 1.0:
         raise RuntimeError("Purity must be between 0 and 1.")
 
-    cnarr = _CNA.read(args.filename)
+    cnarr = _read_cna(args.filename, args)
     if args.center:
         cnarr.center_all(args.center)
     if args.purity and args.purity < 1.0:
@@ -745,7 +1036,8 @@ def _cmd_rescale(args):
                                              args.male_reference)
         cnarr = do_rescale(cnarr, args.ploidy, args.purity,
                            args.male_reference, is_sample_female)
-    cnarr.write(args.output)
+    cnarr.write(_cna_fname(args.output, args.format), args.format,
+                args.index)
 
 
 def do_rescale(cnarr, ploidy=2, purity=None, is_reference_male=False,
@@ -781,6 +1073,7 @@ P_rescale.add_argument('-y', '--male-reference', action='store_true',
                 of chrX is 1; chrY is haploid for either gender reference.""")
 P_rescale.add_argument('-o', '--output',
         help="Output table file name (CNR-like table of segments, .cns).")
+_add_format_option(P_rescale)
 P_rescale.set_defaults(func=_cmd_rescale)
 
 
@@ -791,7 +1084,7 @@ def _cmd_call(args):
     if args.purity and not 0.0 < args.purity <= 1.0:
         raise RuntimeError("Purity must be between 0 and 1.")
 
-    cnarr = _CNA.read(args.filename)
+    cnarr = _read_cna(args.filename, args)
     if args.center:
         cnarr.center_all(args.center)
     is_sample_female = (verify_gender_arg(cnarr, args.gender,
@@ -803,7 +1096,9 @@ def _cmd_call(args):
            else None)
     cnarr = do_call(cnarr, vcf, args.method, args.ploidy, args.purity,
                     args.male_reference, is_sample_female, args.thresholds)
-    cnarr.write(args.output or cnarr.sample_id + '.call.cns')
+    cnarr.write(_cna_fname(args.output or cnarr.sample_id + '.call.cns',
+                           args.format),
+                args.format, args.index)
 
 
 def do_call(cnarr, variants=None, method="threshold", ploidy=2, purity=None,
@@ -814,10 +1109,9 @@ def do_call(cnarr, variants=None, method="threshold", ploidy=2, purity=None,
 
     outarr = cnarr.copy()
     if variants:
-        # baf_median = lambda x: np.median(np.abs(x - .5)) + .5
-        baf_median = export.mirrored_baf_median
-        outarr["baf"] = outarr.match_to_bins(variants, 'alt_freq', np.nan,
-                                            summary_func=baf_median)
+        outarr["baf"] = outarr.match_to_bins(
+            variants, 'alt_freq', np.nan,
+            grouped_func=export.grouped_mirrored_baf_median)
 
     if purity and purity < 1.0:
         logging.info("Rescaling sample with purity %g, ploidy %d",
@@ -922,6 +1216,7 @@ P_call.add_argument('-y', '--male-reference', action='store_true',
                 of chrX is 1; chrY is haploid for either gender reference.""")
 P_call.add_argument('-o', '--output',
         help="Output table file name (CNR-like table of segments, .cns).")
+_add_format_option(P_call)
 P_call.set_defaults(func=_cmd_call)
 
 
@@ -937,8 +1232,8 @@ def _cmd_diagram(args):
     each chromosome (segments on the left side, probes on the right side).
     """
     from cnvlib import diagram
-    cnarr = _CNA.read(args.filename) if args.filename else None
-    segarr = _CNA.read(args.segment) if args.segment else None
+    cnarr = _read_cna(args.filename, args) if args.filename else None
+    segarr = _read_cna(args.segment, args) if args.segment else None
     outfname = diagram.create_diagram(cnarr, segarr, args.threshold,
                                       args.min_probes, args.output,
                                       args.male_reference)
@@ -970,9 +1265,12 @@ P_diagram.set_defaults(func=_cmd_diagram)
 
 def _cmd_scatter(args):
     """Plot probe log2 coverages and segmentation calls together."""
-    cnarr = _CNA.read(args.filename, args.sample_id
-                     ) if args.filename else None
-    segarr = _CNA.read(args.segment
+    # Only one chromosome is shown with -c (even with -g), so skip the rest
+    show_chrom = (plots.unpack_range(args.chromosome)[0]
+                  if args.chromosome and not args.range_list else None)
+    cnarr = _read_cna(args.filename, args, sample_id=args.sample_id,
+                      region=show_chrom) if args.filename else None
+    segarr = _read_cna(args.segment, args, region=show_chrom
                       ) if args.segment else None
     varr = _VA.read_vcf(args.vcf, args.sample_id, args.normal_id,
                         args.min_variant_depth, skip_hom=True, skip_somatic=True
@@ -1193,7 +1491,7 @@ def _cmd_loh(args):
     """
     variants = _VA.read_vcf(args.variants, args.sample_id, args.normal_id,
                             args.min_depth, skip_hom=True, skip_somatic=True)
-    segments = _CNA.read(args.segment) if args.segment else None
+    segments = _read_cna(args.segment, args) if args.segment else None
     _fig, axis = pyplot.subplots()
     axis.set_title("Variant allele frequencies: %s" % variants.sample_id)
     chrom_sizes = collections.OrderedDict(
@@ -1230,7 +1528,11 @@ P_loh.set_defaults(func=_cmd_loh)
 
 def _cmd_heatmap(args):
     """Plot copy number for multiple samples as a heatmap."""
-    cnarrs = list(map(_CNA.read, args.filenames))
+    # Load only the selected region of each file, and just the values to plot
+    region = (plots.unpack_range(args.chromosome) if args.chromosome
+              else None)
+    cnarrs = [_read_cna(fname, args, columns=['log2'], region=region)
+              for fname in args.filenames]
     do_heatmap(cnarrs, args.chromosome, args.desaturate)
     if args.output:
         pyplot.savefig(args.output, format='pdf', bbox_inches="tight")
@@ -1349,8 +1651,8 @@ P_heatmap.set_defaults(func=_cmd_heatmap)
 
 def _cmd_breaks(args):
     """List the targeted genes in which a copy number breakpoint occurs."""
-    cnarr = _CNA.read(args.filename)
-    segarr = _CNA.read(args.segment)
+    cnarr = _read_cna(args.filename, args)
+    segarr = _read_cna(args.segment, args)
     bpoints = do_breaks(cnarr, segarr, args.min_probes)
     logging.info("Found %d gene breakpoints", len(bpoints))
     core.write_tsv(args.output, bpoints,
@@ -1383,8 +1685,8 @@ P_breaks.set_defaults(func=_cmd_breaks)
 
 def _cmd_gainloss(args):
     """Identify targeted genes with copy number gain or loss."""
-    pset = _CNA.read(args.filename)
-    segs = _CNA.read(args.segment) if args.segment else None
+    pset = _read_cna(args.filename, args)
+    segs = _read_cna(args.segment, args) if args.segment else None
     gainloss = do_gainloss(pset, segs, args.male_reference, args.threshold,
                            args.min_probes, args.drop_low_coverage)
     logging.info("Found %d gene-level gains and losses", len(gainloss))
@@ -1436,7 +1738,8 @@ def _cmd_gender(args):
     """Guess samples' gender from the relative coverage of chromosome X."""
     outrows = []
     for fname in args.targets:
-        rel_chrx_cvg = _CNA.read(fname).get_relative_chrx_cvg()
+        rel_chrx_cvg = _read_cna(fname, args, columns=['log2', 'probes']
+                                ).get_relative_chrx_cvg()
         if args.male_reference:
             is_xx = (rel_chrx_cvg >= 0.5)
         else:
@@ -1477,8 +1780,8 @@ def _cmd_metrics(args):
     # Calculate all metrics
     outrows = []
     for probes_fname, segs_fname in zip(args.cnarrays, args.segments):
-        cnarr = _CNA.read(probes_fname)
-        segments = _CNA.read(segs_fname)
+        cnarr = _read_cna(probes_fname, args)
+        segments = _read_cna(segs_fname, args)
         values = metrics.ests_of_scale(cnarr.drop_low_coverage()
                                        .residuals(segments))
         outrows.append([core.rbase(probes_fname), len(segments)] +
@@ -1510,52 +1813,50 @@ def _cmd_segmetrics(args):
     if not 0.0 < args.alpha <= 1.0:
         raise RuntimeError("alpha must be between 0 and 1.")
 
+    # Grouped (vectorized) versions, taking deviations, segment IDs, #segments
     stats = {
-        'stdev': np.std,
-        'mad':  metrics.median_absolute_deviation,
-        'iqr':  metrics.interquartile_range,
-        'bivar': metrics.biweight_midvariance,
-        'ci': lambda x: metrics.confidence_interval_bootstrap(x, args.alpha,
-                                                              args.bootstrap),
-        'pi': lambda x: metrics.prediction_interval(x, args.alpha),
+        'stdev': metrics.grouped_std,
+        'mad':  metrics.grouped_mad,
+        'iqr':  lambda d, ids, n: (metrics.grouped_percentile(d, ids, n, 75) -
+                                   metrics.grouped_percentile(d, ids, n, 25)),
+        'bivar': metrics.grouped_biweight_midvariance,
+        # Intervals: taking log2 values, weights, segment IDs, #segments
+        'ci': lambda x, w, ids, n: metrics.grouped_confidence_interval_bootstrap(
+            x, ids, n, args.alpha, args.bootstrap, w),
+        'pi': lambda x, _w, ids, n: metrics.grouped_prediction_interval(
+            x, ids, n, args.alpha),
     }
     if not any(getattr(args, name) for name in stats):
         logging.info("No stats specified")
         return
 
     # Calculate all metrics
-    cnarr = _CNA.read(args.cnarray)
+    cnarr = _read_cna(args.cnarray, args)
     if args.drop_low_coverage:
         cnarr = cnarr.drop_low_coverage()
-    segarr = _CNA.read(args.segments)
-    deviations = [segbins.log2 - segment.log2
-                  for segment, segbins in cnarr.by_ranges(segarr)]
+    segarr = _read_cna(args.segments, args)
+    seg_idx, bin_idx = cnarr.ranges_idx(segarr)
+    bin_log2s = cnarr['log2'].values[bin_idx]
+    deviations = bin_log2s - segarr['log2'].values[seg_idx]
     # Measures of spread
     for statname in ("StDev", "MAD", "IQR", "BiVar"):
         option = statname.lower()
         if getattr(args, option):
             func = stats[option]
-            segarr[statname] = np.asfarray([func(d) for d in deviations])
+            segarr[statname] = func(deviations, seg_idx, len(segarr))
 
     # Interval calculations
-    if args.ci:
-        segarr["CI_lo"], segarr["CI_hi"] = _segmetric_interval(segarr, cnarr,
-                                                               stats['ci'])
-    if args.pi:
-        segarr["PI_lo"], segarr["PI_hi"] = _segmetric_interval(segarr, cnarr,
-                                                               stats['pi'])
-
-    segarr.write(args.output or segarr.sample_id + ".segmetrics.cns")
-
+    bin_weights = (cnarr['weight'].values[bin_idx] if 'weight' in cnarr
+                   else None)
+    for statname in ("CI", "PI"):
+        if getattr(args, statname.lower()):
+            func = stats[statname.lower()]
+            segarr[statname + "_lo"], segarr[statname + "_hi"] = func(
+                bin_log2s, bin_weights, seg_idx, len(segarr))
 
-def _segmetric_interval(segarr, cnarr, func):
-    """Compute a stat that yields intervals (low & high values)"""
-    out_vals_lo =  np.repeat(np.nan, len(segarr))
-    out_vals_hi = np.repeat(np.nan, len(segarr))
-    for i, (_segment, bins) in enumerate(cnarr.by_ranges(segarr)):
-        if len(bins):
-            out_vals_lo[i], out_vals_hi[i] = func(bins)
-    return out_vals_lo, out_vals_hi
+    segarr.write(_cna_fname(args.output or
+                            segarr.sample_id + ".segmetrics.cns", args.format),
+                 args.format, args.index)
 
 
 P_segmetrics = AP_subparsers.add_parser('segmetrics', help=_cmd_segmetrics.__doc__)
@@ -1589,6 +1890,7 @@ P_segmetrics_stats.add_argument('-a', '--alpha', type=float, default=.05,
 P_segmetrics_stats.add_argument('-b', '--bootstrap', type=int, default=100,
         help="""Number of bootstrap iterations to estimate confidence interval;
                 use with --ci. [Default: %(default)d]""")
+_add_format_option(P_segmetrics)
 P_segmetrics.set_defaults(func=_cmd_segmetrics)
 
 
@@ -1611,7 +1913,8 @@ def _cmd_import_picard(args):
                 os.mkdir(args.output_dir)
                 logging.info("Created directory %s", args.output_dir)
             outfname = os.path.join(args.output_dir, outfname)
-        cnarr.write(outfname)
+        cnarr.write(_cna_fname(outfname, args.format), args.format,
+                    args.index)
 
 
 P_import_picard = AP_subparsers.add_parser('import-picard',
@@ -1621,9 +1924,49 @@ P_import_picard.add_argument('targets', nargs='*', default=['.'],
                 directory that contains them.""")
 P_import_picard.add_argument('-d', '--output-dir', default='.',
         help="Output directory name.")
+_add_format_option(P_import_picard)
 P_import_picard.set_defaults(func=_cmd_import_picard)
 
 
+# import-depth ----------------------------------------------------------------
+
+def _cmd_import_depth(args):
+    """Convert precomputed read depths (e.g. bedGraph) to CNVkit .cnn files.
+
+    The read depths of each sample (e.g. from mosdepth, or a bedGraph) are
+    summarized in the given target and antitarget bins, as the 'coverage'
+    command would do with the BAM file.
+    """
+    cnarrs = importers.import_depth(args.depth_file, args.interval,
+                                    args.sample_id)
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.mkdir(args.output_dir)
+        logging.info("Created directory %s", args.output_dir)
+    for bed_fname, cnarr in zip(args.interval, cnarrs):
+        cnarr.write(_cna_fname(_coverage_fname(cnarr.sample_id, bed_fname,
+                                               args.output_dir),
+                               args.format),
+                    args.format, args.index)
+
+
+P_import_depth = AP_subparsers.add_parser('import-depth',
+        help=_cmd_import_depth.__doc__)
+P_import_depth.add_argument('depth_file',
+        help="""Read depths in BED-like format, optionally gzipped, with the
+                mean depth of each interval in the last column: bedGraph, or
+                mosdepth per-base.bed.gz or regions.bed.gz.""")
+P_import_depth.add_argument('interval', nargs='+',
+        help="""Bins to summarize the depths in (.bed or .list), e.g. targets
+                and antitargets. A .cnn file is written for each.""")
+P_import_depth.add_argument('-i', '--sample-id',
+        help="""Sample ID for the output files. [Default: the depth file name,
+                without directory or extensions]""")
+P_import_depth.add_argument('-d', '--output-dir', default='.',
+        help="Output directory name.")
+_add_format_option(P_import_depth)
+P_import_depth.set_defaults(func=_cmd_import_depth)
+
+
 # import-seg ------------------------------------------------------------------
 
 def _cmd_import_seg(args):
@@ -1639,7 +1982,10 @@ def _cmd_import_seg(args):
 
     for segset in importers.import_seg(args.segfile, chrom_names, args.prefix,
                                        args.from_log10):
-        segset.write(os.path.join(args.output_dir, segset.sample_id + '.cns'))
+        segset.write(_cna_fname(os.path.join(args.output_dir,
+                                             segset.sample_id + '.cns'),
+                                args.format),
+                     args.format, args.index)
 
 
 P_import_seg = AP_subparsers.add_parser('import-seg',
@@ -1657,6 +2003,7 @@ P_import_seg.add_argument('--from-log10', action='store_true',
         help="Convert base-10 logarithm values in the input to base-2 logs.")
 P_import_seg.add_argument('-d', '--output-dir', default='.',
         help="Output directory name.")
+_add_format_option(P_import_seg)
 P_import_seg.set_defaults(func=_cmd_import_seg)
 
 
@@ -1668,11 +2015,14 @@ def _cmd_import_theta(args):
     Equivalently, use the THetA results file to convert CNVkit .cns segments to
     integer copy number calls.
     """
-    tumor_segs = _CNA.read(args.tumor_cns)
+    tumor_segs = _read_cna(args.tumor_cns, args)
     for i, new_cns in enumerate(do_import_theta(tumor_segs, args.theta_results,
                                                 args.ploidy)):
-        new_cns.write(os.path.join(args.output_dir,
-                                   "%s-%d.cns" % (tumor_segs.sample_id, i + 1)))
+        new_cns.write(_cna_fname(os.path.join(args.output_dir,
+                                              "%s-%d.cns" % (tumor_segs.sample_id,
+                                                             i + 1)),
+                                 args.format),
+                      args.format, args.index)
 
 
 def do_import_theta(segarr, theta_results_fname, ploidy=2):
@@ -1697,6 +2047,7 @@ P_import_theta.add_argument("--ploidy", type=int, default=2,
         help="Ploidy of normal cells. [Default: %(default)d]")
 P_import_theta.add_argument('-d', '--output-dir', default='.',
         help="Output directory name.")
+_add_format_option(P_import_theta)
 P_import_theta.set_defaults(func=_cmd_import_theta)
 
 
@@ -1722,7 +2073,7 @@ def _cmd_export_bed(args):
         args.show = "all"
     bed_tables = []
     for segfname in args.segments:
-        segments = _CNA.read(segfname)
+        segments = _read_cna(segfname, args)
         # ENH: args.gender as a comma-separated list of genders
         is_sample_female = verify_gender_arg(segments, args.gender,
                                              args.male_reference)
@@ -1792,7 +2143,7 @@ def _cmd_export_vcf(args):
     Input is a segmentation file (.cns) where, preferably, log2 ratios have
     already been adjusted to integer absolute values using the 'call' command.
     """
-    segments = _CNA.read(args.segments)
+    segments = _read_cna(args.segments, args)
     is_sample_female = verify_gender_arg(segments,
                                          args.gender,
                                          args.male_reference)
@@ -0,0 +1,143 @@
+"""On-disk cache of bin-level coverages, to avoid rescanning unchanged BAMs.
+
+Each entry is a file in the binary format (see `npz`), so the values are
+stored exactly, named by a hash of everything that determines its contents:
+the BAM file's identity, the contents of the BED file, the coverage options,
+and the CNVkit version. Entries are evicted in least-recently-used order when
+the cache grows past a size limit, which can be set in gigabytes with the
+environment variable CNVKIT_COVERAGE_CACHE_SIZE.
+"""
+from __future__ import absolute_import, division
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import zipfile
+
+from Bio._py3k import map
+
+from . import npz
+from .cnary import CopyNumArray as CNA
+from .core import fbase
+from ._version import __version__
+
+# Default total size of the cached files to keep, in bytes
+MAX_CACHE_SIZE = 10 * 2**30
+# Environment variable to override that, in gigabytes
+CACHE_SIZE_VAR = 'CNVKIT_COVERAGE_CACHE_SIZE'
+ENTRY_EXT = '.npz'
+# Errors from reading a damaged entry, e.g. truncated by a full disk
+ENTRY_ERRORS = (ValueError, KeyError, EOFError, struct.error,
+                zipfile.BadZipfile)
+
+
+def max_cache_size():
+    """The cache size limit in bytes, from the environment or the default."""
+    size_gb = os.environ.get(CACHE_SIZE_VAR)
+    if not size_gb:
+        return MAX_CACHE_SIZE
+    try:
+        return int(float(size_gb) * 2**30)
+    except ValueError:
+        raise ValueError("%s must be a number of gigabytes, not %r"
+                         % (CACHE_SIZE_VAR, size_gb))
+
+
+def cache_key(bed_fname, bam_fname, by_count, min_mapq, subsample=None):
+    """Hash the inputs and options that determine a BAM file's coverages.
+
+    The BAM file is identified by its absolute path, size and modification
+    time, so it isn't read at all. The BED file is identified by its contents.
+    """
+    bam_stat = os.stat(bam_fname)
+    bed_hash = hashlib.sha1()
+    with open(bed_fname, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(2**20), b''):
+            bed_hash.update(chunk)
+    fields = [__version__,
+              os.path.abspath(bam_fname), bam_stat.st_size,
+              repr(bam_stat.st_mtime),
+              bed_hash.hexdigest(),
+              'count' if by_count or subsample else 'pileup',
+              min_mapq,
+              subsample]
+    return hashlib.sha1('\t'.join(map(str, fields)).encode('utf-8')
+                       ).hexdigest()
+
+
+def load(cache_dir, key, bam_fname):
+    """Read cached coverages, or return None if there's no usable entry.
+
+    A damaged entry is deleted, to be replaced.
+    """
+    fname = os.path.join(cache_dir, key + ENTRY_EXT)
+    try:
+        # Mark the entry as recently used
+        os.utime(fname, None)
+        cnarr = CNA.read(fname, fbase(bam_fname))
+    except (IOError, OSError):
+        # Not cached, or evicted in the meantime
+        return None
+    except ENTRY_ERRORS as exc:
+        logging.warning("Discarding damaged coverage cache entry %s: %s",
+                        fname, exc)
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+        return None
+    logging.info("Using cached coverages of %s (%s)",
+                 os.path.basename(bam_fname), fname)
+    return cnarr
+
+
+def store(cache_dir, key, cnarr, max_size=None):
+    """Add coverages to the cache, then evict old entries to fit the size.
+
+    The size limit is `max_size` bytes, or by default `max_cache_size`.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+        logging.info("Created coverage cache directory %s", cache_dir)
+    # Write to a temporary file first so readers never see a partial entry
+    fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            npz.write(handle, cnarr.data, cnarr.meta)
+        os.rename(tmp_fname, os.path.join(cache_dir, key + ENTRY_EXT))
+    except:
+        os.remove(tmp_fname)
+        raise
+    logging.info("Cached %d bin coverages of %s", len(cnarr), cnarr.sample_id)
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size=None):
+    """Delete the least recently used entries beyond the total size limit.
+
+    The most recently used entry is always kept. Entries in the text format
+    of earlier versions (.cnn) count too; since they're no longer read, they
+    age out.
+    """
+    if max_size is None:
+        max_size = max_cache_size()
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if fname.endswith((ENTRY_EXT, '.cnn')):
+            path = os.path.join(cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort(reverse=True)
+    total_size = 0
+    for i, (_mtime, size, path) in enumerate(entries):
+        total_size += size
+        if i and total_size > max_size:
+            try:
+                os.remove(path)
+                logging.debug("Evicted %s from the coverage cache", path)
+            except OSError:
+                pass
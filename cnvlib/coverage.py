@@ -2,13 +2,19 @@
 from __future__ import absolute_import, division
 
 import logging
-import math
+import multiprocessing
 import os.path
+import shutil
+import tempfile
 import time
+import zlib
 
-from Bio._py3k import map, zip
+import numpy as np
+import pandas as pd
+from Bio._py3k import StringIO, basestring, range, zip
 import pysam
 
+from . import ngfrills, parallel
 from .cnary import CopyNumArray as CNA
 from .rary import RegionArray as RA
 from .core import fbase
@@ -16,8 +22,18 @@ from .core import fbase
 from .params import NULL_LOG2_COVERAGE, READ_LEN
 
 
-def interval_coverages(bed_fname, bam_fname, by_count, min_mapq):
-    """Calculate log2 coverages in the BAM file at each interval."""
+def interval_coverages(bed_fname, bam_fname, by_count, min_mapq,
+                       processes=1, subsample=None, fasta=None):
+    """Calculate log2 coverages in the BAM file at each interval.
+
+    With `processes` other than 1, the regions are split into shards which are
+    processed in parallel; give 0 or a negative value to use all CPUs.
+
+    With `subsample`, only that fraction of reads is counted (implying
+    `by_count`), for a quick but noisier estimate of the coverages.
+
+    CRAM files are decoded with the reference genome sequence `fasta`, if given.
+    """
     start_time = time.time()
 
     # Skip processing if the BED file is empty
@@ -31,14 +47,28 @@ def interval_coverages(bed_fname, bam_fname, by_count, min_mapq):
             return CNA.from_rows([], meta_dict={'sample_id': fbase(bam_fname)})
 
     # Calculate average read depth in each bin
-    ic_func = (interval_coverages_count if by_count
-               else interval_coverages_pileup)
-    results = ic_func(bed_fname, bam_fname, min_mapq)
-    read_counts, cna_rows = zip(*list(results))
+    if subsample:
+        # Counting is the only method that can skip reads
+        ic_func = interval_coverages_count
+        ic_args = (min_mapq, subsample, fasta)
+        logging.info("Counting %.3g of the reads; expect %.3g times the "
+                     "variance of full-depth bin coverages",
+                     subsample, 1. / subsample)
+    else:
+        ic_func = (interval_coverages_count if by_count
+                   else interval_coverages_pileup)
+        ic_args = ((min_mapq, None, fasta) if by_count
+                   else (min_mapq, fasta))
+    if processes == 1:
+        table = ic_func(bed_fname, bam_fname, *ic_args)
+    else:
+        table = interval_coverages_sharded(ic_func, bed_fname, bam_fname,
+                                           ic_args, processes)
+    read_counts = table["count"].values
 
     # Log some stats
     tot_time = time.time() - start_time
-    tot_reads = sum(read_counts)
+    tot_reads = read_counts.sum()
     logging.info("Time: %.3f seconds (%d reads/sec, %s bins/sec)",
                  tot_time,
                  int(round(tot_reads / tot_time, 0)),
@@ -48,9 +78,9 @@ def interval_coverages(bed_fname, bam_fname, by_count, min_mapq):
                  len(read_counts),
                  tot_reads,
                  (tot_reads / len(read_counts)),
-                 min(read_counts),
-                 max(read_counts))
-    tot_mapped_reads = bam_total_reads(bam_fname)
+                 read_counts.min(),
+                 read_counts.max())
+    tot_mapped_reads, tot_unmapped_reads = bam_read_counts(bam_fname)
     if tot_mapped_reads:
         logging.info("Percent reads in regions: %.3f (of %d mapped)",
                      100. * tot_reads / tot_mapped_reads,
@@ -58,22 +88,222 @@ def interval_coverages(bed_fname, bam_fname, by_count, min_mapq):
     else:
         logging.info("(Couldn't calculate total number of mapped reads)")
 
-    return CNA.from_rows(list(cna_rows),
-                         meta_dict={'sample_id': fbase(bam_fname)})
+    depths = table["depth"].values
+    log2_depths = np.repeat(NULL_LOG2_COVERAGE, len(depths))
+    covered = (depths > 0)
+    log2_depths[covered] = np.log2(depths[covered])
+    return CNA.from_columns({"chromosome": table["chromosome"].values,
+                             "start": table["start"].values,
+                             "end": table["end"].values,
+                             "gene": table["gene"].values,
+                             "log2": log2_depths},
+                            meta_dict={'sample_id': fbase(bam_fname),
+                                       'mapped_reads': tot_mapped_reads,
+                                       'unmapped_reads': tot_unmapped_reads})
+
+
+def interval_coverages_sharded(ic_func, bed_fname, bam_fname, ic_args,
+                               processes):
+    """Run a coverage function on shards of the regions in parallel.
+
+    The regions are split into contiguous chunks of roughly equal total span,
+    one per process. Each chunk is processed separately, with its own handle on
+    the BAM file, and the resulting tables are concatenated in the original
+    order.
+    """
+    if processes < 1:
+        processes = multiprocessing.cpu_count()
+    shards = split_regions(RA.read(bed_fname), processes)
+    if len(shards) < 2:
+        return ic_func(bed_fname, bam_fname, *ic_args)
+
+    logging.info("Splitting %s into %d shards", bed_fname, len(shards))
+    tmpdir = tempfile.mkdtemp(prefix='cnvkit-coverage-')
+    try:
+        pool = parallel.pick_pool(processes)
+        jobs = []
+        for i, shard in enumerate(shards):
+            shard_fname = os.path.join(tmpdir, "shard%d.bed" % i)
+            shard.write(shard_fname, "bed4", verbose=False)
+            jobs.append(pool.apply_async(ic_func,
+                                         (shard_fname, bam_fname) + ic_args))
+        pool.close()
+        pool.join()
+        table = pd.concat([job.get() for job in jobs], ignore_index=True)
+    finally:
+        shutil.rmtree(tmpdir)
+    return table
+
+
+def split_regions(regions, nshards):
+    """Split regions into contiguous chunks of roughly equal total span.
+
+    Returns a list of at most `nshards` non-empty region arrays, in order.
+    """
+    spans = np.cumsum(np.asarray(regions.end - regions.start))
+    if not len(spans) or nshards < 2:
+        return [regions] if len(spans) else []
+    cuts = np.searchsorted(spans, spans[-1] * np.arange(1, nshards) / nshards,
+                           side='right')
+    bounds = np.unique(np.r_[0, cuts, len(spans)])
+    return [regions[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def interval_coverages_multi(bed_fnames, bam_fname, by_count, min_mapq,
+                             processes=1, subsample=None, fasta=None):
+    """Calculate log2 coverages in the intervals of several BED files at once.
+
+    The regions of all the given BED files (e.g. targets and antitargets) are
+    combined and sorted, so the BAM file is scanned only once. The results are
+    then split back into one CopyNumArray per BED file, each in the same order
+    as the original file's regions.
+    """
+    if len(bed_fnames) == 1:
+        return [interval_coverages(bed_fnames[0], bam_fname, by_count,
+                                   min_mapq, processes, subsample, fasta)]
+
+    # Tag each region with its source file and original position
+    tables = []
+    for i, bed_fname in enumerate(bed_fnames):
+        regions = RA.read(bed_fname)
+        table = regions.data.loc[:, ["chromosome", "start", "end"]]
+        table["name"] = (regions.data["name"] if "name" in regions
+                         else "-")
+        table["source"] = i
+        table["order"] = np.arange(len(table))
+        tables.append(table)
+    combined = RA(pd.concat(tables))
+    combined.sort()
+
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.bed') as tmp:
+        combined.write(tmp, "bed4", verbose=False)
+        tmp.flush()
+        cnarr = interval_coverages(tmp.name, bam_fname, by_count, min_mapq,
+                                   processes, subsample, fasta)
+
+    # Rows of the output correspond to rows of the combined, sorted regions
+    sources = np.asarray(combined["source"])
+    orders = np.asarray(combined["order"])
+    results = []
+    for i in range(len(bed_fnames)):
+        idx = np.flatnonzero(sources == i)
+        idx = idx[np.argsort(orders[idx], kind='mergesort')]
+        results.append(cnarr.as_dataframe(cnarr.data.take(idx)))
+    return results
+
 
+def interval_coverages_count(bed_fname, bam_fname, min_mapq, subsample=None,
+                             fasta=None):
+    """Calculate read counts and depths in the BAM file at each interval.
 
-def interval_coverages_count(bed_fname, bam_fname, min_mapq):
-    """Calculate log2 coverages in the BAM file at each interval."""
-    bamfile = pysam.Samfile(bam_fname, 'rb')
+    If `subsample` is given, count only that fraction of reads, then scale the
+    counts up accordingly.
+
+    Returns a table of the regions (chromosome, start, end, gene) with each
+    region's read count and estimated mean read depth.
+    """
+    bamfile = ngfrills.open_alignment(bam_fname, fasta)
+    tables = []
     for chrom, subregions in RA.read(bed_fname).by_chromosome():
         logging.info("Processing chromosome %s of %s",
                      chrom, os.path.basename(bam_fname))
-        for _chrom, start, end, name, in subregions.coords(["name"]):
-            count, depth = region_depth_count(bamfile, chrom, start, end,
-                                              min_mapq)
-            yield [count,
-                   (chrom, start, end, name,
-                    math.log(depth, 2) if depth else NULL_LOG2_COVERAGE)]
+        starts = subregions.start.values
+        ends = subregions.end.values
+        counts = region_depth_counts(bamfile, chrom, starts, ends, min_mapq,
+                                     subsample)
+        if subsample:
+            counts = counts / subsample
+        # Scale read counts to region length
+        # Depth := #Bases / Span
+        spans = ends - starts
+        tables.append(pd.DataFrame({
+            "chromosome": subregions.chromosome.values,
+            "start": starts,
+            "end": ends,
+            "gene": (subregions["name"].values if "name" in subregions
+                     else "-"),
+            "count": counts,
+            "depth": np.where(spans > 0,
+                              READ_LEN * counts / np.maximum(spans, 1), 0.),
+        }))
+    return pd.concat(tables, ignore_index=True)
+
+
+# Reads with any of these flags set are not counted:
+# unmapped, secondary, QC failure, PCR/optical duplicate
+SKIP_READ_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+# Nearby regions are counted together from one fetch of the reads
+FETCH_WINDOW_SIZE = 1000000
+FETCH_WINDOW_GAP = 50000
+
+
+def region_depth_counts(bamfile, chrom, starts, ends, min_mapq,
+                        subsample=None):
+    """Count read midpoints in each of many regions on one chromosome.
+
+    Equivalent to `region_depth_count` on each region, but the reads in each
+    window of nearby regions are fetched only once. The reads are filtered with
+    vectorized masks, and their midpoints are assigned to regions by binary
+    search.
+
+    If `subsample` is given, only that fraction of reads is counted, selected
+    deterministically by a hash of the read name (so mates go together).
+
+    Returns an array of read counts, in the same order as the given regions.
+    """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    counts = np.zeros(len(starts), dtype=np.int64)
+    if not len(starts):
+        return counts
+    # Split the regions into windows, breaking at large gaps
+    order = np.argsort(starts, kind='mergesort')
+    sorted_starts = starts[order]
+    reach = np.maximum.accumulate(ends[order])
+    breaks = np.flatnonzero(
+        (sorted_starts[1:] - reach[:-1] > FETCH_WINDOW_GAP) |
+        (sorted_starts[1:] // FETCH_WINDOW_SIZE !=
+         sorted_starts[:-1] // FETCH_WINDOW_SIZE)) + 1
+    bounds = np.r_[0, breaks, len(order)]
+    for win_start, win_end in zip(bounds[:-1], bounds[1:]):
+        idx = order[win_start:win_end]
+        counts[idx] = _window_depth_counts(bamfile, chrom, starts[idx],
+                                           ends[idx], min_mapq, subsample)
+    # Empty regions never overlap any reads
+    counts[ends <= starts] = 0
+    return counts
+
+
+def _window_depth_counts(bamfile, chrom, starts, ends, min_mapq, subsample):
+    """Count read midpoints in each region, fetching the reads only once."""
+    reads = bamfile.fetch(reference=chrom, start=int(starts.min()),
+                          end=int(ends.max()))
+    if subsample:
+        max_hash = int(subsample * 2**32)
+        reads = (read for read in reads
+                 if zlib.crc32(read.qname.encode('ascii')) & 0xffffffff
+                 < max_hash)
+    reads = [(read.pos, read.rlen, read.aend or read.pos + 1, read.flag,
+              read.mapq)
+             for read in reads]
+    if not reads:
+        return np.zeros(len(starts), dtype=np.int64)
+    pos, rlen, aend, flag, mapq = np.array(reads, dtype=np.int64).T
+    keep = ((flag & SKIP_READ_FLAGS) == 0) & (mapq >= min_mapq)
+    pos, aend = pos[keep], aend[keep]
+    midpoints = pos + .5 * rlen[keep]
+    # Count midpoints within each region, inclusive of both ends
+    sorted_mids = np.sort(midpoints)
+    counts = (sorted_mids.searchsorted(ends, 'right') -
+              sorted_mids.searchsorted(starts, 'left'))
+    # A read is only counted in regions it overlaps. That's true whenever the
+    # midpoint lies within the aligned span; handle the rare exceptions (e.g.
+    # heavily soft-clipped reads) individually.
+    odd = (midpoints <= pos) | (midpoints >= aend)
+    for mid, rpos, rend in zip(midpoints[odd], pos[odd], aend[odd]):
+        counts -= ((starts <= mid) & (mid <= ends) &
+                   ~((rpos < ends) & (rend > starts)))
+    return counts
 
 
 def region_depth_count(bamfile, chrom, start, end, min_mapq):
@@ -103,69 +333,128 @@ def region_depth_count(bamfile, chrom, start, end, min_mapq):
     return count, depth
 
 
-def interval_coverages_pileup(bed_fname, bam_fname, min_mapq):
-    """Calculate log2 coverages in the BAM file at each interval."""
+def interval_coverages_pileup(bed_fname, bam_fname, min_mapq, fasta=None):
+    """Calculate read counts and depths in the BAM file at each interval.
+
+    Returns a table of the regions (chromosome, start, end, gene) with each
+    region's estimated read count and mean pileup depth.
+    """
     logging.info("Processing reads in %s", os.path.basename(bam_fname))
-    for chrom, start, end, name, count, depth in bedcov(bed_fname, bam_fname,
-                                                        min_mapq):
-        yield [count,
-               (chrom, start, end, name,
-                math.log(depth, 2) if depth else NULL_LOG2_COVERAGE)]
+    table = bedcov(bed_fname, bam_fname, min_mapq, fasta)
+    # User-supplied bins might be oddly constructed
+    spans = (table["end"] - table["start"]).values
+    basecounts = table.pop("basecount").values
+    ok_span = (spans > 0)
+    # Algebra from above
+    table["count"] = np.where(ok_span, basecounts / READ_LEN, 0.)
+    table["depth"] = np.where(ok_span, basecounts / np.maximum(spans, 1), 0.)
+    return table
 
 
-def bedcov(bed_fname, bam_fname, min_mapq):
+def bedcov(bed_fname, bam_fname, min_mapq, fasta=None):
     """Calculate depth of all regions in a BED file via samtools (pysam) bedcov.
 
     i.e. mean pileup depth across each region.
+
+    Returns a table of the regions (chromosome, start, end, gene) and the total
+    number of aligned bases in each ("basecount").
     """
     # Count bases in each region; exclude low-MAPQ reads
     if min_mapq > 0:
         bedcov_args = ['-Q', str(min_mapq)]
     else:
         bedcov_args = []
+    if fasta:
+        # For CRAM
+        bedcov_args.extend(['--reference', fasta])
     try:
-        lines = pysam.bedcov(bed_fname, bam_fname, *bedcov_args)
+        text = pysam.bedcov(bed_fname, bam_fname, *bedcov_args)
     except pysam.SamtoolsError as exc:
         raise ValueError("Failed processing %r coverages in %r regions. PySAM error: %s"
                          % (bam_fname, bed_fname, exc))
-    if not lines:
+    if not isinstance(text, basestring):
+        # Older pysam returns a list of lines
+        text = ''.join(text)
+    if not text.strip():
         raise ValueError("BED file %r sequence IDs don't match any in BAM file %r"
                          % (bed_fname, bam_fname))
-    # Return an iterable...
-    if isinstance(lines, basestring):
-        lines = lines.splitlines()
-    for line in lines:
-        fields = line.split('\t')
-        if len(fields) == 5:
-            chrom, start_s, end_s, name, basecount_s = fields
-        elif len(fields) == 4:
-            chrom, start_s, end_s, basecount_s = fields
-            name = "-"
-        else:
-            raise RuntimeError("Bad line from bedcov:\n" + line)
-        start, end, basecount = map(int, (start_s, end_s, basecount_s.strip()))
-        span = end - start
-        if span > 0:
-            # Algebra from above
-            count = basecount / READ_LEN
-            mean_depth = basecount / span
-        else:
-            # User-supplied bins might be oddly constructed
-            count = mean_depth = 0
-        yield chrom, start, end, name, count, mean_depth
+    return parse_bedcov(text)
 
 
-def bam_total_reads(bam_fname):
-    """Count the total number of mapped reads in a BAM file.
+def parse_bedcov(text):
+    """Parse the text output of bedcov into a table, all at once.
 
-    Uses the BAM index to do this quickly.
+    The regions may or may not have names (in the 'gene' column); the last
+    column is the number of aligned bases in each region ('basecount').
+    """
+    first_line = text[:text.find('\n')] if '\n' in text else text
+    ncols = first_line.count('\t') + 1
+    if ncols == 5:
+        colnames = ["chromosome", "start", "end", "gene", "basecount"]
+    elif ncols == 4:
+        colnames = ["chromosome", "start", "end", "basecount"]
+    else:
+        raise RuntimeError("Bad line from bedcov:\n" + first_line)
+    try:
+        table = pd.read_table(StringIO(text), header=None, names=colnames,
+                              na_filter=False,
+                              dtype={"chromosome": str, "gene": str,
+                                     "start": np.int64, "end": np.int64,
+                                     "basecount": np.int64})
+    except ValueError as exc:
+        # Including pandas' parser errors
+        raise RuntimeError("Bad output from bedcov:\n%s" % exc)
+    if ncols == 4:
+        table.insert(3, "gene", "-")
+    return table
+
+
+# Read counts from each BAM file's index, for the life of the process
+_INDEX_READ_COUNTS = {}
+
+def bam_read_counts(bam_fname):
+    """Count the mapped and unmapped reads in a BAM file.
+
+    Reads the totals stored in the BAM index (.bai or .csi) through pysam, so
+    this is quick. (CRAM indexes don't have these totals, so the CRAM file is
+    scanned with samtools idxstats instead.) The result is cached for each
+    version of the file.
+
+    Returns a tuple of (mapped, unmapped) read counts.
     """
+    bam_stat = os.stat(bam_fname)
+    key = (os.path.abspath(bam_fname), bam_stat.st_size, bam_stat.st_mtime)
+    if key not in _INDEX_READ_COUNTS:
+        if ngfrills.is_cram(bam_fname):
+            counts = _idxstats_read_counts(bam_fname)
+        else:
+            bamfile = ngfrills.open_alignment(bam_fname)
+            # Unmapped reads without a position aren't in the per-contig stats
+            stats = bamfile.get_index_statistics()
+            counts = (sum(stat.mapped for stat in stats),
+                      sum(stat.unmapped for stat in stats)
+                      + bamfile.nocoordinate)
+            bamfile.close()
+        _INDEX_READ_COUNTS[key] = counts
+    return _INDEX_READ_COUNTS[key]
+
+
+def _idxstats_read_counts(bam_fname):
+    """Count mapped and unmapped reads with samtools idxstats."""
     lines = pysam.idxstats(bam_fname)
     if isinstance(lines, basestring):
         lines = lines.splitlines()
-    tot_mapped_reads = 0
+    tot_mapped_reads = tot_unmapped_reads = 0
     for line in lines:
-        _seqname, _seqlen, nmapped, _nunmapped = line.split()
+        _seqname, _seqlen, nmapped, nunmapped = line.split()
         tot_mapped_reads += int(nmapped)
-    return tot_mapped_reads
+        tot_unmapped_reads += int(nunmapped)
+    return tot_mapped_reads, tot_unmapped_reads
+
+
+def bam_total_reads(bam_fname):
+    """Count the total number of mapped reads in a BAM file.
 
+    Uses the BAM index to do this quickly.
+    """
+    return bam_read_counts(bam_fname)[0]
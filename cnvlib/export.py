@@ -8,7 +8,7 @@ import numpy as np
 import pandas as pd
 from Bio._py3k import map, range, zip
 
-from . import call, core, params
+from . import call, core, metrics, params
 from .cnary import CopyNumArray as CNA
 from .vary import VariantArray as VA
 
@@ -21,21 +21,16 @@ def merge_samples(filenames):
     Output:
         list-of-tuples: (probe, log2 coverages...)
     """
-    def label_with_gene(cnarr):
-        row2label = lambda row: "{}:{}-{}:{}".format(
-            row.chromosome, row.start, row.end, row.gene)
-        return cnarr.data.apply(row2label, axis=1)
-
     if not filenames:
         return []
     first_cnarr = CNA.read(filenames[0])
     out_table = first_cnarr.data.loc[:, ["chromosome", "start", "end", "gene"]]
-    out_table["label"] = label_with_gene(first_cnarr)
+    out_table["label"] = first_cnarr.labels('gene')
     out_table[first_cnarr.sample_id] = first_cnarr["log2"]
     for fname in filenames[1:]:
         cnarr = CNA.read(fname)
         # Verify labels match
-        labels = label_with_gene(cnarr)
+        labels = cnarr.labels('gene')
         if not (labels == out_table["label"]).all():
             raise ValueError("Mismatched row coordinates in %s" % fname)
         # Copy the next column by sample ID
@@ -113,7 +108,7 @@ def export_nexus_ogt(sample_fname, vcf_fname):
     cnarr = CNA.read(sample_fname)
     varr = VA.read_vcf(vcf_fname, skip_hom=True, skip_somatic=True)
     bafs = cnarr.match_to_bins(varr, 'alt_freq', np.nan,
-                               summary_func=mirrored_baf_median)
+                               grouped_func=grouped_mirrored_baf_median)
     logging.info("Placed %d variants into %d bins",
                  sum(~np.isnan(bafs)), len(cnarr))
     out_table = cnarr.data.loc[:, ['chromosome', 'start', 'end', 'log2']]
@@ -135,6 +130,13 @@ def mirrored_baf_median(vals):
         return .5 - shift
 
 
+def grouped_mirrored_baf_median(vals, groups, ngroups):
+    """Same as `mirrored_baf_median`, for each group of values at once."""
+    shifts = metrics.grouped_median(np.abs(vals - .5), groups, ngroups)
+    return np.where(metrics.grouped_median(vals, groups, ngroups) > .5,
+                    .5 + shifts, .5 - shifts)
+
+
 def export_seg(sample_fnames):
     """SEG format for copy number segments.
 
@@ -372,25 +374,31 @@ def export_theta(tumor, reference):
     # Convert chromosome names to 1-based integer indices
     prev_chrom = None
     chrom_id = 0
-    for seg, subcnarr in ref_cnarr.by_ranges(tumor_segs):
+    # Mean reference log2 value & number of reference bins in each segment
+    seg_idx, bin_idx = ref_cnarr.ranges_idx(tumor_segs)
+    ref_means = metrics.grouped_mean(ref_cnarr['log2'].values[bin_idx],
+                                     seg_idx, len(tumor_segs))
+    ref_nbins = metrics.grouped_count(seg_idx, len(tumor_segs))
+    for seg, ref_mean, nbins in zip(tumor_segs, ref_means, ref_nbins):
         if seg.chromosome != prev_chrom:
             chrom_id += 1
             prev_chrom = seg.chromosome
-        fields = format_theta_row(seg, subcnarr, chrom_id, log2ratio_to_count)
+        fields = format_theta_row(seg, ref_mean, nbins, chrom_id,
+                                  log2ratio_to_count)
         outrows.append(fields)
 
     return outheader, outrows
 
 
-def format_theta_row(seg, cnarr, chrom_id, log2_to_count):
+def format_theta_row(seg, ref_log2, ref_nbins, chrom_id, log2_to_count):
     """Convert a segment's info to a row of THetA input.
 
     For the normal/reference bin count, take the mean of the bin values within
-    each segment so that segments match between tumor and normal.
+    each segment (`ref_log2`) so that segments match between tumor and normal.
     """
-    nbins = seg.probes if "probes" in seg else len(cnarr)
+    nbins = seg.probes if "probes" in seg else ref_nbins
     tumor_count = log2_to_count(seg.log2, nbins)
-    ref_count = log2_to_count(cnarr.log2.mean(), nbins)
+    ref_count = log2_to_count(ref_log2, nbins)
     # e.g. "start_1_93709:end_1_19208166"
     row_id = ("start_%d_%d:end_%d_%d"
               % (chrom_id, seg.start, chrom_id, seg.end))
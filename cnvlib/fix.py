@@ -55,7 +55,7 @@ def load_adjust_coverages(pset, ref_pset, skip_low,
 
     # Normalize coverages according to the reference
     # (Subtract the reference log2 copy number to get the log2 ratio)
-    pset.data['log2'] -= ref_matched['log2']
+    pset['log2'] = pset['log2'] - ref_matched['log2']
     pset.center_all(skip_low=skip_low)
     return apply_weights(pset, ref_matched)
 
@@ -102,7 +102,8 @@ def center_by_window(cnarr, fraction, sort_key):
     # (to avoid re-centering actual CNV regions -- only want an independently
     # sampled subset of presumably overall-CN-neutral probes)
     df = cnarr.data.reset_index(drop=True)
-    shuffle_order = np.random.permutation(df.index)
+    # Same shuffle each time, for reproducible results (e.g. in subprocesses)
+    shuffle_order = np.random.RandomState(0xA5EED).permutation(df.index)
     df = df.reindex(shuffle_order)
     # Apply the same shuffling to the key array as to the target probe set
     assert isinstance(sort_key, (np.ndarray, pd.Series))
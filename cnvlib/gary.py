@@ -1,14 +1,17 @@
 """A generic array of genomic positions."""
 from __future__ import print_function, absolute_import, division
 
+import collections
 import logging
+import numbers
 import sys
 import warnings
+import weakref
 
 import numpy as np
 import pandas as pd
 
-from . import core, ngfrills
+from . import core, metrics, ngfrills, npz, tabindex
 
 
 class GenomicArray(object):
@@ -38,6 +41,62 @@ class GenomicArray(object):
                      if meta_dict is not None and len(meta_dict)
                      else {})
 
+    @property
+    def data(self):
+        """The wrapped data table (pandas DataFrame).
+
+        Since the caller may modify it, a table shared with another array is
+        copied first (see `_own_data`).
+        """
+        self._own_data()
+        return self._data
+
+    @data.setter
+    def data(self, table):
+        """Replace the data table, which then belongs to this array."""
+        self._data = table
+        self._leave_sharing()
+        self._chrom_index = None
+        self._intervals = None
+
+    @property
+    def _shared(self):
+        """Whether another (live) array may refer to this array's data."""
+        return self._sharing is not None and len(self._sharing) > 1
+
+    def _share_data(self, other):
+        """Note that `other` wraps (part of) this array's data table."""
+        if self._sharing is None:
+            self._sharing = weakref.WeakSet([self])
+        self._sharing.add(other)
+        other._sharing = self._sharing
+
+    def _leave_sharing(self):
+        sharing = getattr(self, '_sharing', None)
+        if sharing is not None:
+            sharing.discard(self)
+        self._sharing = None
+
+    def _own_data(self):
+        """Copy the data table first if it's shared with another array.
+
+        Arrays created with `as_dataframe` (e.g. slices) wrap the given table
+        without copying it; the source array and these views then share data,
+        for as long as more than one of them is alive. Before the data can be
+        modified through any of them, that array gets its own copy
+        (copy-on-write), so the others are unaffected. Until then, their
+        columns are read-only (see `__getitem__`).
+        """
+        if self._shared:
+            self._data = self._data.copy()
+            self._leave_sharing()
+
+    def __getstate__(self):
+        # The data is independent after pickling, e.g. to another process
+        state = self.__dict__.copy()
+        state['_sharing'] = None
+        return state
+
     @staticmethod
     def row2label(row):
         return "{}:{}-{}".format(row.chromosome, row.start, row.end)
@@ -69,37 +128,54 @@ class GenomicArray(object):
     def as_columns(self, **columns):
         """Wrap the named columns in this instance's metadata."""
         return self.__class__.from_columns(columns, self.meta)
-        # return self.__class__(self.data.loc[:, columns], self.meta.copy())
+        # return self.__class__(self._data.loc[:, columns], self.meta.copy())
 
     def as_dataframe(self, dframe):
-        """Wrap the given pandas dataframe in this instance's metadata."""
-        return self.__class__(dframe.reset_index(drop=True), self.meta.copy())
+        """Wrap the given pandas dataframe in this instance's metadata.
+
+        The dataframe's rows are renumbered, but the data is not copied until
+        it's modified through the new array (see `_own_data`).
+        """
+        return self._wrap(dframe, shared=True)
+
+    def _wrap(self, dframe, shared):
+        """Wrap a dataframe, noting whether its data may be used elsewhere.
+
+        Only pass ``shared=False`` for a table that nothing else refers to,
+        e.g. the result of `take` or boolean indexing.
+        """
+        table = dframe.copy(deep=False)
+        table.index = np.arange(len(table))
+        result = self.__class__(table, self.meta.copy())
+        if shared:
+            self._share_data(result)
+        return result
 
     # def as_index(self, index):
     #     """Subset with fancy/boolean indexing; reuse this instance's metadata."""
     #     """Extract rows by indices, reusing this instance's metadata."""
     #     if isinstance(index, (int, slice)):
-    #         return self.__class__(self.data.iloc[index], self.meta.copy())
+    #         return self.__class__(self._data.iloc[index], self.meta.copy())
     #     else:
-    #         return self.__class__(self.data[index], self.meta.copy())
+    #         return self.__class__(self._data[index], self.meta.copy())
 
     def as_rows(self, rows):
         """Wrap the given rows in this instance's metadata."""
         return self.from_rows(rows,
-                              columns=self.data.columns,
+                              columns=self._data.columns,
                               meta_dict=self.meta)
 
     # Container behaviour
 
     def __eq__(self, other):
         return (isinstance(other, self.__class__) and
-                self.data.equals(other.data))
+                self._data.equals(other._data))
 
     def __len__(self):
-        return len(self.data)
+        return len(self._data)
 
     def __contains__(self, key):
-        return key in self.data.columns
+        return key in self._data.columns
 
     def __getitem__(self, index):
         """Access a portion of the data.
@@ -107,73 +183,90 @@ class GenomicArray(object):
         Cases:
 
         - single integer: a row, as pd.Series
-        - string row name: a column, as pd.Series
+        - string row name: a column, as pd.Series -- read-only if the data is
+          shared with another array; assign to the column instead
         - a boolean array: masked rows, as_dataframe
         - tuple of integers: selected rows, as_dataframe
         """
         if isinstance(index, int):
             # A single row
-            return self.data.iloc[index]
-            # return self.as_dataframe(self.data.iloc[index:index+1])
+            return self._data.iloc[index]
+            # return self.as_dataframe(self._data.iloc[index:index+1])
         elif isinstance(index, basestring):
             # A column, by name
-            return self.data[index]
+            column = self._data[index]
+            if self._shared:
+                column = _read_only(column)
+            return column
         elif (isinstance(index, tuple) and
               len(index) == 2 and
-              index[1] in self.data.columns):
+              index[1] in self._data.columns):
             # Row index, column index -> cell value
-            return self.data.loc[index]
+            return self._data.loc[index]
         elif isinstance(index, slice):
-            # return self.as_dataframe(self.data.take(index))
-            return self.as_dataframe(self.data[index])
+            # A view of the rows, not a copy
+            return self.as_dataframe(self._data[index])
         else:
             # Iterable -- selected row indices or boolean array, probably
             try:
                 if isinstance(index, type(None)) or len(index) == 0:
-                    empty = pd.DataFrame(columns=self.data.columns)
+                    empty = pd.DataFrame(columns=self._data.columns)
                     return self.as_dataframe(empty)
             except TypeError:
                 raise TypeError("object of type %r " % type(index) +
                                 "cannot be used as an index into a " +
                                 self.__class__.__name__)
-            return self.as_dataframe(self.data[index])
-            # return self.as_dataframe(self.data.take(index))
+            # Fancy/boolean indexing makes a new table
+            return self._wrap(self._data[index], shared=False)
 
     def __setitem__(self, index, value):
         """Assign to a portion of the data.
+
+        If the data is shared with another array, it's copied first -- except
+        to add a new column, which leaves the existing ones untouched.
         """
-        # self.data[index] = value
+        # self._data[index] = value
+        if not (isinstance(index, basestring) and index not in self._data):
+            self._own_data()
+        self._chrom_index = None
+        self._intervals = None
         if isinstance(index, int):
-            self.data.iloc[index] = value
+            self._data.iloc[index] = value
         elif isinstance(index, basestring):
-            self.data[index] = value
+            self._data[index] = value
         elif (isinstance(index, tuple) and
               len(index) == 2 and
-              index[1] in self.data.columns):
-            self.data.loc[index] = value
+              index[1] in self._data.columns):
+            self._data.loc[index] = value
         else:
             assert isinstance(index, slice) or len(index) > 0
-            self.data[index] = value
+            dtypes = self._data.dtypes
+            self._data[index] = value
+            # Assigning rows can upcast compact numeric columns; undo that
+            for col, dtype in zip(dtypes.index, dtypes):
+                if (dtype.kind in 'if' and col in self._data and
+                    self._data[col].dtype != dtype):
+                    self._data[col] = self._data[col].astype(dtype)
 
     def __delitem__(self, index):
         return NotImplemented
 
     def __iter__(self):
-        return self.data.itertuples(index=False)
+        return self._data.itertuples(index=False)
 
     __next__ = next
 
     @property
     def chromosome(self):
-        return self.data['chromosome']
+        return self['chromosome']
 
     @property
     def start(self):
-        return self.data['start']
+        return self['start']
 
     @property
     def end(self):
-        return self.data['end']
+        return self['end']
 
     @property
     def sample_id(self):
@@ -199,9 +292,44 @@ class GenomicArray(object):
         return self[is_auto]
 
     def by_chromosome(self):
-        """Iterate over bins grouped by chromosome name."""
-        for chrom, subtable in self.data.groupby("chromosome", sort=False):
-            yield chrom, self.as_dataframe(subtable)
+        """Iterate over bins grouped by chromosome name.
+
+        If each chromosome's bins are contiguous (e.g. the array is sorted), the
+        emitted arrays are views of this array's data, not copies, and should
+        be treated as read-only.
+        """
+        order, chrom_groups = self._chrom_groups()
+        for chrom, (start_row, end_row) in chrom_groups.items():
+            if order is None:
+                yield chrom, self._row_view(start_row, end_row)
+            else:
+                yield chrom, self._wrap(
+                    self._data.take(order[start_row:end_row]), shared=False)
+
+    def _chrom_slices(self):
+        """Map each chromosome name to its contiguous range of row indices.
+
+        The index is an ordered dict of {chromosome: (start_row, end_row)}, in
+        order of appearance. It's built on first use and kept until the data
+        table is replaced or modified through this object. If any chromosome's
+        rows are not contiguous, returns None.
+        """
+        if self._chrom_index is None:
+            codes, chroms = _factorize(self._data['chromosome'])
+            bounds = np.r_[0, np.flatnonzero(np.diff(codes)) + 1, len(codes)]
+            if not len(codes):
+                self._chrom_index = collections.OrderedDict()
+            elif len(bounds) - 1 == len(chroms):
+                self._chrom_index = collections.OrderedDict(
+                    zip(chroms, zip(bounds[:-1], bounds[1:])))
+            else:
+                # Unsorted
+                self._chrom_index = False
+        return self._chrom_index or None
+
+    def _row_view(self, start_row, end_row):
+        """Wrap a contiguous range of rows without copying the data."""
+        return self.as_dataframe(self._data.iloc[start_row:end_row])
 
     def by_ranges(self, other, mode='inner', keep_empty=True):
         """Group rows by another GenomicArray's bin coordinate ranges.
@@ -232,6 +360,129 @@ class GenomicArray(object):
                     for bin_row in bin_rows:
                         yield bin_row, self.as_rows([])
 
+    def ranges_idx(self, other, mode='inner'):
+        """Match this array's rows to another GenomicArray's bins, vectorized.
+
+        Same grouping as `by_ranges`, but without creating an array for each
+        bin. Returns two integer arrays of equal length, `bin_idx` and
+        `row_idx`, pairing each bin of `other` (by row position) with each row
+        of this array that `by_ranges` would emit for it. The pairs are ordered
+        by bin, then by row. `mode` is ``inner`` or ``outer``, as in
+        `by_ranges`; since only the row indices are returned, ``trim`` isn't
+        supported (select the rows with ``outer``, then alter their
+        coordinates).
+
+        Rows are found through this array's interval index (see
+        `overlaps_idx`), so they can overlap each other.
+
+        The results are ready for the grouped reductions in `metrics`, e.g.:
+
+        >>> bin_idx, row_idx = cnarr.ranges_idx(segarr)
+        >>> seg_medians = metrics.grouped_median(cnarr['log2'].values[row_idx],
+        ...                                      bin_idx, len(segarr))
+        """
+        _check_idx_mode(mode)
+        intervals = self._interval_index()
+        other_order, other_chroms = other._chrom_groups()
+        bin_chunks = []
+        row_chunks = []
+        for chrom, (bin_lo, bin_hi) in other_chroms.items():
+            if chrom not in intervals:
+                continue
+            bins = (np.arange(bin_lo, bin_hi) if other_order is None
+                    else other_order[bin_lo:bin_hi])
+            query_idx, row_idx = _query_overlaps(intervals[chrom],
+                                                 other.start.values[bins],
+                                                 other.end.values[bins], mode)
+            bin_chunks.append(bins[query_idx])
+            row_chunks.append(row_idx)
+        if not bin_chunks:
+            return np.array([], dtype=np.int_), np.array([], dtype=np.int_)
+        bin_idx = np.concatenate(bin_chunks)
+        row_idx = np.concatenate(row_chunks)
+        if other_order is not None:
+            order = np.argsort(bin_idx, kind='mergesort')
+            bin_idx = bin_idx[order]
+            row_idx = row_idx[order]
+        return bin_idx, row_idx
+
+    def overlaps_idx(self, chrom, starts, ends, mode='outer'):
+        """Find this array's rows overlapping each of many query regions.
+
+        The queries are all on chromosome `chrom`, or on all rows of this array
+        if `chrom` is None. Returns two integer arrays of equal length,
+        `query_idx` and `row_idx`, pairing each query region (by position) with
+        the rows it overlaps, ordered by query, then by row. With `mode`
+        ``inner``, only rows entirely within the query region are matched;
+        ``outer`` matches all overlapping rows. (``trim`` isn't supported, as
+        in `ranges_idx`.)
+        """
+        _check_idx_mode(mode)
+        intervals = self._interval_index(whole=(chrom is None))
+        if chrom not in intervals:
+            return np.array([], dtype=np.int_), np.array([], dtype=np.int_)
+        return _query_overlaps(intervals[chrom], np.asarray(starts),
+                               np.asarray(ends), mode)
+
+    def segment_ids(self, segments, mode='inner'):
+        """Get the index of the segment containing each of this array's rows.
+
+        Rows outside all of the segments get -1. If a row is in more than one
+        segment, i.e. overlaps a segment boundary in ``outer`` mode, it's
+        assigned to the first of them.
+        """
+        bin_idx, row_idx = self.ranges_idx(segments, mode)
+        ids = np.repeat(-1, len(self))
+        ids[row_idx[::-1]] = bin_idx[::-1]
+        return ids
+
+    def _chrom_groups(self):
+        """Group row positions by chromosome, for vectorized traversal.
+
+        Returns a tuple of (order, {chromosome: (lo, hi)}), where the rows of
+        each chromosome are at positions ``order[lo:hi]``, in their original
+        relative order. If the chromosomes' rows are already contiguous,
+        `order` is None and the positions are just ``lo`` through ``hi - 1``.
+        """
+        chrom_index = self._chrom_slices()
+        if chrom_index is not None:
+            return None, chrom_index
+        codes, chroms = _factorize(self._data['chromosome'])
+        order = np.argsort(codes, kind='mergesort')
+        bounds = codes[order].searchsorted(np.arange(len(chroms) + 1))
+        return order, collections.OrderedDict(
+            zip(chroms, zip(bounds[:-1], bounds[1:])))
+
+    def _interval_index(self, whole=False):
+        """Index the intervals on each chromosome for overlap queries.
+
+        For each chromosome, the rows are ordered by start position, with the
+        running maximum of their end positions. Rows overlapping a query region
+        are then within a range found by binary search on each of these, even
+        if the rows overlap each other.
+
+        Returns a dict of {chromosome: (rows, starts, ends, max_ends,
+        in_order)}. It's
+        built on first use and kept until the data table is modified, like
+        the chromosome index. With `whole`, instead index all rows together
+        (ignoring chromosome), under the key None.
+        """
+        if self._intervals is None:
+            self._intervals = {}
+        if whole:
+            if None not in self._intervals:
+                self._intervals[None] = _index_intervals(
+                    np.arange(len(self)), self.start.values, self.end.values)
+        elif not self._intervals or list(self._intervals) == [None]:
+            order, chrom_groups = self._chrom_groups()
+            starts = self.start.values
+            ends = self.end.values
+            for chrom, (lo, hi) in chrom_groups.items():
+                rows = (np.arange(lo, hi) if order is None else order[lo:hi])
+                self._intervals[chrom] = _index_intervals(rows, starts[rows],
+                                                          ends[rows])
+        return self._intervals
+
     def coords(self, also=()):
         """Iterate over plain coordinates of each bin: chromosome, start, end.
 
@@ -247,11 +498,21 @@ class GenomicArray(object):
                 cols.append(also)
             else:
                 cols.extend(also)
-        coordframe = self.data.loc[:, cols]
+        coordframe = self._data.loc[:, cols]
         return coordframe.itertuples(index=False)
 
-    def labels(self):
-        return self.data.apply(self.row2label, axis=1)
+    def labels(self, *extra_columns):
+        """Label each row with its coordinates, like `row2label`.
+
+        Any additional column names given are appended to each label,
+        separated by ':', e.g. "chr1:100-200:BRAF" for 'gene'.
+        """
+        labels = (self._data['chromosome'].astype(str) + ':' +
+                  self._data['start'].astype(str) + '-' +
+                  self._data['end'].astype(str))
+        for col in extra_columns:
+            labels = labels + ':' + self._data[col].astype(str)
+        return labels
 
     def in_range(self, chrom=None, start=None, end=None, mode='inner'):
         """Get the GenomicArray portion within the given genomic range.
@@ -261,9 +522,9 @@ class GenomicArray(object):
         endpoints to match the range boundaries, and ``inner`` excludes those
         bins.
         """
-        if isinstance(start, (int, float, np.float64)):
+        if isinstance(start, numbers.Number):
             start = [int(start)]
-        if isinstance(end, (int, float, np.float64)):
+        if isinstance(end, numbers.Number):
             end = [int(end)]
         results = self._iter_ranges(chrom, start, end, mode)
         return next(results)
@@ -281,78 +542,93 @@ class GenomicArray(object):
         assert mode in ('inner', 'outer', 'trim')
         if chrom:
             assert isinstance(chrom, basestring)  # ENH: accept array?
-            try:
-                table = self.data[self.data['chromosome'] == chrom]
-            except KeyError:
-                raise KeyError("Chromosome %s is not in this probe set" % chrom)
+            chrom_index = self._chrom_slices()
+            if chrom_index is None:
+                table = self._data[self._data['chromosome'] == chrom]
+            elif chrom in chrom_index:
+                table = self._data.iloc[slice(*chrom_index[chrom])]
+            else:
+                table = self._data.iloc[:0]
         else:
             # Unsafe, but faster if we've already subsetted by chromosome
-            table = self.data
+            table = self._data
 
         # Edge cases
         if not len(table):
             yield self.as_rows([])
-            raise StopIteration
+            return
 
         if starts is None and ends is None:
             yield self.as_dataframe(table)
-            raise StopIteration
+            return
 
         if starts is not None and len(starts):
-            if mode == 'inner':
-                # Only rows entirely after the start point
-                start_idxs = table.start.searchsorted(starts)
-            else:
-                # Include all rows overlapping the start point
-                start_idxs = table.end.searchsorted(starts, 'right')
+            query_starts = np.asarray(starts)
         else:
             starts = np.zeros(len(ends) if ends is not None else 1,
                               dtype=np.int_)
-            start_idxs = starts.copy()
-
+            query_starts = starts
         if ends is not None and len(ends):
-            if mode == 'inner':
-                end_idxs = table.end.searchsorted(ends, 'right')
-            else:
-                end_idxs = table.start.searchsorted(ends)
+            query_ends = np.asarray(ends)
         else:
-            end_idxs = np.repeat(len(table), len(starts))
+            # Through the end of the chromosome
+            query_ends = np.repeat(table.end.max() + 1, len(starts))
             ends = [None] * len(starts)
 
-        for start_idx, start_val, end_idx, end_val in zip(start_idxs, starts,
-                                                          end_idxs, ends):
-            subtable = table[start_idx:end_idx]
+        # Rows to trim are those straddling the boundaries, as in 'outer'
+        query_idx, row_idx = self.overlaps_idx(chrom or None, query_starts,
+                                               query_ends,
+                                               'outer' if mode == 'trim'
+                                               else mode)
+        bounds = query_idx.searchsorted(np.arange(len(starts) + 1))
+        for i, start_val, end_val in zip(range(len(starts)), starts, ends):
+            subtable = self._data.take(row_idx[bounds[i]:bounds[i+1]])
             if mode == 'trim':
-                subtable = subtable.copy()
                 # Update 5' endpoints to the boundary
                 if start_val:
                     subtable.start = subtable.start.clip_lower(start_val)
                 # Update 3' endpoints to the boundary
                 if end_val:
                     subtable.end = subtable.end.clip_upper(end_val)
-            yield self.as_dataframe(subtable)
+            yield self._wrap(subtable, shared=False)
 
     def match_to_bins(self, other, key, default=0.0, fill=False,
-                      summary_func=np.median):
+                      summary_func=np.median, grouped_func=None):
         """Take values of the other array at each of this array's bins.
 
         Assign `default` to indices that fall outside the other array's bins, or
         chromosomes that appear in `self` but not `other`.
 
+        Where several of the other array's rows overlap a bin, their values are
+        combined with `grouped_func`, a grouped reduction like those in
+        `metrics` (taking values, group labels and number of groups), or else
+        with `summary_func` -- by its grouped version, if `metrics` has one
+        (see `metrics.grouped_summary`).
+
         Return an array of the `key` column values in `other` corresponding to this
         array's bin locations, the same length as this array.
         """
-        def rows2value(rows):
-            if len(rows) == 0:
-                return default
-            elif len(rows) == 1:
-                return rows[0, key]
+        bin_idx, row_idx = other.ranges_idx(self, mode='outer')
+        values = np.asarray(other[key])[row_idx]
+        counts = metrics.grouped_count(bin_idx, len(self))
+        out_vals = np.repeat(default, len(self)).astype(np.float_)
+        multi = (counts > 1)
+        if multi.any():
+            in_multi = multi[bin_idx]
+            if grouped_func is not None:
+                summaries = grouped_func(values[in_multi], bin_idx[in_multi],
+                                         len(self))
             else:
-                return summary_func(rows[key])
-
-        all_out_vals = [rows2value(other_rows) for _bin, other_rows in
-                        other.by_ranges(self, mode='outer', keep_empty=True)]
-        return np.asarray(all_out_vals)
+                summaries = metrics.grouped_summary(summary_func,
+                                                    values[in_multi],
+                                                    bin_idx[in_multi],
+                                                    len(self))
+            out_vals[multi] = summaries[multi]
+        # Take single values as-is
+        single = (counts == 1)
+        single_pairs = single[bin_idx]
+        out_vals[bin_idx[single_pairs]] = values[single_pairs]
+        return out_vals
 
     # Modification
 
@@ -364,9 +640,10 @@ class GenomicArray(object):
         if not isinstance(other, self.__class__):
             raise ValueError("Argument (type %s) is not a %s instance"
                              % (type(other), self.__class__))
-        if not len(other.data):
+        if not len(other._data):
             return self.copy()
-        self.data = pd.concat([self.data, other.data])
+        self.data = _match_compact_dtypes(pd.concat([self._data, other._data]),
+                                          self._data)
         self.sort()
 
     def concat(self, others):
@@ -374,25 +651,36 @@ class GenomicArray(object):
 
         This array's data table is not implicitly included in the result.
         """
-        result = self.as_dataframe(pd.concat([otr.data for otr in others]))
+        others = list(others)
+        table = pd.concat([otr._data for otr in others])
+        if others:
+            table = _match_compact_dtypes(table, others[0]._data)
+        # The concatenated table is always a new copy
+        result = self._wrap(table, shared=False)
         result.sort()
         return result
 
     def copy(self):
         """Create an independent copy of this object."""
-        return self.as_dataframe(self.data.copy())
+        return self._wrap(self._data.copy(), shared=False)
 
     def add_columns(self, **columns):
-        """Create a new CNA, adding the specified extra columns to this CNA."""
-        # return self.as_dataframe(self.data.assign(**columns))
-        result = self.copy()
+        """Create a new CNA, adding the specified extra columns to this CNA.
+
+        The existing columns are shared with this CNA, not copied, unless any
+        of them are replaced.
+        """
+        result = self.as_dataframe(self._data)
         for key, values in columns.iteritems():
             result[key] = values
+        if _is_compact(self._data):
+            # Only changes the new columns' dtypes, so nothing is overwritten
+            compact_table(result._data)
         return result
 
     def keep_columns(self, columns):
         """Extract a subset of columns, reusing this instance's metadata."""
-        return self.__class__(self.data.loc[:, columns], self.meta.copy())
+        return self.__class__(self._data.loc[:, columns], self.meta.copy())
 
     def drop_extra_columns(self):
         """Remove any optional columns from this GenomicArray.
@@ -400,8 +688,8 @@ class GenomicArray(object):
         Returns a new copy with only the core columns retained:
             log2 value, chromosome, start, end, bin name.
         """
-        table = self.data.loc[:, self._required_columns]
-        return self.as_dataframe(table)
+        table = self._data.loc[:, self._required_columns]
+        return self._wrap(table, shared=False)
 
     def select(self, selector=None, **kwargs):
         """Take a subset of rows where the given condition is true.
@@ -410,10 +698,16 @@ class GenomicArray(object):
         will be used to select True rows, and/or keyword arguments like
         gene="Background" or chromosome="chr7", which will select rows where the
         keyed field equals the specified value.
+
+        The selector can also be a string expression over the columns, as for
+        `pandas.DataFrame.eval`, e.g. "log2 > 0 and gene != 'Background'". A
+        function is first applied to the whole table at once, as with
+        ``lambda t: t['log2'] > 0``; if that doesn't produce one bool per row,
+        it's applied to each row instead.
         """
-        table = self.data
+        table = self._data
         if selector is not None:
-            table = table[table.apply(selector, axis=1)]
+            table = table[_select_mask(table, selector)]
         for key, val in kwargs.items():
             assert key in self
             table = table[table[key] == val]
@@ -422,64 +716,329 @@ class GenomicArray(object):
     def shuffle(self):
         """Randomize the order of bins in this array (in-place)."""
         np.random.seed(0xA5EED)  # For reproducible results
-        order = np.arange(len(self.data))
+        order = np.arange(len(self._data))
         np.random.shuffle(order)
-        self.data = self.data.iloc[order]
+        self.data = self._data.iloc[order]
         return order
 
     def sort(self):
-        """Sort this array's bins in-place, with smart chromosome ordering."""
-        table = self.data.copy()
-        table['SORT_KEY'] = self.chromosome.apply(core.sorter_chrom)
-        table.sort_values(by=['SORT_KEY', 'start'], inplace=True)
-        del table['SORT_KEY']
-        self.data = table.reset_index(drop=True)
+        """Sort this array's bins in-place, with smart chromosome ordering.
+
+        Bins are ordered by chromosome (see `core.sorter_chrom`), then start
+        and end position. The sort is stable, and skipped if the bins are
+        already in order.
+        """
+        chrom_ranks = self._chrom_ranks()
+        starts = self._data['start'].values
+        ends = self._data['end'].values
+        if _is_sorted(chrom_ranks, starts, ends):
+            if not self._data.index.equals(pd.Index(np.arange(len(self)))):
+                self.data = self._data.reset_index(drop=True)
+            return
+        order = np.lexsort((ends, starts, chrom_ranks))
+        self.data = self._data.take(order).reset_index(drop=True)
+
+    def _chrom_ranks(self):
+        """Rank of each bin's chromosome in the sorted order of chromosomes.
+
+        The sort key is calculated once per distinct chromosome name. Names
+        with equal keys (e.g. "chr1" and "1") get the same rank.
+        """
+        codes, chroms = _factorize(self._data['chromosome'])
+        keys = [core.sorter_chrom(chrom) for chrom in chroms]
+        key_ranks = dict((key, rank)
+                         for rank, key in enumerate(sorted(set(keys))))
+        ranks = np.array([key_ranks[key] for key in keys], dtype=np.int64)
+        return ranks.take(codes) if len(ranks) else codes
 
     def sort_columns(self):
         """Sort this array's columns in-place, per class definition."""
         extra_cols = []
-        for col in self.data.columns:
+        for col in self._data.columns:
             if col not in self._required_columns:
                 extra_cols.append(col)
         sorted_colnames = list(self._required_columns) + sorted(extra_cols)
-        assert len(sorted_colnames) == len(self.data.columns)
-        self.data = self.data.reindex(columns=sorted_colnames)
+        assert len(sorted_colnames) == len(self._data.columns)
+        self.data = self._data.reindex(columns=sorted_colnames)
 
     # I/O
 
     @classmethod
-    def read(cls, infile, sample_id=None):
+    def read(cls, infile, sample_id=None, columns=None, region=None,
+             compact=False):
+        """Read a table from a file name or handle.
+
+        Either the tabular text format or the binary format (see `npz`) is
+        accepted; the binary format is detected automatically.
+
+        To load less of a large file, `columns` can list the columns to keep,
+        in addition to the required ones; any not in the file are ignored. A
+        `region`, either a chromosome name or a tuple of (chromosome, start,
+        end), selects the rows overlapping that region. If the file's
+        chromosomes are contiguous, only that chromosome's part of the file is
+        read -- directly in the binary format, or via a sidecar index (see
+        `tabindex`) for a text file.
+
+        With `compact`, the table is stored with smaller dtypes to save memory;
+        see `compact_table`.
+        """
         if sample_id is None:
             if isinstance(infile, basestring):
                 sample_id = core.fbase(infile)
             else:
                 sample_id = '<unknown>'
-        # Create a multi-index of genomic coordinates (like GRanges)
-        try:
-            table = pd.read_table(infile, na_filter=False,
-                                  dtype={'chromosome': 'string'},
-                                  # index_col=['chromosome', 'start']
-                                 )
-        except ValueError:
-            # File is blank/empty, most likely
-            logging.info("Blank file %s", infile)
-            table = cls._make_blank()
-        # XXX Pending pandas 0.17: https://github.com/pydata/pandas/issues/10505
-        # table['chromosome'] = pd.Categorical(table['chromosome'],
-        #                                      table.chromosome.drop_duplicates(),
-        #                                      ordered=True)
-        # table.set_index(['chromosome', 'start'], inplace=True)
-        return cls(table, {"sample_id": sample_id})
-
-    def write(self, outfile=None):
-        """Write the wrapped data table to a file or handle in tabular format.
-
-        The format is BED-like, but with a header row included and with
-        arbitrary extra columns.
+        if columns is not None:
+            columns = set(cls._required_columns).union(columns)
+        if region is None:
+            chrom = start = end = None
+        elif isinstance(region, basestring):
+            chrom, start, end = region, None, None
+        else:
+            chrom, start, end = region
+        # Chromosome still to be selected after reading, if any
+        region_chrom = chrom
+        table = meta = offsets = None
+        if isinstance(infile, basestring) and npz.is_npz(infile):
+            table, meta, offsets = npz.read(infile, columns, chrom)
+            if chrom is not None and offsets is not None:
+                chrom = None
+        elif isinstance(infile, basestring) and chrom is not None:
+            table = tabindex.read_chrom(infile, chrom, columns)
+            if table is not None:
+                chrom = None
+        if table is None:
+            usecols = None
+            if isinstance(infile, basestring) and columns is not None:
+                usecols = [col for col in tabindex.read_header(infile)
+                           if col in columns] or None
+            # Create a multi-index of genomic coordinates (like GRanges)
+            try:
+                table = pd.read_table(infile, na_filter=False,
+                                      usecols=usecols,
+                                      dtype={'chromosome': str},
+                                      # index_col=['chromosome', 'start']
+                                     )
+            except ValueError:
+                # File is blank/empty, most likely
+                logging.info("Blank file %s", infile)
+                table = cls._make_blank()
+            # XXX Pending pandas 0.17: https://github.com/pydata/pandas/issues/10505
+            # table['chromosome'] = pd.Categorical(table['chromosome'],
+            #                                      table.chromosome.drop_duplicates(),
+            #                                      ordered=True)
+            # table.set_index(['chromosome', 'start'], inplace=True)
+            if columns is not None and usecols is None:
+                table = table.loc[:, [col for col in table.columns
+                                      if col in columns]]
+        meta = meta or {}
+        meta["sample_id"] = sample_id
+        if compact:
+            table = compact_table(table)
+        ary = cls(table, meta)
+        log_memory(ary)
+        if offsets is not None:
+            # Already known; skip re-scanning the chromosome column
+            ary._chrom_index = collections.OrderedDict(
+                (chrom_name, (row_start, row_end))
+                for chrom_name, row_start, row_end in offsets
+                if row_end > row_start)
+        if chrom is not None or start is not None or end is not None:
+            # Rows weren't (fully) selected while reading
+            ary = ary.in_range(region_chrom, start, end, mode='outer')
+        return ary
+
+    def write(self, outfile=None, fmt='tab', index=False):
+        """Write the wrapped data table to a file or handle.
+
+        With `fmt` 'tab' (the default), the format is BED-like, but with a
+        header row included and with arbitrary extra columns. With 'npz', the
+        columns and metadata are stored in a binary format that loads faster;
+        see the `npz` module.
 
         To combine multiple samples in one file and/or convert to another
         format, see the 'export' subcommand.
+
+        With `index`, a text file written to a file name also gets a sidecar
+        index of its chromosomes' positions, for reading one region at a time;
+        see `tabindex`.
         """
-        with ngfrills.safe_write(outfile or sys.stdout) as handle:
-            self.data.to_csv(handle, index=False, sep='\t', float_format='%.6g')
+        if fmt == 'npz':
+            npz.write(outfile, self._data, self.meta)
+        elif fmt == 'tab':
+            with ngfrills.safe_write(outfile or sys.stdout) as handle:
+                self._data.to_csv(handle, index=False, sep='\t',
+                                 float_format='%.6g')
+            if index and isinstance(outfile, basestring):
+                tabindex.write_index(outfile)
+        else:
+            raise ValueError("Unknown output format: %r" % fmt)
+
+
+# Columns stored with compact dtypes, if present
+CATEGORY_COLUMNS = ('chromosome', 'gene')
+COORD_COLUMNS = ('start', 'end')
+FLOAT_COLUMNS = ('log2', 'depth', 'weight', 'spread', 'gc', 'rmask')
+
+
+def _check_idx_mode(mode):
+    """Reject `mode` values that don't apply to row indices (ranges_idx etc.)."""
+    if mode not in ('inner', 'outer'):
+        raise ValueError("Mode must be 'inner' or 'outer' to find row indices, "
+                         "not %r" % mode)
 
+
+def _select_mask(table, selector):
+    """Evaluate a `GenomicArray.select` selector as a boolean row mask."""
+    if isinstance(selector, basestring):
+        return np.asarray(table.eval(selector), dtype=np.bool_)
+    try:
+        mask = np.asarray(selector(table))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        # Only works row by row, e.g. uses `in` or `and`
+        mask = None
+    if mask is None or mask.dtype != np.bool_ or mask.shape != (len(table),):
+        mask = np.asarray(table.apply(selector, axis=1), dtype=np.bool_)
+    return mask
+
+
+def _read_only(column):
+    """View a column of a shared table so it can't be modified in-place.
+
+    Numeric and string columns keep their values' memory, but can't be written
+    to. Categorical columns are copied, since their codes are small.
+    """
+    if hasattr(column, 'cat'):
+        return column.copy()
+    values = column.values.view()
+    values.flags.writeable = False
+    return pd.Series(values, index=column.index, name=column.name)
+
+
+def _factorize(column):
+    """Integer codes and distinct values of a column, in order of appearance.
+
+    Like `pandas.factorize`, but a categorical column's values are taken from
+    its categories (some pandas versions give just the category codes).
+    """
+    if hasattr(column, 'cat'):
+        codes, uniques = pd.factorize(np.asarray(column.cat.codes))
+        return codes, np.asarray(column.cat.categories).take(uniques)
+    return pd.factorize(np.asarray(column))
+
+
+def compact_table(table):
+    """Convert a table's columns to smaller dtypes, in-place.
+
+    Chromosome and gene names become categoricals; coordinates become 32-bit
+    integers, if they fit; and the usual floating-point columns (log2, etc.)
+    become single-precision floats.
+    """
+    for col in CATEGORY_COLUMNS:
+        if (col in table and table[col].dtype.kind == 'O' and
+            not hasattr(table[col], 'cat')):
+            table[col] = table[col].astype('category')
+    for col in COORD_COLUMNS:
+        if col in table and table[col].dtype.kind == 'i' and (
+                not len(table) or
+                table[col].max() <= np.iinfo(np.int32).max):
+            table[col] = table[col].astype(np.int32)
+    for col in FLOAT_COLUMNS:
+        if col in table and table[col].dtype.kind == 'f':
+            table[col] = table[col].astype(np.float32)
+    return table
+
+
+def _is_compact(table):
+    """Check whether any of a table's columns have compact dtypes."""
+    return (any(hasattr(table[col], 'cat')
+                for col in CATEGORY_COLUMNS if col in table) or
+            any(table[col].dtype.itemsize == 4
+                for col in COORD_COLUMNS + FLOAT_COLUMNS if col in table))
+
+
+def _match_compact_dtypes(table, like):
+    """Restore compact dtypes from `like` that were lost in concatenation."""
+    for col in like.columns:
+        if col not in table:
+            continue
+        if hasattr(like[col], 'cat'):
+            if not hasattr(table[col], 'cat'):
+                table[col] = table[col].astype('category')
+        elif (like[col].dtype.itemsize == 4 and
+              table[col].dtype.kind == like[col].dtype.kind and
+              table[col].dtype != like[col].dtype):
+            if (like[col].dtype.kind == 'i' and len(table) and
+                table[col].max() > np.iinfo(like[col].dtype).max):
+                continue
+            table[col] = table[col].astype(like[col].dtype)
+    return table
+
+
+def log_memory(garr):
+    """Log the memory footprint of an array's data table, for debugging."""
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("%s %s: %d rows, %.1f MB", garr.__class__.__name__,
+                      garr.meta.get('sample_id'), len(garr),
+                      garr._data.memory_usage(index=True, deep=True).sum()
+                      / 1024**2)
+
+
+def _is_sorted(*keys):
+    """Check if rows are in lexicographic order of the key arrays, in O(n)."""
+    # Rows that are tied on all the keys so far
+    ties = np.ones(max(len(keys[0]) - 1, 0), dtype=np.bool_)
+    for key in keys:
+        steps = np.diff(key)
+        if (steps[ties] < 0).any():
+            return False
+        ties &= (steps == 0)
+    return True
+
+
+def _index_intervals(rows, starts, ends):
+    """Sort intervals by start position, tracking the running maximum end."""
+    order = np.argsort(starts, kind='mergesort')
+    rows = rows[order]
+    ends = ends[order]
+    in_order = not (np.diff(rows) < 0).any()
+    return (rows, starts[order], ends,
+            np.maximum.accumulate(ends) if len(ends) else ends, in_order)
+
+
+def _query_overlaps(intervals, query_starts, query_ends, mode):
+    """Find the indexed intervals overlapping each query region.
+
+    Each query's candidate intervals are a contiguous range in start order:
+    they start before the query ends, and follow every interval that ends
+    before the query starts. The candidates are then checked individually, so
+    this stays exact when intervals overlap or contain each other, though a
+    very long interval widens the candidate ranges after it.
+
+    Returns arrays (query_idx, row_idx), ordered by query, then by row.
+    """
+    rows, starts, ends, max_ends, in_order = intervals
+    if mode == 'inner':
+        # Rows entirely within the query region
+        lo = starts.searchsorted(query_starts)
+        hi = starts.searchsorted(query_ends, 'right')
+    else:
+        # All rows overlapping the query region
+        lo = max_ends.searchsorted(query_starts, 'right')
+        hi = starts.searchsorted(query_ends)
+    counts = np.maximum(hi - lo, 0)
+    query_idx = np.repeat(np.arange(len(counts)), counts)
+    # Concatenate the ranges of candidate positions
+    posns = (np.repeat(lo - np.cumsum(counts) + counts, counts) +
+             np.arange(counts.sum()))
+    if mode == 'inner':
+        keep = (ends[posns] <= query_ends[query_idx])
+    else:
+        keep = (ends[posns] > query_starts[query_idx])
+    query_idx = query_idx[keep]
+    row_idx = rows[posns[keep]]
+    if not in_order:
+        # Start order isn't the same as row order
+        order = np.lexsort((row_idx, query_idx))
+        query_idx = query_idx[order]
+        row_idx = row_idx[order]
+    return query_idx, row_idx
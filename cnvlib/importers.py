@@ -1,6 +1,7 @@
 """Import from other formats to the CNVkit format."""
 from __future__ import absolute_import, division, print_function
 
+import gzip
 import logging
 import math
 import os.path
@@ -11,6 +12,7 @@ import pandas as pd
 
 from . import core, params
 from .cnary import CopyNumArray as CNA
+from .rary import RegionArray as RA
 
 
 # __________________________________________________________________________
@@ -104,6 +106,120 @@ def unpipe_name(name):
     return new_name
 
 
+# __________________________________________________________________________
+# import-depth
+
+DEPTH_CHUNK_SIZE = 1000000
+
+def import_depth(depth_fname, bed_fnames, sample_id=None):
+    """Aggregate a precomputed read depth track onto bins.
+
+    The depth file is BED-like, optionally gzipped, with the mean read depth
+    of each interval in the last column -- e.g. a bedGraph, or the
+    per-base.bed.gz or regions.bed.gz output of mosdepth. Its intervals must be
+    sorted and non-overlapping within each chromosome. The file is read in
+    chunks, and each bin's total base count is accumulated from the
+    depth-weighted overlaps of the intervals in each chunk.
+
+    Return a list of CopyNumArrays, one for each BED file, in the same order.
+    These match what the 'coverage' command calculates from the BAM file,
+    given per-base depths with the same read filters.
+    """
+    if sample_id is None:
+        sample_id = core.fbase(depth_fname)
+    # Index the bins of all BED files by chromosome
+    regions = [RA.read(bed_fname) for bed_fname in bed_fnames]
+    bin_starts = np.concatenate([rarr.start.values for rarr in regions])
+    bin_ends = np.concatenate([rarr.end.values for rarr in regions])
+    bin_chroms = np.concatenate([rarr.chromosome.values for rarr in regions])
+    bins_by_chrom = dict((chrom, np.flatnonzero(bin_chroms == chrom))
+                         for chrom in pd.unique(bin_chroms))
+    basecounts = np.zeros(len(bin_starts))
+
+    skiprows, ncols = _depth_file_layout(depth_fname)
+    chunks = pd.read_table(depth_fname, header=None, skiprows=skiprows,
+                           usecols=[0, 1, 2, ncols - 1],
+                           names=["chromosome", "start", "end", "depth"],
+                           dtype={"chromosome": str}, na_filter=False,
+                           compression=('gzip' if depth_fname.endswith('.gz')
+                                        else None),
+                           chunksize=DEPTH_CHUNK_SIZE)
+    for chunk in chunks:
+        chroms = chunk["chromosome"].values
+        for chrom in pd.unique(chroms):
+            if chrom not in bins_by_chrom:
+                continue
+            in_chrom = (chroms == chrom)
+            idx = bins_by_chrom[chrom]
+            basecounts[idx] += depth_basecounts(
+                chunk["start"].values[in_chrom],
+                chunk["end"].values[in_chrom],
+                chunk["depth"].values[in_chrom],
+                bin_starts[idx], bin_ends[idx])
+
+    # Mean depth in each bin, as in coverage.interval_coverages
+    spans = bin_ends - bin_starts
+    depths = np.where(spans > 0, basecounts / np.maximum(spans, 1), 0.)
+    log2_depths = np.repeat(params.NULL_LOG2_COVERAGE, len(depths))
+    covered = (depths > 0)
+    log2_depths[covered] = np.log2(depths[covered])
+    if (~covered).sum() > TOO_MANY_NO_COVERAGE:
+        logging.warn("*WARNING* Sample %s has >%d bins with no coverage",
+                     sample_id, TOO_MANY_NO_COVERAGE)
+
+    cnarrs = []
+    offset = 0
+    for rarr in regions:
+        rows = slice(offset, offset + len(rarr))
+        offset += len(rarr)
+        cnarrs.append(CNA.from_columns(
+            {"chromosome": rarr.chromosome.values,
+             "start": rarr.start.values,
+             "end": rarr.end.values,
+             "gene": rarr["name"].values if "name" in rarr else "-",
+             "log2": log2_depths[rows]},
+            {"sample_id": sample_id}))
+    return cnarrs
+
+
+def depth_basecounts(starts, ends, depths, bin_starts, bin_ends):
+    """Sum the read depths over each bin's span, i.e. count aligned bases.
+
+    The depth intervals (`starts`, `ends`, `depths`) must not overlap each
+    other. The bins can be in any order.
+
+    The cumulative base count up to each bin edge is found by binary search
+    on the sorted interval starts, so each bin's count is the difference of
+    the cumulative counts at its end and start.
+    """
+    if (np.diff(starts) < 0).any():
+        order = np.argsort(starts, kind='mergesort')
+        starts, ends, depths = starts[order], ends[order], depths[order]
+    lengths = ends - starts
+    cum_bases = np.concatenate([[0], np.cumsum(lengths * depths)])
+
+    def bases_before(posn):
+        """Count the aligned bases upstream of each position."""
+        idx = starts.searchsorted(posn, 'right') - 1
+        at_idx = np.maximum(idx, 0)
+        partial = depths[at_idx] * np.clip(posn - starts[at_idx], 0,
+                                           lengths[at_idx])
+        return np.where(idx >= 0, cum_bases[at_idx] + partial, 0.)
+
+    return bases_before(bin_ends) - bases_before(bin_starts)
+
+
+def _depth_file_layout(fname):
+    """Count header lines (track, browser, #) and the columns of a depth file.
+    """
+    opener = gzip.open if fname.endswith('.gz') else open
+    with opener(fname, 'rb') as handle:
+        for skiprows, line in enumerate(handle):
+            if not line.startswith((b'track', b'browser', b'#')):
+                return skiprows, len(line.split(b'\t'))
+    raise ValueError("Depth file %s is empty" % fname)
+
+
 # __________________________________________________________________________
 # import-seg
 
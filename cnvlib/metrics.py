@@ -10,6 +10,7 @@ See:
 from __future__ import division
 
 import numpy as np
+import pandas as pd
 from scipy import stats
 
 
@@ -28,26 +29,32 @@ def ests_of_scale(deviations):
 
 # M-estimators of central location
 
-def biweight_location(a, initial=None, c=6.0, epsilon=1e-4):
+def biweight_location(a, initial=None, c=6.0, epsilon=1e-4, axis=None):
     """Compute the biweight location for an array.
 
     The biweight is a robust statistic for determining the central location of a
     distribution.
+
+    With `axis`, calculate the biweight location of each row or column of a 2-D
+    array at once.
     """
     a = np.asarray(a)
     if initial is None:
-        initial = np.median(a)
+        initial = np.median(a, axis=axis)
     # Weight the observations by distance from initial estimate
-    d = a - initial
-    w = d / max(c * median_absolute_deviation(a), epsilon)
+    d = a - _expand(initial, axis)
+    scale = np.maximum(c * median_absolute_deviation(a, axis=axis), epsilon)
+    w = d / _expand(scale, axis)
     w = (1 - w**2)**2
     # Omit the outlier points
-    mask = (w < 1)
-    weightsum = w[mask].sum()
-    if weightsum == 0:
-        # Insufficient variation to improve the initial estimate
-        return initial
-    return initial + (d[mask] * w[mask]).sum() / weightsum
+    w[~(w < 1)] = 0
+    weightsum = w.sum(axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # If weightsum is 0, there's insufficient variation to improve the
+        # initial estimate
+        result = np.where(weightsum == 0, initial,
+                          initial + (d * w).sum(axis=axis) / weightsum)
+    return result[()]
 
 
 def modal_location(arr):
@@ -78,29 +85,36 @@ def segment_mean(cnarr, skip_low=False):
 
 # Estimators of scale
 
-def biweight_midvariance(a, initial=None, c=9.0, epsilon=1e-4):
+def biweight_midvariance(a, initial=None, c=9.0, epsilon=1e-4, axis=None):
     """Compute the biweight midvariance for an array.
 
     The biweight midvariance is a robust statistic for determining the
     midvariance (i.e. the standard deviation) of a distribution.
 
+    With `axis`, calculate the midvariance of each row or column of a 2-D array
+    at once.
+
     See:
     https://en.wikipedia.org/wiki/Robust_measures_of_scale#The_biweight_midvariance
     https://astropy.readthedocs.org/en/latest/_modules/astropy/stats/funcs.html
     """
     a = np.asarray(a)
     if initial is None:
-        initial = np.median(a)
+        initial = np.median(a, axis=axis)
     # Difference of observations from initial estimate
-    d = a - initial
+    d = a - _expand(initial, axis)
     # Weighting (avoid dividing by zero)
-    w = d / max(c * median_absolute_deviation(a), epsilon)
+    scale = np.maximum(c * median_absolute_deviation(a, axis=axis), epsilon)
+    w = d / _expand(scale, axis)
     w = w**2
     # Omit the outlier points
     mask = np.abs(w) < 1
-    n = mask.sum()
-    return (n**0.5 * (d[mask] * d[mask] * (1 - w[mask])**4).sum()**0.5
-            / np.abs(((1 - w[mask]) * (1 - 5 * w[mask])).sum()))
+    n = mask.sum(axis=axis)
+    numer = np.where(mask, d * d * (1 - w)**4, 0).sum(axis=axis)
+    denom = np.where(mask, (1 - w) * (1 - 5 * w), 0).sum(axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = n**0.5 * numer**0.5 / np.abs(denom)
+    return result[()]
 
 
 def interquartile_range(a):
@@ -109,21 +123,30 @@ def interquartile_range(a):
     return np.percentile(a, 75) - np.percentile(a, 25)
 
 
-def median_absolute_deviation(a, scale_to_sd=True):
+def median_absolute_deviation(a, scale_to_sd=True, axis=None):
     """Compute the median absolute deviation (MAD) of array elements.
 
     The MAD is defined as: ``median(abs(a - median(a)))``.
 
+    With `axis`, calculate the MAD of each row or column of a 2-D array.
+
     See: https://en.wikipedia.org/wiki/Median_absolute_deviation
     """
     a = np.asarray(a)
-    a_median = np.median(a)
-    mad = np.median(np.abs(a - a_median))
+    a_median = np.median(a, axis=axis)
+    mad = np.median(np.abs(a - _expand(a_median, axis)), axis=axis)
     if scale_to_sd:
         mad *= 1.4826
     return mad
 
 
+def _expand(values, axis):
+    """Restore the axis reduced over, to broadcast `values` against the input."""
+    if axis is None:
+        return values
+    return np.expand_dims(values, axis)
+
+
 def q_n(a):
     """Rousseeuw & Croux's (1993) Q_n, an alternative to MAD.
 
@@ -198,3 +221,225 @@ def prediction_interval(bins, alpha):
     # ENH: weighted percentile
     return np.percentile(bins['log2'], [pct_lo, pct_hi])
 
+
+
+# Grouped reductions
+#
+# These calculate a statistic for many groups of values at once, e.g. the bins
+# within each segment. Each takes an array of values, a parallel array of
+# integer group labels from 0 to ngroups - 1 (see GenomicArray.ranges_idx),
+# and the number of groups, and returns an array of length `ngroups`.
+# Empty groups get NaN, or 0 for sums and counts.
+
+def grouped_count(groups, ngroups):
+    """Number of values in each group."""
+    return np.bincount(groups, minlength=ngroups)
+
+
+def grouped_sum(values, groups, ngroups):
+    """Sum of the values in each group."""
+    return np.bincount(groups, weights=values, minlength=ngroups)
+
+
+def grouped_mean(values, groups, ngroups, weights=None):
+    """Mean (or weighted average) of the values in each group."""
+    values = np.asarray(values, dtype=np.float_)
+    if weights is None:
+        totals = grouped_count(groups, ngroups)
+    else:
+        weights = np.asarray(weights, dtype=np.float_)
+        totals = grouped_sum(weights, groups, ngroups)
+        values = values * weights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return grouped_sum(values, groups, ngroups) / totals
+
+
+def grouped_std(values, groups, ngroups):
+    """Standard deviation of the values in each group."""
+    values = np.asarray(values, dtype=np.float_)
+    means = grouped_mean(values, groups, ngroups)
+    return np.sqrt(grouped_mean((values - means[groups])**2, groups, ngroups))
+
+
+def grouped_median(values, groups, ngroups):
+    """Median of the values in each group."""
+    values = np.asarray(values, dtype=np.float_)
+    groups = np.asarray(groups)
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    bounds = groups[order].searchsorted(np.arange(ngroups + 1))
+    sizes = np.diff(bounds)
+    result = np.repeat(np.nan, ngroups)
+    ok = (sizes > 0)
+    # Average the middle two values, or take the one middle value twice
+    lo_mid = bounds[:-1][ok] + (sizes[ok] - 1) // 2
+    hi_mid = bounds[:-1][ok] + sizes[ok] // 2
+    result[ok] = (sorted_values[lo_mid] + sorted_values[hi_mid]) / 2
+    return result
+
+
+def grouped_mad(values, groups, ngroups, scale_to_sd=True):
+    """Median absolute deviation (MAD) of the values in each group.
+
+    See `median_absolute_deviation`.
+    """
+    values = np.asarray(values, dtype=np.float_)
+    medians = grouped_median(values, groups, ngroups)
+    mads = grouped_median(np.abs(values - medians[groups]), groups, ngroups)
+    if scale_to_sd:
+        mads *= 1.4826
+    return mads
+
+
+def grouped_biweight_location(values, groups, ngroups, c=6.0, epsilon=1e-4):
+    """Biweight location of the values in each group.
+
+    See `biweight_location`.
+    """
+    values = np.asarray(values, dtype=np.float_)
+    groups = np.asarray(groups)
+    initial = grouped_median(values, groups, ngroups)
+    scale = np.maximum(c * grouped_mad(values, groups, ngroups), epsilon)
+    d = values - initial[groups]
+    w = (1 - (d / scale[groups])**2)**2
+    # Omit the outlier points
+    mask = (w < 1)
+    weightsum = grouped_sum(w[mask], groups[mask], ngroups)
+    shift = grouped_sum(d[mask] * w[mask], groups[mask], ngroups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(weightsum == 0, initial, initial + shift / weightsum)
+
+
+def grouped_biweight_midvariance(values, groups, ngroups, c=9.0,
+                                 epsilon=1e-4):
+    """Biweight midvariance of the values in each group.
+
+    See `biweight_midvariance`.
+    """
+    values = np.asarray(values, dtype=np.float_)
+    groups = np.asarray(groups)
+    initial = grouped_median(values, groups, ngroups)
+    scale = np.maximum(c * grouped_mad(values, groups, ngroups), epsilon)
+    d = values - initial[groups]
+    w = (d / scale[groups])**2
+    # Omit the outlier points
+    mask = np.abs(w) < 1
+    d, w, mask_groups = d[mask], w[mask], groups[mask]
+    n = grouped_count(mask_groups, ngroups)
+    numer = grouped_sum(d * d * (1 - w)**4, mask_groups, ngroups)
+    denom = grouped_sum((1 - w) * (1 - 5 * w), mask_groups, ngroups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return n**0.5 * numer**0.5 / np.abs(denom)
+
+
+def grouped_percentile(values, groups, ngroups, q):
+    """Percentile `q` (0 to 100) of the values in each group.
+
+    Interpolates linearly between values, like `numpy.percentile`.
+    """
+    values = np.asarray(values, dtype=np.float_)
+    groups = np.asarray(groups)
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    bounds = groups[order].searchsorted(np.arange(ngroups + 1))
+    sizes = np.diff(bounds)
+    result = np.repeat(np.nan, ngroups)
+    ok = (sizes > 0)
+    posns = bounds[:-1][ok] + (sizes[ok] - 1) * (q / 100)
+    lo_posns = np.floor(posns).astype(np.int_)
+    hi_posns = np.ceil(posns).astype(np.int_)
+    result[ok] = (sorted_values[lo_posns] +
+                  (sorted_values[hi_posns] - sorted_values[lo_posns]) *
+                  (posns - lo_posns))
+    return result
+
+
+def grouped_prediction_interval(values, groups, ngroups, alpha):
+    """Prediction interval of each group's values, estimated by percentiles.
+
+    See `prediction_interval`. Returns arrays of the low and high bounds.
+    """
+    return (grouped_percentile(values, groups, ngroups, 100 * alpha / 2),
+            grouped_percentile(values, groups, ngroups, 100 * (1 - alpha / 2)))
+
+
+def grouped_confidence_interval_bootstrap(values, groups, ngroups, alpha,
+                                          bootstraps=100, weights=None):
+    """Confidence interval of each group's mean value, by bootstrap.
+
+    See `confidence_interval_bootstrap`. All groups are resampled at once, in
+    each of the `bootstraps` iterations. Returns arrays of the low and high
+    bounds.
+    """
+    values = np.asarray(values, dtype=np.float_)
+    groups = np.asarray(groups)
+    order = np.argsort(groups, kind='mergesort')
+    values = values[order]
+    groups = groups[order]
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float_)[order]
+    sizes = grouped_count(groups, ngroups)
+    # Position of each value's group, and its size
+    group_starts = (np.cumsum(sizes) - sizes)[groups]
+    group_sizes = sizes[groups]
+    boot_means = np.zeros((bootstraps, ngroups))
+    for i in range(bootstraps):
+        # Resample each group's values, with replacement
+        idx = group_starts + (np.random.random_sample(len(values)) *
+                              group_sizes).astype(np.int_)
+        boot_means[i] = grouped_mean(values[idx], groups, ngroups,
+                                     None if weights is None else weights[idx])
+    ci_lo = np.repeat(np.nan, ngroups)
+    ci_hi = np.repeat(np.nan, ngroups)
+    ok = (sizes > 0)
+    if ok.any():
+        ci_lo[ok], ci_hi[ok] = np.percentile(boot_means[:, ok],
+                                             [100 * alpha / 2,
+                                              100 * (1 - alpha / 2)],
+                                             axis=0)
+    return ci_lo, ci_hi
+
+
+def grouped_unique(values, groups, ngroups):
+    """Distinct values in each group, in order of first appearance.
+
+    Returns a list of `ngroups` lists.
+    """
+    table = pd.DataFrame({'group': groups, 'value': values}
+                        ).drop_duplicates()
+    table = table.iloc[np.argsort(table['group'].values, kind='mergesort')]
+    bounds = table['group'].values.searchsorted(np.arange(1, ngroups))
+    return [list(chunk) for chunk in np.split(table['value'].values, bounds)]
+
+
+def grouped_split(values, groups, ngroups):
+    """Split values into a list of arrays, one per group.
+
+    For statistics without a vectorized grouped version here.
+    """
+    values = np.asarray(values)
+    order = np.argsort(groups, kind='mergesort')
+    bounds = np.asarray(groups)[order].searchsorted(np.arange(1, ngroups))
+    return np.split(values[order], bounds)
+
+
+_GROUPED_SUMMARIES = {
+    np.mean: grouped_mean,
+    np.median: grouped_median,
+    biweight_location: grouped_biweight_location,
+    biweight_midvariance: grouped_biweight_midvariance,
+    median_absolute_deviation: grouped_mad,
+}
+
+
+def grouped_summary(func, values, groups, ngroups):
+    """Apply a summary statistic `func` to the values in each group.
+
+    Uses the vectorized grouped version of `func` if there is one here,
+    otherwise calls `func` on each group's values in turn. Empty groups get NaN.
+    """
+    if func in _GROUPED_SUMMARIES:
+        return _GROUPED_SUMMARIES[func](values, groups, ngroups)
+    return np.array([func(chunk) if len(chunk) else np.nan
+                     for chunk in grouped_split(values, groups, ngroups)],
+                    dtype=np.float_)
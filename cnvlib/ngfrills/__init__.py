@@ -72,18 +72,19 @@ def ensure_path(fname):
 
 
 @contextlib.contextmanager
-def safe_write(outfile, verbose=True):
+def safe_write(outfile, verbose=True, mode='w'):
     """Write to a filename or file-like object with error handling.
 
-    If given a file name, open it. If the path includes directories that don't
-    exist yet, create them.  If given a file-like object, just pass it through.
+    If given a file name, open it (with `mode`, e.g. 'wb' for binary). If the
+    path includes directories that don't exist yet, create them.  If given a
+    file-like object, just pass it through.
     """
     if isinstance(outfile, basestring):
         dirname = os.path.dirname(outfile)
         if dirname and not os.path.isdir(dirname):
             os.mkdir(dirname)
             logging.info("Created directory %s", dirname)
-        with open(outfile, 'w') as handle:
+        with open(outfile, mode) as handle:
             yield handle
     else:
         yield outfile
@@ -6,6 +6,7 @@ import math
 import os
 from itertools import groupby
 
+import numpy as np
 import pysam
 from Bio._py3k import map
 
@@ -105,6 +106,40 @@ def fasta_extract_regions(fa_fname, intervals):
                 yield subseq
 
 
+def fasta_chrom_blocks(fa_fname, index_record, block_size=2**22):
+    """Iterate over a chromosome's sequence as blocks of bytes, without EOLs.
+
+    The FASTA file is memory-mapped, and each block is a NumPy array of
+    (roughly) `block_size` byte values, or fewer at the end of the sequence.
+    `index_record` is the chromosome's entry from `read_fasta_index`.
+
+    Emits pairs of (position of the block's first base, block).
+    """
+    seq_len, offset, chars_per_line, bytes_per_line = index_record
+    if not seq_len:
+        return
+    full_lines, remainder = divmod(seq_len, chars_per_line)
+    # The file's last line may lack its EOL, so stop at the end of the file
+    size = min(full_lines * bytes_per_line + remainder,
+               os.path.getsize(fa_fname) - offset)
+    raw = np.memmap(fa_fname, dtype=np.uint8, mode='r', offset=offset,
+                    shape=(size,))
+    # View the lines that end with an EOL as rows, dropping the EOL characters
+    eol_lines = min(full_lines, size // bytes_per_line)
+    lines = raw[:eol_lines * bytes_per_line].reshape(eol_lines,
+                                                     bytes_per_line)
+    lines = lines[:, :chars_per_line]
+    block_lines = max(1, block_size // chars_per_line)
+    for i in range(0, eol_lines, block_lines):
+        yield i * chars_per_line, lines[i:i + block_lines].ravel()
+    # Then the last line, if it's short or has no EOL
+    tail_start = eol_lines * bytes_per_line
+    tail_len = seq_len - eol_lines * chars_per_line
+    if tail_len:
+        yield (eol_lines * chars_per_line,
+               raw[tail_start:tail_start + tail_len])
+
+
 def _fasta_extract_regions_safe(fa_fname, intervals):
     """Simpler, slower version of fasta_extract_regions, for testing it."""
     from Bio import SeqIO
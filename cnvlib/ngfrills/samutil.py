@@ -1,14 +1,37 @@
-"""BAM utilities."""
+"""BAM and CRAM utilities."""
 from __future__ import absolute_import, division, print_function
 
+import contextlib
+import hashlib
 import logging
 import os
+import tempfile
 from itertools import islice
 
 import pysam
 
 from .shared import is_newer_than
 
+# Environment variables htslib uses to find reference sequences for CRAM
+REF_VARS = ('REF_PATH', 'REF_CACHE')
+
+
+def is_cram(bam_fname):
+    """Guess whether a read alignment file is CRAM (or else BAM) by its name."""
+    return bam_fname.lower().endswith('.cram')
+
+
+def open_alignment(bam_fname, fasta=None):
+    """Open a BAM or CRAM file for reading.
+
+    CRAM files are decoded against the reference genome sequence, given as a
+    FASTA file; otherwise htslib looks up each sequence by its MD5 checksum
+    through the REF_PATH environment variable (see `using_ref_cache`).
+    """
+    if is_cram(bam_fname):
+        return pysam.Samfile(bam_fname, 'rc', reference_filename=fasta)
+    return pysam.Samfile(bam_fname, 'rb')
+
 
 def ensure_bam_index(bam_fname):
     """Ensure a BAM file is indexed, to enable fast traversal & lookup.
@@ -17,8 +40,12 @@ def ensure_bam_index(bam_fname):
 
     - MySample.bam.bai
     - MySample.bai
+
+    For MySample.cram, the index is MySample.cram.crai.
     """
-    if os.path.isfile(bam_fname + '.bai'):
+    if is_cram(bam_fname):
+        bai_fname = bam_fname + '.crai'
+    elif os.path.isfile(bam_fname + '.bai'):
         # MySample.bam.bai
         bai_fname = bam_fname + '.bai'
     else:
@@ -27,13 +54,14 @@ def ensure_bam_index(bam_fname):
     if not is_newer_than(bai_fname, bam_fname):
         logging.info("Indexing BAM file %s", bam_fname)
         pysam.index(bam_fname)
-        bai_fname = bam_fname + '.bai'
+        if not is_cram(bam_fname):
+            bai_fname = bam_fname + '.bai'
     assert os.path.isfile(bai_fname), \
             "Failed to generate index " + bai_fname
     return bai_fname
 
 
-def ensure_bam_sorted(bam_fname, by_name=False, span=50):
+def ensure_bam_sorted(bam_fname, by_name=False, span=50, fasta=None):
     """Test if the reads in a BAM file are sorted as expected.
 
     by_name=True: reads are expected to be sorted by query name. Consecutive
@@ -41,6 +69,8 @@ def ensure_bam_sorted(bam_fname, by_name=False, span=50):
 
     by_name=False: reads are sorted by position. Consecutive reads have
     increasing position.
+
+    For CRAM files, `fasta` is the reference genome sequence.
     """
     if by_name:
         # Compare read IDs
@@ -55,10 +85,93 @@ def ensure_bam_sorted(bam_fname, by_name=False, span=50):
                         prev.pos <= read.pos)
 
     # ENH - repeat at 50%, ~99% through the BAM
-    bam = pysam.Samfile(bam_fname, 'rb')
+    bam = open_alignment(bam_fname, fasta)
     last_read = None
     for read in islice(bam, span):
         if out_of_order(read, last_read):
             return False
         last_read = read
     return True
+
+
+def ensure_ref_cache(fasta_fname, cache_dir):
+    """Set up a local cache of reference sequences for decoding CRAM files.
+
+    Each sequence in the FASTA file is stored in `cache_dir` under its MD5
+    checksum, in the layout htslib expects; see `using_ref_cache` to decode
+    CRAM files with it. If the cache is already up to date, do nothing.
+
+    If `fasta_fname` is None, just use the previously cached sequences.
+    """
+    if not fasta_fname:
+        return
+    cache_dir = os.path.abspath(cache_dir)
+    done_fname = os.path.join(cache_dir,
+                              os.path.basename(fasta_fname) + '.cached')
+    if not is_newer_than(done_fname, fasta_fname):
+        logging.info("Caching reference sequences of %s in %s",
+                     fasta_fname, cache_dir)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(fasta_fname) as handle:
+            _cache_fasta_sequences(handle, cache_dir)
+        with open(done_fname, 'w'):
+            pass
+
+
+@contextlib.contextmanager
+def using_ref_cache(cache_dir):
+    """Decode CRAM files via a cache of reference sequences within a block.
+
+    Points the REF_PATH and REF_CACHE environment variables at the cache made
+    by `ensure_ref_cache`, and restores them afterward. Processes started in
+    the block (e.g. by `parallel.pick_pool`) inherit these settings, so they
+    all share the same memory-mapped copy of each sequence, instead of each
+    reading the sequences from the FASTA file again. Open CRAM files without
+    the FASTA file here, since htslib would use it instead of the cache.
+
+    If `cache_dir` is None, leave the environment as it is.
+    """
+    if not cache_dir:
+        yield
+        return
+    ref_pattern = os.path.join(os.path.abspath(cache_dir), '%2s', '%2s', '%s')
+    saved = [(key, os.environ.get(key)) for key in REF_VARS]
+    for key in REF_VARS:
+        os.environ[key] = ref_pattern
+    try:
+        yield
+    finally:
+        for key, value in saved:
+            if value is None:
+                del os.environ[key]
+            else:
+                os.environ[key] = value
+
+
+def _cache_fasta_sequences(handle, cache_dir):
+    """Write each sequence to the cache under the MD5 of its uppercase form.
+    """
+    def store(tmp_fname, md5):
+        digest = md5.hexdigest()
+        seq_dir = os.path.join(cache_dir, digest[:2], digest[2:4])
+        if not os.path.isdir(seq_dir):
+            os.makedirs(seq_dir)
+        os.rename(tmp_fname, os.path.join(seq_dir, digest[4:]))
+
+    tmp_fname = md5 = out = None
+    for line in handle:
+        if line.startswith('>'):
+            if out is not None:
+                out.close()
+                store(tmp_fname, md5)
+            fd, tmp_fname = tempfile.mkstemp(dir=cache_dir)
+            out = os.fdopen(fd, 'w')
+            md5 = hashlib.md5()
+        elif out is not None:
+            seq = line.strip().upper()
+            out.write(seq)
+            md5.update(seq.encode('ascii'))
+    if out is not None:
+        out.close()
+        store(tmp_fname, md5)
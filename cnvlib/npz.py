@@ -0,0 +1,214 @@
+"""Binary storage of genomic arrays, as uncompressed NumPy .npz archives.
+
+Each column is stored as its own typed array. String columns (chromosome,
+gene, etc.) are stored as integer codes into a dictionary of the distinct
+values. A JSON header holds the column order, the array's metadata, and, if
+each chromosome's rows are contiguous, the range of rows for each chromosome.
+
+Since the archive members are not compressed, numeric columns are read by
+memory-mapping the file instead of parsing it, so reading one chromosome's rows
+only touches that part of the file. The rows read are still copied into the
+table, which takes as much memory as one read from the text format. The files
+are also readable with plain `numpy.load`, and must be named with the ``.npz``
+extension.
+"""
+from __future__ import absolute_import, division
+import collections
+import json
+import logging
+import struct
+import sys
+import zipfile
+
+import numpy as np
+import pandas as pd
+from Bio._py3k import basestring
+
+from .ngfrills import safe_write
+
+EXT = '.npz'
+# Archive members other than the columns
+HEADER_KEY = '__header__'
+FORMAT_VERSION = 1
+# Every zip archive (and so .npz file) starts with this
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+def is_npz(fname):
+    """Check whether a file is in this binary format (or else text)."""
+    try:
+        with open(fname, 'rb') as handle:
+            return handle.read(len(ZIP_MAGIC)) == ZIP_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def with_ext(fname):
+    """Add the .npz extension to a file name, if it isn't there already."""
+    return fname if fname.endswith(EXT) else fname + EXT
+
+
+def write(outfile, table, meta):
+    """Write a data table and its metadata to a file or binary handle.
+
+    A file name must end with the .npz extension (see `with_ext`).
+    """
+    if isinstance(outfile, basestring) and not outfile.endswith(EXT):
+        raise ValueError("Binary output file name must end with %s: %s"
+                         % (EXT, outfile))
+    arrays = {}
+    columns = []
+    string_columns = []
+    for col in table.columns:
+        values = table[col].values
+        if values.dtype.kind == 'O':
+            codes, categories = pd.factorize(table[col])
+            arrays['codes:' + col] = codes.astype(np.int32)
+            arrays['categories:' + col] = np.array(
+                [str(cat) for cat in categories], dtype=np.unicode_)
+            string_columns.append(col)
+        else:
+            arrays['values:' + col] = values
+        columns.append(col)
+    header = {'version': FORMAT_VERSION,
+              'columns': columns,
+              'string_columns': string_columns,
+              'meta': meta,
+              'chrom_offsets': _chrom_offsets(arrays, string_columns)}
+    arrays[HEADER_KEY] = np.frombuffer(
+        json.dumps(header, default=_json_default).encode('utf-8'),
+        dtype=np.uint8)
+    if outfile is None or outfile is sys.stdout:
+        outfile = getattr(sys.stdout, 'buffer', sys.stdout)
+    with safe_write(outfile, mode='wb') as handle:
+        np.savez(handle, **arrays)
+
+
+def read(fname, columns=None, chrom=None):
+    """Read a data table and its metadata from a file.
+
+    If `columns` is given, only those columns are loaded (in file order);
+    others are skipped. If `chrom` is given and each chromosome's rows are
+    contiguous in the file, only that chromosome's rows are loaded; otherwise
+    the caller has to select them.
+
+    Returns a tuple: (pandas.DataFrame, metadata dict, chromosome offsets). The
+    offsets are an ordered list of (chromosome, start_row, end_row), or None if
+    the chromosomes weren't contiguous.
+    """
+    with zipfile.ZipFile(fname) as zfile:
+        infos = dict((_member_key(info), info) for info in zfile.infolist())
+    with open(fname, 'rb') as handle:
+        header = json.loads(_map_member(fname, handle, infos[HEADER_KEY])
+                            .tobytes().decode('utf-8'))
+        if header['version'] > FORMAT_VERSION:
+            raise ValueError("File %s was written by a newer version of "
+                             "CNVkit (format version %s)"
+                             % (fname, header['version']))
+        offsets = header['chrom_offsets']
+        rows = slice(None)
+        if chrom is not None and offsets is not None:
+            bounds = [(start, end) for name, start, end in offsets
+                      if name == chrom]
+            rows = slice(*bounds[0]) if bounds else slice(0, 0)
+            offsets = [(chrom, 0, rows.stop - rows.start)] if bounds else []
+        elif offsets is not None:
+            offsets = [(name, start, end) for name, start, end in offsets]
+        wanted = [col for col in header['columns']
+                  if columns is None or col in columns]
+        arrays = {}
+        for col in wanted:
+            if col in header['string_columns']:
+                keys = ('codes:' + col, 'categories:' + col)
+            else:
+                keys = ('values:' + col,)
+            for key in keys:
+                arrays[key] = _map_member(fname, handle, infos[key])
+    table = pd.DataFrame(collections.OrderedDict(
+        (col, _column_values(arrays, col, col in header['string_columns'],
+                             rows))
+        for col in wanted))
+    if not len(wanted):
+        table = pd.DataFrame()
+    return table, header['meta'], offsets
+
+
+def load_arrays(fname):
+    """Load all the arrays in an .npz file, memory-mapping where possible.
+
+    The memory-mapped arrays are read-only.
+    """
+    arrays = {}
+    with zipfile.ZipFile(fname) as zfile:
+        infos = zfile.infolist()
+    with open(fname, 'rb') as handle:
+        for info in infos:
+            arrays[_member_key(info)] = _map_member(fname, handle, info)
+    return arrays
+
+
+def _member_key(info):
+    """Array name of an archive member, as numpy.load would show it."""
+    if info.filename.endswith('.npy'):
+        return info.filename[:-4]
+    return info.filename
+
+
+def _map_member(fname, handle, info):
+    """Memory-map one array stored in the archive, or else just read it."""
+    if info.compress_type == zipfile.ZIP_STORED:
+        # Skip over the member's local file header
+        handle.seek(info.header_offset)
+        local_header = handle.read(30)
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        handle.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(handle)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(handle)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(handle)
+        if not dtype.hasobject:
+            if not np.prod(shape):
+                return np.zeros(shape, dtype=dtype)
+            return np.memmap(fname, dtype=dtype, mode='r',
+                             offset=handle.tell(), shape=shape,
+                             order='F' if fortran else 'C')
+    logging.debug("Can't memory-map %s in %s; reading it instead",
+                  info.filename, fname)
+    with zipfile.ZipFile(fname) as zfile:
+        with zfile.open(info) as member:
+            return np.lib.format.read_array(member, allow_pickle=False)
+
+
+def _column_values(arrays, col, is_string, rows=slice(None)):
+    if is_string:
+        categories = arrays['categories:' + col].astype(object)
+        codes = np.array(arrays['codes:' + col][rows])
+        values = categories.take(codes) if len(categories) else \
+                np.repeat(np.nan, len(codes)).astype(object)
+        # Missing values
+        values[codes < 0] = np.nan
+        return values
+    # Copy the rows out of the memory-mapped file
+    return np.array(arrays['values:' + col][rows])
+
+
+def _chrom_offsets(arrays, string_columns):
+    """Each chromosome's range of rows, if they're all contiguous."""
+    if 'chromosome' not in string_columns:
+        return None
+    codes = arrays['codes:chromosome']
+    # Codes are numbered in order of first appearance
+    if len(codes) and (np.diff(codes) < 0).any():
+        return None
+    chroms = arrays['categories:chromosome']
+    bounds = np.searchsorted(codes, np.arange(len(chroms) + 1))
+    return [(str(chrom), int(start), int(end))
+            for chrom, start, end in zip(chroms, bounds[:-1], bounds[1:])]
+
+
+def _json_default(obj):
+    """Convert NumPy scalars in the metadata to plain Python values."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Can't store %r in the file header" % (obj,))
@@ -6,21 +6,38 @@ import multiprocessing
 class SerialPool(object):
     """Mimic the multiprocessing.Pool interface, but run in serial."""
 
-    def __init__(self):
-        pass
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
 
     def apply_async(self, func, args):
         """Just call the function."""
-        func(*args)
+        return SerialResult(func(*args))
 
     # No-ops to mimic multiprocessing.Pool
     def close(self): pass
     def join(self): pass
 
 
-def pick_pool(nprocs):
+class SerialResult(object):
+    """Mimic the multiprocessing.pool.AsyncResult interface."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        """Return the already-computed result."""
+        return self.value
+
+
+def pick_pool(nprocs, initializer=None, initargs=()):
+    """Get a process pool, or a serial stand-in if `nprocs` is 1.
+
+    If `nprocs` is 0 or negative, use all available CPUs. The optional
+    `initializer` is called with `initargs` once in each worker process.
+    """
     if nprocs == 1:
-        return SerialPool()
+        return SerialPool(initializer, initargs)
     if nprocs < 1:
         nprocs = multiprocessing.cpu_count()
-    return multiprocessing.Pool(nprocs)
+    return multiprocessing.Pool(nprocs, initializer, initargs)
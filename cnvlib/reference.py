@@ -2,14 +2,21 @@
 from __future__ import absolute_import, division, print_function
 
 import logging
+import multiprocessing
+import os
+import tempfile
 
 import numpy as np
-from Bio._py3k import map, zip
+from Bio._py3k import basestring, map, zip
 
-from . import core, fix, metrics, ngfrills, params
+from . import core, fix, metrics, ngfrills, parallel, params, refstore
 from .cnary import CopyNumArray as CNA
+from .gary import GenomicArray as GA
 from .rary import RegionArray as RA
 
+# Temporary copies of the data the robust estimators make, for sizing chunks
+ESTIMATOR_COPIES = 10
+
 
 def bed2probes(bed_fname):
     """Create neutral-coverage probes from intervals."""
@@ -22,12 +29,22 @@ def bed2probes(bed_fname):
 
 
 def combine_probes(filenames, fa_fname, is_male_reference, skip_low,
-                   fix_gc, fix_edge, fix_rmask, combine_probes_threshold = None):
+                   fix_gc, fix_edge, fix_rmask, combine_probes_threshold = None,
+                   processes=1, store_dir=None, store_part=None,
+                   max_memory=None):
     """Calculate the median coverage of each bin across multiple samples.
 
     Input:
         List of .cnn files, as generated by 'coverage' or 'import-picard'.
         `fa_fname`: fil columns for GC and RepeatMasker genomic values.
+        `processes`: number of subprocesses to load and bias-correct the
+        samples in parallel.
+        `store_dir`, `store_part`: if given, save the bins and the samples'
+        corrected coverages as this part of a reference store (see
+        `refstore`), so the reference can be updated later.
+        `max_memory`: approximate limit, in bytes, on the memory used for the
+        samples' corrected coverages. If they'd take more, they're kept in a
+        temporary file instead, and the bins are summarized in chunks.
     Returns:
         A single CopyNumArray summarizing the coverages of the input samples,
         including each bin's "average" coverage, "spread" of coverages, and
@@ -46,11 +63,20 @@ def combine_probes(filenames, fa_fname, is_male_reference, skip_low,
         if fa_fname:
             col_names.append('rmask')
         col_names.append('spread')
+        if store_dir:
+            bins = GA.from_rows([], [col for col in col_names
+                                     if col not in ('log2', 'spread')])
+            refstore.write_part(store_dir, store_part, bins,
+                                {'is_male_reference': is_male_reference,
+                                 'skip_low': skip_low,
+                                 'threshold': combine_probes_threshold},
+                                list(map(core.fbase, filenames)),
+                                np.zeros((len(filenames) + 1, 0)))
         return CNA.from_rows([], col_names, {'sample_id': "reference"})
 
     # Calculate GC and RepeatMasker content for each probe's genomic region
     if fa_fname and (fix_rmask or fix_gc):
-        gc, rmask = get_fasta_stats(cnarr1, fa_fname)
+        gc, rmask = get_fasta_stats(cnarr1, fa_fname, processes)
         if fix_gc:
             columns['gc'] = gc
         if fix_rmask:
@@ -60,95 +86,285 @@ def combine_probes(filenames, fa_fname, is_male_reference, skip_low,
         gc = cnarr1['gc']
         columns['gc'] = gc
 
-    # Make the sex-chromosome coverages of male and female samples compatible
-    is_chr_x = (cnarr1.chromosome == cnarr1._chr_x_label)
-    is_chr_y = (cnarr1.chromosome == cnarr1._chr_y_label)
-    flat_coverage = cnarr1.expect_flat_cvg(is_male_reference)
-    def shift_sex_chroms(cnarr, shift_sex_threshold=None):
-        """Shift sample X and Y chromosomes to match the reference gender.
-
-        Reference values:
-            XY: chrX -1, chrY -1
-            XX: chrX 0, chrY -1
-
-        Plan:
-          chrX:
-            xx sample, xx ref: 0    (from 0)
-            xx sample, xy ref: -= 1 (from -1)
-            xy sample, xx ref: += 1 (from 0)    +1
-            xy sample, xy ref: 0    (from -1)   +1
-          chrY:
-            xx sample, xx ref: = -1 (from -1)
-            xx sample, xy ref: = -1 (from -1)
-            xy sample, xx ref: 0    (from -1)   +1
-            xy sample, xy ref: 0    (from -1)   +1
-
-        """
-        is_sample_female = cnarr.guess_xx(guess_xx_threshold=shift_sex_threshold)
-        cnarr['log2'] += flat_coverage
-        if is_sample_female:
-            # chrX already OK
-            # No chrY; it's all noise, so just match the male
-            cnarr[is_chr_y, 'log2'] = -1.0
-        else:
-            # 1/2 #copies of each sex chromosome
-            cnarr[is_chr_x | is_chr_y, 'log2'] += 1.0
-
-    edge_bias = fix.get_edge_bias(cnarr1, params.INSERT_SIZE)
-    def bias_correct_coverage(cnarr, bias_correct_threshold = None):
-        """Perform bias corrections on the sample."""
-        cnarr.center_all(skip_low=skip_low)
-        shift_sex_chroms(cnarr, bias_correct_threshold)
-        # Skip bias corrections if most bins have no coverage (e.g. user error)
-        if (cnarr['log2'] > params.NULL_LOG2_COVERAGE - params.MIN_REF_COVERAGE
-           ).sum() <= len(cnarr) // 2:
-            logging.warn("WARNING: most bins have no or very low coverage; "
-                         "check that the right BED file was used")
-        else:
-            if 'gc' in columns and fix_gc:
-                logging.info("Correcting for GC bias...")
-                cnarr = fix.center_by_window(cnarr, .1, columns['gc'])
-            if 'rmask' in columns and fix_rmask:
-                logging.info("Correcting for RepeatMasker bias...")
-                cnarr = fix.center_by_window(cnarr, .1, columns['rmask'])
-            if fix_edge:
-                logging.info("Correcting for density bias...")
-                cnarr = fix.center_by_window(cnarr, .1, edge_bias)
-        return cnarr['log2']
+    # Values each sample is corrected against, stored along with the bins
+    settings = {'is_male_reference': is_male_reference,
+                'skip_low': skip_low,
+                'threshold': combine_probes_threshold}
+    bins = GA(cnarr1.data.loc[:, ['chromosome', 'start', 'end', 'gene']])
+    for key, values in columns.items():
+        bins[key] = np.asarray(values)
+    if fix_edge:
+        bins['edge_bias'] = fix.get_edge_bias(cnarr1, params.INSERT_SIZE)
+    corrections = _bias_corrections(bins, settings)
 
     # Pseudocount of 1 "flat" sample
-    all_coverages = [flat_coverage, bias_correct_coverage(cnarr1, combine_probes_threshold)]
-    for fname in filenames[1:]:
-        logging.info("Loading target %s", fname)
-        cnarrx = CNA.read(fname)
-        # Bin information should match across all files
-        if not (len(cnarr1) == len(cnarrx)
-                and (cnarr1.chromosome == cnarrx.chromosome).all()
-                and (cnarr1.start == cnarrx.start).all()
-                and (cnarr1.end == cnarrx.end).all()
-                and (cnarr1['gene'] == cnarrx['gene']).all()):
-            raise RuntimeError("%s probes do not match those in %s"
-                               % (fname, filenames[0]))
-        all_coverages.append(bias_correct_coverage(cnarrx, combine_probes_threshold))
-    all_coverages = np.vstack(all_coverages)
-
-    logging.info("Calculating average bin coverages")
-    cvg_centers = np.apply_along_axis(metrics.biweight_location, 0,
-                                      all_coverages)
-    logging.info("Calculating bin spreads")
-    spreads = np.apply_along_axis(metrics.biweight_midvariance, 0,
-                                  all_coverages)
+    shape = (len(filenames) + 1, len(cnarr1))
+    cvg_out, all_coverages = _allocate_matrix(shape, max_memory)
+    try:
+        all_coverages[0] = cnarr1.expect_flat_cvg(is_male_reference)
+        all_coverages[1] = bias_correct_coverage(cnarr1, **corrections)
+        _correct_samples(filenames[1:], 2, cvg_out, shape, bins,
+                         filenames[0], corrections, processes)
+        if store_dir:
+            refstore.write_part(store_dir, store_part, bins, settings,
+                                list(map(core.fbase, filenames)),
+                                all_coverages)
+        return summarize_reference(bins, all_coverages, max_memory)
+    finally:
+        del all_coverages
+        _release_matrix(cvg_out)
+
+
+def update_probes(store_dir, part, filenames=(), remove_ids=(), processes=1,
+                  max_memory=None):
+    """Add and/or remove samples in a reference store, and recalculate it.
+
+    Only the newly added samples are loaded and bias-corrected, with the same
+    options and bin-level values as the samples already in the store (see
+    `refstore`). Samples to remove are given by sample ID. The stored matrix of
+    coverages is memory-mapped, and summarized within `max_memory` as in
+    `combine_probes`.
+
+    Returns a CopyNumArray of the updated part of the reference, the same as
+    `combine_probes` would calculate from scratch for these samples.
+    """
+    if remove_ids:
+        refstore.remove_samples(store_dir, part, remove_ids)
+    if filenames:
+        bins, settings, stored_ids, _cvgs = refstore.read_part(store_dir, part)
+        del _cvgs
+        new_ids = list(map(core.fbase, filenames))
+        duplicates = set(new_ids).intersection(stored_ids)
+        if duplicates:
+            raise ValueError("Samples already in the reference store %s: %s"
+                             % (store_dir, ", ".join(sorted(duplicates))))
+        shape = (len(filenames), len(bins))
+        if len(bins):
+            cvg_out, new_coverages = _allocate_matrix(shape, max_memory)
+            try:
+                _correct_samples(filenames, 0, cvg_out, shape, bins,
+                                 store_dir, _bias_corrections(bins, settings),
+                                 processes)
+                refstore.append_samples(store_dir, part, new_ids,
+                                        new_coverages)
+            finally:
+                del new_coverages
+                _release_matrix(cvg_out)
+        else:
+            refstore.append_samples(store_dir, part, new_ids, np.zeros(shape))
+    bins, _settings, sample_ids, all_coverages = refstore.read_part(store_dir,
+                                                                    part)
+    logging.info("Updating the %s from %d samples", part, len(sample_ids))
+    return summarize_reference(bins, all_coverages, max_memory)
+
+
+def summarize_reference(bins, all_coverages, max_memory=None):
+    """Summarize the samples' corrected coverages of each bin as a reference.
+
+    `all_coverages` has a row of flat pseudocounts, then a row for each sample.
+    """
+    logging.info("Calculating average bin coverages and spreads")
+    if max_memory:
+        chunk_bins = _chunk_bins(len(all_coverages), max_memory)
+        cvg_centers, spreads = summarize_bin_coverages(all_coverages,
+                                                       chunk_bins)
+    else:
+        cvg_centers, spreads = summarize_bin_coverages(all_coverages)
+    columns = {col: bins[col] for col in bins.data.columns
+               if col != 'edge_bias'}
+    columns['log2'] = cvg_centers
     columns['spread'] = spreads
-    columns.update({
-        'chromosome': cnarr1.chromosome,
-        'start': cnarr1.start,
-        'end': cnarr1.end,
-        'gene': cnarr1['gene'],
-        'log2': cvg_centers,
-    })
     return CNA.from_columns(columns, {'sample_id': "reference"})
 
 
+def shift_sex_chroms(cnarr, is_male_reference, threshold=None):
+    """Shift sample X and Y chromosomes to match the reference gender.
+
+    Reference values:
+        XY: chrX -1, chrY -1
+        XX: chrX 0, chrY -1
+
+    Plan:
+      chrX:
+        xx sample, xx ref: 0    (from 0)
+        xx sample, xy ref: -= 1 (from -1)
+        xy sample, xx ref: += 1 (from 0)    +1
+        xy sample, xy ref: 0    (from -1)   +1
+      chrY:
+        xx sample, xx ref: = -1 (from -1)
+        xx sample, xy ref: = -1 (from -1)
+        xy sample, xx ref: 0    (from -1)   +1
+        xy sample, xy ref: 0    (from -1)   +1
+
+    """
+    is_chr_x = (cnarr.chromosome == cnarr._chr_x_label)
+    is_chr_y = (cnarr.chromosome == cnarr._chr_y_label)
+    is_sample_female = cnarr.guess_xx(guess_xx_threshold=threshold)
+    cnarr['log2'] += cnarr.expect_flat_cvg(is_male_reference)
+    if is_sample_female:
+        # chrX already OK
+        # No chrY; it's all noise, so just match the male
+        cnarr[is_chr_y, 'log2'] = -1.0
+    else:
+        # 1/2 #copies of each sex chromosome
+        cnarr[is_chr_x | is_chr_y, 'log2'] += 1.0
+
+
+def bias_correct_coverage(cnarr, is_male_reference, skip_low, threshold=None,
+                          gc=None, rmask=None, edge_bias=None):
+    """Perform bias corrections on the sample.
+
+    Each of `gc`, `rmask` and `edge_bias`, if given, is an array of that
+    value for each bin to correct the coverages against.
+
+    Returns the sample's corrected log2 values.
+    """
+    cnarr.center_all(skip_low=skip_low)
+    shift_sex_chroms(cnarr, is_male_reference, threshold)
+    # Skip bias corrections if most bins have no coverage (e.g. user error)
+    if (cnarr['log2'] > params.NULL_LOG2_COVERAGE - params.MIN_REF_COVERAGE
+       ).sum() <= len(cnarr) // 2:
+        logging.warn("WARNING: most bins have no or very low coverage; "
+                     "check that the right BED file was used")
+    else:
+        if gc is not None:
+            logging.info("Correcting for GC bias...")
+            cnarr = fix.center_by_window(cnarr, .1, gc)
+        if rmask is not None:
+            logging.info("Correcting for RepeatMasker bias...")
+            cnarr = fix.center_by_window(cnarr, .1, rmask)
+        if edge_bias is not None:
+            logging.info("Correcting for density bias...")
+            cnarr = fix.center_by_window(cnarr, .1, edge_bias)
+    return cnarr['log2']
+
+
+def _bias_corrections(bins, settings):
+    """Arguments to `bias_correct_coverage` from the stored bins and settings."""
+    corrections = dict(settings)
+    for key in ('gc', 'rmask', 'edge_bias'):
+        corrections[key] = (np.asarray(bins[key]) if key in bins else None)
+    return corrections
+
+
+def _correct_samples(filenames, first_row, cvg_out, shape, bins, bins_fname,
+                     corrections, processes):
+    """Load and bias-correct samples in parallel, into a shared matrix.
+
+    Each sample's corrected log2 values are written to the rows of the matrix
+    from `_allocate_matrix` starting at `first_row`, in order.
+    """
+    if not len(filenames):
+        return
+    if processes < 1:
+        processes = multiprocessing.cpu_count()
+    coords = bins.data.loc[:, ['chromosome', 'start', 'end', 'gene']]
+    pool = parallel.pick_pool(max(1, min(processes, len(filenames))),
+                              initializer=_init_sample_worker,
+                              initargs=(cvg_out, shape, coords, bins_fname,
+                                        corrections))
+    jobs = [pool.apply_async(_load_correct_sample, (fname, row))
+            for row, fname in enumerate(filenames, first_row)]
+    pool.close()
+    pool.join()
+    _sample_worker.clear()
+    for job in jobs:
+        # Raise any error in a worker here
+        job.get()
+
+
+def _allocate_matrix(shape, max_memory=None):
+    """Allocate a 2-D float array that subprocesses can write rows into.
+
+    The array is in shared memory, unless it would be larger than `max_memory`
+    bytes; then it's a memory-mapped temporary file.
+
+    Returns the buffer or file name to open the array with (`_open_matrix`),
+    and the array.
+    """
+    nbytes = shape[0] * shape[1] * np.dtype(np.float_).itemsize
+    if max_memory and nbytes > max_memory:
+        fd, fname = tempfile.mkstemp(prefix='cnvkit-reference-',
+                                     suffix='.log2')
+        os.close(fd)
+        logging.info("Storing the %d x %d matrix of corrected coverages "
+                     "(%.1f MB) in %s", shape[0], shape[1], nbytes / 2**20,
+                     fname)
+        return fname, np.memmap(fname, dtype=np.float_, mode='w+',
+                                shape=shape)
+    buf = multiprocessing.RawArray('d', shape[0] * shape[1])
+    return buf, _open_matrix(buf, shape)
+
+
+def _open_matrix(out, shape):
+    """Open a matrix from `_allocate_matrix` to write to."""
+    if isinstance(out, basestring):
+        return np.memmap(out, dtype=np.float_, mode='r+', shape=shape)
+    return np.frombuffer(out).reshape(shape)
+
+
+def _release_matrix(out):
+    """Delete the temporary file behind a matrix, if there's one."""
+    if isinstance(out, basestring):
+        os.remove(out)
+
+
+def _chunk_bins(nrows, max_memory):
+    """Number of bins to summarize at once within `max_memory` bytes."""
+    # The robust estimators make several temporary copies of each chunk
+    row_bytes = nrows * np.dtype(np.float_).itemsize * ESTIMATOR_COPIES
+    return max(1, int(max_memory // row_bytes))
+
+
+# State shared by the subprocesses that load and correct samples
+_sample_worker = {}
+
+
+def _init_sample_worker(out, shape, bins, bins_fname, corrections):
+    """Set up a subprocess to load and correct samples (see combine_probes)."""
+    _sample_worker.update(coverages=_open_matrix(out, shape),
+                          bins=bins, bins_fname=bins_fname,
+                          corrections=corrections)
+
+
+def _load_correct_sample(fname, row):
+    """Load a sample, check its bins and store its corrected coverages."""
+    logging.info("Loading target %s", fname)
+    cnarr = CNA.read(fname)
+    bins = _sample_worker['bins']
+    # Bin information should match across all files
+    if not (len(bins) == len(cnarr) and
+            all(np.array_equal(np.asarray(bins[col]), np.asarray(cnarr[col]))
+                for col in bins.columns)):
+        raise RuntimeError("%s probes do not match those in %s"
+                           % (fname, _sample_worker['bins_fname']))
+    _sample_worker['coverages'][row] = bias_correct_coverage(
+        cnarr, **_sample_worker['corrections'])
+
+
+def summarize_bin_coverages(all_coverages, chunk_bins=100000):
+    """Calculate the average coverage and spread of each bin across samples.
+
+    `all_coverages` is a 2-D array with one row per sample and one column per
+    bin. The biweight location and midvariance are calculated for
+    `chunk_bins` columns at a time, to limit the memory used for temporary
+    arrays.
+
+    Returns two arrays: the bin centers and spreads.
+    """
+    n_bins = all_coverages.shape[1]
+    if not chunk_bins:
+        chunk_bins = max(n_bins, 1)
+    centers = np.empty(n_bins)
+    spreads = np.empty(n_bins)
+    for start in range(0, n_bins, chunk_bins):
+        end = start + chunk_bins
+        chunk = all_coverages[:, start:end]
+        centers[start:end] = metrics.biweight_location(chunk, axis=0)
+        spreads[start:end] = metrics.biweight_midvariance(chunk, axis=0)
+    return centers, spreads
+
+
 def warn_bad_probes(probes):
     """Warn about target probes where coverage is poor.
 
@@ -188,16 +404,100 @@ def warn_bad_probes(probes):
                      len(bg_bad_probes), "%.4f" % bad_pct + '%')
 
 
-def get_fasta_stats(probes, fa_fname):
-    """Calculate GC and RepeatMasker content of each bin in the FASTA genome."""
-    ngfrills.ensure_fasta_index(fa_fname)
-    fa_coords = zip(probes.chromosome, probes.start, probes.end)
+def get_fasta_stats(probes, fa_fname, processes=1):
+    """Calculate GC and RepeatMasker content of each bin in the FASTA genome.
+
+    The FASTA file is memory-mapped, and the bases of each chromosome counted
+    in one pass (see `fasta_gc_lo`). With `processes`, chromosomes are
+    processed in parallel.
+    """
+    index = ngfrills.read_fasta_index(fa_fname)
     logging.info("Calculating GC and RepeatMasker content in %s ...", fa_fname)
-    gc_rm_vals = [calculate_gc_lo(subseq)
-                  for subseq in ngfrills.fasta_extract_regions(fa_fname,
-                                                               fa_coords)]
-    gc_vals, rm_vals = zip(*gc_rm_vals)
-    return np.asfarray(gc_vals), np.asfarray(rm_vals)
+    gc_vals = np.zeros(len(probes))
+    rm_vals = np.zeros(len(probes))
+    # Group by plain names; pandas can't group categoricals with sort=False
+    chrom_rows = probes.data.groupby(np.asarray(probes['chromosome']),
+                                     sort=False).indices
+    if processes < 1:
+        processes = multiprocessing.cpu_count()
+    pool = parallel.pick_pool(max(1, min(processes, len(chrom_rows))))
+    jobs = []
+    for chrom, rows in chrom_rows.items():
+        if chrom not in index:
+            raise ValueError("Sequence ID '" + chrom + "' is not in FASTA "
+                             + "file " + fa_fname)
+        jobs.append((rows, pool.apply_async(
+            fasta_gc_lo, (fa_fname, chrom, index[chrom],
+                          np.asarray(probes['start'])[rows],
+                          np.asarray(probes['end'])[rows]))))
+    pool.close()
+    pool.join()
+    for rows, job in jobs:
+        gc_vals[rows], rm_vals[rows] = job.get()
+    return gc_vals, rm_vals
+
+
+# Classes of sequence characters counted by fasta_gc_lo, as bit flags
+_GC, _AT, _LOWER = 1, 2, 4
+
+
+def _base_classes():
+    """Lookup table of the class flags of each byte value."""
+    table = np.zeros(256, dtype=np.uint8)
+    for chars, flags in ((b'GC', _GC), (b'gc', _GC | _LOWER),
+                         (b'AT', _AT), (b'at', _AT | _LOWER)):
+        table[np.frombuffer(chars, dtype=np.uint8)] = flags
+    return table
+
+_BASE_CLASSES = _base_classes()
+
+
+def fasta_gc_lo(fa_fname, chrom, index_record, starts, ends):
+    """Calculate the GC and lowercase content of regions of one chromosome.
+
+    Like `calculate_gc_lo` for each region, but reads the chromosome from the
+    memory-mapped FASTA file once. The running counts of GC, AT and lowercase
+    bases are taken at each region boundary, so each region's counts are the
+    differences of these cumulative counts at its start and end.
+
+    Returns two arrays: the GC and lowercase fractions of the regions.
+    """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    seq_len = index_record[0]
+    if len(ends) and ends.max() > seq_len:
+        bad = ends.argmax()
+        raise ValueError("Chromosome {} has length {} which requested range "
+                         "{}:{}-{} extends beyond"
+                         .format(chrom, seq_len, chrom, starts[bad],
+                                 ends[bad]))
+    # Cumulative counts of each class before each region boundary
+    bounds = np.unique(np.concatenate([starts, ends]))
+    cum_counts = np.zeros((3, len(bounds)), dtype=np.int64)
+    totals = np.zeros(3, dtype=np.int64)
+    for block_start, block in ngfrills.fasta_chrom_blocks(fa_fname,
+                                                          index_record):
+        if not len(bounds) or block_start >= bounds[-1]:
+            break
+        block_end = block_start + len(block)
+        first, last = bounds.searchsorted([block_start, block_end],
+                                          side='right')
+        offsets = bounds[first:last] - block_start - 1
+        classes = _BASE_CLASSES[block]
+        for i, cls in enumerate((_GC, _AT, _LOWER)):
+            counts = np.cumsum((classes & cls).astype(np.bool_),
+                               dtype=np.int64)
+            cum_counts[i, first:last] = totals[i] + counts[offsets]
+            totals[i] += counts[-1]
+    start_idx = bounds.searchsorted(starts)
+    end_idx = bounds.searchsorted(ends)
+    cnt_gc, cnt_at, cnt_lo = (cum_counts[:, end_idx] -
+                              cum_counts[:, start_idx])
+    tot = (cnt_gc + cnt_at).astype(np.float_)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac_gc = np.where(tot > 0, cnt_gc / tot, 0.0)
+        frac_lo = np.where(tot > 0, cnt_lo / tot, 0.0)
+    return frac_gc, frac_lo
 
 
 def calculate_gc_lo(subseq):
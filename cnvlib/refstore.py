@@ -0,0 +1,147 @@
+"""On-disk store of the normal samples' bias-corrected coverages in a reference.
+
+With this sidecar to a reference, normal samples can be added to or removed
+from the reference without reprocessing the others. The store is a directory
+with a set of files for each part of the reference (i.e. targets and
+antitargets):
+
+- ``<part>.bins.npz``: the bins, with the GC, RepeatMasker and edge-effect
+  values used to correct the samples, in the binary format (see `npz`).
+- ``<part>.log2``: the samples' corrected log2 values as a raw matrix of
+  doubles, one row per sample, after a first row of "flat" pseudocounts. New
+  samples are appended as rows, and the matrix is memory-mapped for reading.
+- ``<part>.json``: the sample IDs, in row order, and the options the samples
+  were corrected with.
+"""
+from __future__ import absolute_import, division
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from .gary import GenomicArray as GA
+
+FORMAT_VERSION = 1
+# Rows of the matrix to copy at a time when removing samples
+COPY_ROWS = 64
+
+
+def _paths(store_dir, part):
+    """File names of the bins, matrix and index of a part of the store."""
+    prefix = os.path.join(store_dir, part)
+    return prefix + '.bins.npz', prefix + '.log2', prefix + '.json'
+
+
+def has_part(store_dir, part):
+    """Check whether the store contains the given part."""
+    return os.path.isfile(_paths(store_dir, part)[2])
+
+
+def write_part(store_dir, part, bins, settings, sample_ids, coverages):
+    """Create or replace a part of the store.
+
+    `bins` is a GenomicArray of the bins and their per-bin correction values;
+    `settings` is a dict of the options used to correct the samples; and
+    `coverages` is a 2-D array of the flat pseudocounts and then each sample's
+    corrected log2 values, matching `sample_ids`.
+    """
+    bins_fname, matrix_fname, index_fname = _paths(store_dir, part)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    bins.write(bins_fname, 'npz')
+    with open(matrix_fname, 'wb') as handle:
+        np.ascontiguousarray(coverages, dtype=np.float_).tofile(handle)
+    _write_index(index_fname, settings, sample_ids, len(bins))
+    logging.info("Stored %d samples' corrected %s coverages in %s",
+                 len(sample_ids), part, store_dir)
+
+
+def read_part(store_dir, part):
+    """Read a part of the store.
+
+    Returns a tuple of: the bins (GenomicArray), the correction settings
+    (dict), the sample IDs (list), and the coverage matrix (memory-mapped
+    read-only, including the pseudocount row).
+    """
+    bins_fname, matrix_fname, index_fname = _paths(store_dir, part)
+    index = _read_index(index_fname)
+    bins = GA.read(bins_fname, compact=False)
+    shape = (len(index['samples']) + 1, index['bins'])
+    if shape[1]:
+        coverages = np.memmap(matrix_fname, dtype=np.float_, mode='r',
+                              shape=shape)
+    else:
+        coverages = np.zeros(shape)
+    return bins, index['settings'], index['samples'], coverages
+
+
+def append_samples(store_dir, part, sample_ids, coverages):
+    """Add samples' corrected coverages (one row each) to a part of the store.
+    """
+    _bins_fname, matrix_fname, index_fname = _paths(store_dir, part)
+    index = _read_index(index_fname)
+    duplicates = set(sample_ids).intersection(index['samples'])
+    if duplicates:
+        raise ValueError("Samples already in the reference store %s: %s"
+                         % (store_dir, ", ".join(sorted(duplicates))))
+    row_size = index['bins'] * np.dtype(np.float_).itemsize
+    with open(matrix_fname, 'r+b') as handle:
+        # Drop any rows left over from an interrupted update
+        handle.truncate((len(index['samples']) + 1) * row_size)
+        handle.seek(0, os.SEEK_END)
+        np.ascontiguousarray(coverages, dtype=np.float_).tofile(handle)
+    _write_index(index_fname, index['settings'],
+                 index['samples'] + list(sample_ids), index['bins'])
+    logging.info("Added %d samples to the %s in %s",
+                 len(sample_ids), part, store_dir)
+
+
+def remove_samples(store_dir, part, sample_ids):
+    """Remove samples from a part of the store, by sample ID."""
+    _bins_fname, matrix_fname, index_fname = _paths(store_dir, part)
+    bins, settings, stored_ids, coverages = read_part(store_dir, part)
+    missing = set(sample_ids).difference(stored_ids)
+    if missing:
+        raise ValueError("Samples not in the reference store %s: %s"
+                         % (store_dir, ", ".join(sorted(missing))))
+    # Keep the pseudocount row, then the other samples' rows
+    keep_rows = [0] + [i + 1 for i, sid in enumerate(stored_ids)
+                       if sid not in sample_ids]
+    fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=store_dir)
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            for i in range(0, len(keep_rows), COPY_ROWS):
+                coverages[keep_rows[i:i + COPY_ROWS]].tofile(handle)
+        del coverages
+        os.rename(tmp_fname, matrix_fname)
+    except:
+        os.remove(tmp_fname)
+        raise
+    _write_index(index_fname, settings,
+                 [sid for sid in stored_ids if sid not in sample_ids],
+                 len(bins))
+    logging.info("Removed %d samples from the %s in %s",
+                 len(sample_ids), part, store_dir)
+
+
+def _read_index(index_fname):
+    with open(index_fname) as handle:
+        index = json.load(handle)
+    if index.get('version') != FORMAT_VERSION:
+        raise ValueError("Unsupported reference store version in %s: %r"
+                         % (index_fname, index.get('version')))
+    return index
+
+
+def _write_index(index_fname, settings, sample_ids, nbins):
+    # Replace the index atomically, after the matrix is complete
+    tmp_fname = index_fname + '.tmp'
+    with open(tmp_fname, 'w') as handle:
+        json.dump({'version': FORMAT_VERSION,
+                   'bins': nbins,
+                   'samples': list(sample_ids),
+                   'settings': settings},
+                  handle, indent=1, sort_keys=True)
+    os.rename(tmp_fname, index_fname)
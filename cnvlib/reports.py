@@ -7,6 +7,8 @@ import collections
 import math
 import sys
 
+import numpy as np
+
 from . import metrics, params
 
 iteritems = (dict.iteritems if sys.version_info[0] < 3 else dict.items)
@@ -83,11 +85,24 @@ def gainloss_by_segment(probes, segments, threshold, skip_low=False):
     NB: Must shift sex-chromosome values beforehand with shift_xx,
     otherwise all chrX/chrY genes may be reported gained/lost.
     """
-    for segment, subprobes in probes.by_ranges(segments):
-        if abs(segment.log2) >= threshold:
-            for (gene, chrom, start, end, _coverage, nprobes
-                ) in group_by_genes(subprobes, skip_low):
-                yield (gene, chrom, start, end, segment.log2, nprobes)
+    seg_idx, bin_idx = probes.ranges_idx(segments)
+    seg_log2s = segments['log2'].values
+    # Only extract the probes within segments past the threshold
+    keep = (np.abs(seg_log2s) >= threshold)[seg_idx]
+    seg_idx = seg_idx[keep]
+    subprobes = probes.as_dataframe(probes.data.take(bin_idx[keep]))
+    # Group the probes by gene within each segment, as in group_by_genes
+    starts, ends, is_gene = subprobes._gene_runs(groups=seg_idx)
+    starts = starts[is_gene]
+    ends = ends[is_gene]
+    table = subprobes.data
+    for row in zip(table['gene'].values[starts],
+                   table['chromosome'].values[starts],
+                   table['start'].values[starts],
+                   table['end'].values[ends - 1],
+                   seg_log2s[seg_idx[starts]],
+                   ends - starts):
+        yield row
 
 
 # TODO consolidate with CNA.squash_genes
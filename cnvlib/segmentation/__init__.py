@@ -8,7 +8,7 @@ import tempfile
 import numpy as np
 import pandas as pd
 
-from .. import core, ngfrills, params, smoothing, vary
+from .. import core, metrics, ngfrills, params, smoothing, vary
 from ..cnary import CopyNumArray as CNA
 from . import cbs, flasso, haar
 
@@ -114,13 +114,15 @@ def transfer_names_weights(segments, cnarr, ignore=params.IGNORE_GENE_NAMES):
     Segment name is the comma-separated list of bin gene names.
     """
     ignore += ("Background",)
-    segnames = ['-'] * len(segments)
-    segweights = np.zeros(len(segments))
-    for i, (_seg, subprobes) in enumerate(cnarr.by_ranges(segments)):
-        segweights[i] = subprobes['weight'].sum()
-        subgenes = [g for g in pd.unique(subprobes['gene']) if g not in ignore]
-        if subgenes:
-            segnames[i] = ",".join(subgenes)
+    seg_idx, bin_idx = cnarr.ranges_idx(segments)
+    segweights = metrics.grouped_sum(cnarr['weight'].values[bin_idx], seg_idx,
+                                     len(segments))
+    genes = cnarr['gene'].values[bin_idx]
+    named = ~pd.Series(genes).isin(ignore).values
+    segnames = [",".join(subgenes) if subgenes else '-'
+                for subgenes in metrics.grouped_unique(genes[named],
+                                                       seg_idx[named],
+                                                       len(segments))]
     return segnames, segweights
 
 
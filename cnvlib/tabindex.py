@@ -0,0 +1,129 @@
+"""Byte offsets of each chromosome's rows in a tabular text file.
+
+For a file where each chromosome's rows are contiguous (e.g. sorted .cnr or
+.cns files), the offsets are kept in a small "sidecar" file next to it, named
+like the original with an extra ``.idx`` extension. With these, the rows of a
+single chromosome can be read by seeking directly to them, rather than parsing
+the whole file.
+
+The sidecar file is written on request along with the data file (see
+`write_index`), and is ignored once the data file's size or modification time
+changes. Without a current sidecar file, the offsets are just recalculated as
+needed; reading a file never writes anything next to it.
+"""
+from __future__ import absolute_import, division
+import collections
+import json
+import logging
+import os
+from io import BytesIO
+
+import pandas as pd
+
+INDEX_EXT = '.idx'
+INDEX_VERSION = 1
+
+
+def index_fname(fname):
+    return fname + INDEX_EXT
+
+
+def read_header(fname):
+    """Get the column names from the header line of a tabular file."""
+    with open(fname) as handle:
+        return handle.readline().rstrip('\r\n').split('\t')
+
+
+def chrom_offsets(fname):
+    """Get the byte offsets of each chromosome's rows in a tabular file.
+
+    Returns an ordered dict of {chromosome: (start_offset, end_offset)}, or
+    None if the chromosomes' rows are not contiguous in the file.
+    """
+    stat = os.stat(fname)
+    try:
+        with open(index_fname(fname)) as handle:
+            index = json.load(handle)
+        if (index['version'] == INDEX_VERSION and
+            index['size'] == stat.st_size and
+            index['mtime'] == stat.st_mtime):
+            return _as_offsets(index['chroms'])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return _as_offsets(scan_offsets(fname))
+
+
+def write_index(fname):
+    """Save the byte offsets of a tabular file's chromosomes in its sidecar.
+
+    If the sidecar file can't be written (e.g. in a read-only directory), just
+    log it and carry on.
+    """
+    idx_fname = index_fname(fname)
+    try:
+        stat = os.stat(fname)
+        index = {'version': INDEX_VERSION,
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime,
+                 'chroms': scan_offsets(fname)}
+        with open(idx_fname, 'w') as handle:
+            json.dump(index, handle)
+    except (IOError, OSError) as exc:
+        logging.debug("Can't write index %s: %s", idx_fname, exc)
+
+
+def scan_offsets(fname):
+    """Scan a tabular file (with a header line) for each chromosome's rows.
+
+    Returns a list of (chromosome, start_offset, end_offset), or None if the
+    chromosomes' rows are not contiguous.
+    """
+    chroms = []
+    seen = set()
+    with open(fname, 'rb') as handle:
+        offset = len(handle.readline())
+        curr_chrom = None
+        for line in handle:
+            chrom = line.split(b'\t', 1)[0].decode('utf-8')
+            if chrom != curr_chrom:
+                if chrom in seen:
+                    return None
+                seen.add(chrom)
+                chroms.append([chrom, offset, offset])
+                curr_chrom = chrom
+            offset += len(line)
+            chroms[-1][2] = offset
+    return chroms
+
+
+def read_chrom(fname, chrom, columns=None):
+    """Read only the rows of one chromosome from a tabular file.
+
+    Returns a pandas.DataFrame of the selected rows and `columns` (default:
+    all), or None if the rows could not be located through the index.
+    """
+    header = read_header(fname)
+    if not any(header):
+        # Blank file
+        return None
+    offsets = chrom_offsets(fname)
+    if offsets is None:
+        return None
+    usecols = ([col for col in header if col in columns]
+               if columns is not None else None)
+    start, end = offsets.get(chrom, (0, 0))
+    if end <= start:
+        return pd.DataFrame(columns=usecols or header)
+    with open(fname, 'rb') as handle:
+        handle.seek(start)
+        chunk = handle.read(end - start)
+    return pd.read_table(BytesIO(chunk), header=None, names=header,
+                         usecols=usecols, na_filter=False,
+                         dtype={'chromosome': str})
+
+
+def _as_offsets(chroms):
+    if chroms is None:
+        return None
+    return collections.OrderedDict((chrom, (start, end))
+                                   for chrom, start, end in chroms)
@@ -7,7 +7,7 @@ import numpy as np
 import pandas as pd
 import vcf
 
-from . import gary
+from . import gary, metrics
 
 
 class VariantArray(gary.GenomicArray):
@@ -329,9 +329,9 @@ def _allele_specific_copy_numbers(segarr, varr, ploidy=2):
     See: PSCBS, Bentsson et al. 2011
     """
     seg_depths = ploidy * np.exp2(segarr["log2"])
-    seg_bafs = np.asarray([(np.median(subvarr.mirrored_baf())
-                            if len(subvarr) else np.nan)
-                           for _seg, subvarr in varr.by_ranges(segarr)])
+    seg_idx, var_idx = varr.ranges_idx(segarr)
+    seg_bafs = metrics.grouped_median(np.asarray(varr.mirrored_baf())[var_idx],
+                                      seg_idx, len(segarr))
     cn1 = 0.5 * (1 - seg_bafs) * seg_depths
     cn2 = seg_depths - cn1
     # segout = segarr.copy()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+"""Benchmark the CNVkit coverage engine and core pipeline steps.
+
+Generates synthetic, coordinate-sorted BAM files with matching target and
+antitarget BED files for a few typical designs -- amplicon panel, exome, and
+whole-genome bins -- then times:
+
+- coverage.interval_coverages, in both count and pileup modes
+- reference.combine_probes
+- fix.load_adjust_coverages
+- segmentation.do_segmentation
+
+Results are printed as JSON, one record per line, with each step's run time,
+reads/sec and bins/sec, and the peak memory usage (RSS) of the benchmark
+process up to that point. Generated data is kept in the work directory and
+reused by later runs.
+
+Usage:
+
+    python benchmark.py -o results.jsonl
+    python benchmark.py amplicon exome --scale 0.1
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from cnvlib import commands, coverage, fix, reference, segmentation
+from cnvlib._version import __version__
+
+READ_LEN = 100
+
+# name: (chromosome lengths, #targets, target size, #reads, on-target fraction,
+#        avg. antitarget size)
+# WGS "targets" are fixed-size bins tiling the genome.
+PROFILES = {
+    'amplicon': ([20000000] * 4, 500, 150, 200000, .95, None),
+    'exome': ([25000000] * 8, 20000, 200, 1000000, .7, 100000),
+    'wgs': ([25000000] * 4, None, 5000, 1000000, 0., None),
+}
+
+
+def make_regions(profile, scale, rng):
+    """Create target and antitarget intervals for a design.
+
+    Returns two lists of (chrom, start, end, name) tuples, sorted.
+    """
+    chrom_sizes, ntargets, tgt_size, _nreads, _ontarget, anti_size = \
+            PROFILES[profile]
+    chrom_sizes = [int(size * scale) for size in chrom_sizes]
+    targets = []
+    antitargets = []
+    for i, chrom_size in enumerate(chrom_sizes):
+        chrom = 'chr%d' % (i + 1)
+        if ntargets is None:
+            # Tile the chromosome with bins
+            starts = np.arange(0, chrom_size - tgt_size + 1, tgt_size)
+        else:
+            n = max(1, int(ntargets * scale) // len(chrom_sizes))
+            # Evenly spaced slots, jittered, so targets never overlap
+            slot = chrom_size // n
+            starts = (np.arange(n) * slot +
+                      rng.randint(0, max(1, slot - tgt_size), n))
+        for j, start in enumerate(starts):
+            targets.append((chrom, int(start), int(start) + tgt_size,
+                            'G%d_%d' % (i + 1, j // 10)))
+        if anti_size:
+            # Split the gaps between targets into background bins
+            edges = np.r_[0, starts + tgt_size]
+            gap_ends = np.r_[starts, chrom_size]
+            for gap_start, gap_end in zip(edges + 150, gap_ends - 150):
+                if gap_end - gap_start < anti_size // 16:
+                    continue
+                nbins = int(np.ceil((gap_end - gap_start) / anti_size))
+                bounds = np.linspace(gap_start, gap_end, nbins + 1).astype(int)
+                for bin_start, bin_end in zip(bounds[:-1], bounds[1:]):
+                    antitargets.append((chrom, bin_start, bin_end,
+                                        'Background'))
+    return chrom_sizes, targets, antitargets
+
+
+def make_bam(bam_fname, chrom_sizes, targets, nreads, ontarget, rng):
+    """Write a coordinate-sorted, indexed BAM of simulated 100bp reads."""
+    n_on = int(nreads * ontarget) if targets else 0
+    n_off = nreads - n_on
+    chrom_names = ['chr%d' % (i + 1) for i in range(len(chrom_sizes))]
+    chrom_idx = []
+    positions = []
+    if n_on:
+        # Reads centered around targets
+        tgt_chrom = np.array([chrom_names.index(t[0]) for t in targets])
+        tgt_start = np.array([t[1] for t in targets])
+        tgt_end = np.array([t[2] for t in targets])
+        which = rng.randint(0, len(targets), n_on)
+        chrom_idx.append(tgt_chrom[which])
+        positions.append(rng.randint(tgt_start[which] - READ_LEN // 2,
+                                     tgt_end[which] - READ_LEN // 2))
+    if n_off:
+        # Uniform background
+        sizes = np.array(chrom_sizes)
+        which = rng.choice(len(sizes), n_off, p=sizes / sizes.sum())
+        chrom_idx.append(which)
+        positions.append((rng.random_sample(n_off) *
+                          (sizes[which] - READ_LEN)).astype(int))
+    chrom_idx = np.concatenate(chrom_idx)
+    positions = np.maximum(np.concatenate(positions), 0)
+    order = np.lexsort((positions, chrom_idx))
+    mapqs = np.where(rng.random_sample(nreads) < .05, 0, 60)
+
+    sam_fname = bam_fname[:-4] + '.sam'
+    seq = 'A' * READ_LEN
+    with open(sam_fname, 'w') as handle:
+        handle.write('@HD\tVN:1.4\tSO:coordinate\n')
+        for name, size in zip(chrom_names, chrom_sizes):
+            handle.write('@SQ\tSN:%s\tLN:%d\n' % (name, size))
+        for i, idx in enumerate(order):
+            handle.write('r%d\t0\t%s\t%d\t%d\t%dM\t*\t0\t0\t%s\t*\n'
+                         % (i, chrom_names[chrom_idx[idx]],
+                            positions[idx] + 1, mapqs[idx], READ_LEN, seq))
+    pysam.view('-b', '-o', bam_fname, sam_fname, catch_stdout=False)
+    os.remove(sam_fname)
+    pysam.index(bam_fname)
+
+
+def write_bed(fname, regions):
+    with open(fname, 'w') as handle:
+        for row in regions:
+            handle.write('%s\t%d\t%d\t%s\n' % row)
+
+
+def prepare(profile, scale, workdir):
+    """Generate (or reuse) the BAM and BED files for a design."""
+    base = os.path.join(workdir, '%s-x%g' % (profile, scale))
+    bam_fname = base + '.bam'
+    tgt_fname = base + '.target.bed'
+    anti_fname = base + '.antitarget.bed'
+    if not all(map(os.path.isfile, (bam_fname, tgt_fname, anti_fname))):
+        logging.info("Generating %s data in %s", profile, workdir)
+        rng = np.random.RandomState(0)
+        chrom_sizes, targets, antitargets = make_regions(profile, scale, rng)
+        write_bed(tgt_fname, targets)
+        write_bed(anti_fname, antitargets)
+        nreads = int(PROFILES[profile][3] * scale)
+        make_bam(bam_fname, chrom_sizes, targets, nreads,
+                 PROFILES[profile][4], rng)
+    return bam_fname, tgt_fname, anti_fname
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process (and its finished children)."""
+    # Linux reports kilobytes; Mac OS X reports bytes
+    unit = 1024 if sys.platform == 'darwin' else 1
+    usage = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / unit / 1024
+
+
+def timed(record, func, *args, **kwargs):
+    """Run a function, adding its run time and peak memory to `record`."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    elapsed = time.time() - start
+    record['seconds'] = round(elapsed, 4)
+    for key in ('reads', 'bins'):
+        if record.get(key):
+            record[key + '_per_sec'] = round(record[key] / elapsed, 1)
+    record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+
+def run_profile(profile, scale, workdir, nnormals, seg_method, emit):
+    bam_fname, tgt_fname, anti_fname = prepare(profile, scale, workdir)
+    nreads = coverage.bam_total_reads(bam_fname)
+    common = {'profile': profile, 'scale': scale,
+              'cnvkit_version': __version__,
+              'python': platform.python_version()}
+
+    # Coverage engines
+    raw = {}
+    for method, by_count in (('count', True), ('pileup', False)):
+        for bed_fname, kind in ((tgt_fname, 'target'),
+                                (anti_fname, 'antitarget')):
+            nbins = sum(1 for _line in open(bed_fname))
+            if not nbins:
+                # e.g. no antitargets; keep an empty array for 'fix'
+                raw[kind] = coverage.interval_coverages(bed_fname, bam_fname,
+                                                        by_count, 0)
+                continue
+            record = dict(common, step='interval_coverages', mode=method,
+                          regions=kind, reads=nreads, bins=nbins)
+            raw[kind] = timed(record, coverage.interval_coverages,
+                              bed_fname, bam_fname, by_count, 0)
+            emit(record)
+
+    # Simulated normal samples, for the reference
+    rng = np.random.RandomState(1)
+    cnn_fnames = {}
+    for kind, cnarr in raw.items():
+        if not len(cnarr):
+            continue
+        cnn_fnames[kind] = []
+        for i in range(nnormals):
+            normal = cnarr.copy()
+            normal['log2'] += rng.normal(0, .1, len(normal))
+            fname = os.path.join(workdir, '%s-x%g-normal%d.%s.cnn'
+                                 % (profile, scale, i, kind))
+            normal.write(fname)
+            cnn_fnames[kind].append(fname)
+
+    refs = {}
+    for kind in sorted(cnn_fnames):
+        record = dict(common, step='combine_probes', regions=kind,
+                      samples=nnormals, bins=len(raw[kind]))
+        refs[kind] = timed(record, reference.combine_probes,
+                           cnn_fnames[kind], None, False, kind == 'target',
+                           False, kind == 'target', False)
+        emit(record)
+    ref_probes = refs['target']
+    if 'antitarget' in refs:
+        ref_probes.add(refs['antitarget'])
+    ref_probes.center_all(skip_low=True)
+
+    for kind in sorted(cnn_fnames):
+        record = dict(common, step='load_adjust_coverages', regions=kind,
+                      bins=len(raw[kind]))
+        timed(record, fix.load_adjust_coverages, raw[kind], ref_probes,
+              kind == 'target', False, kind == 'target', False)
+        emit(record)
+
+    cnarr = commands.do_fix(raw['target'], raw['antitarget'], ref_probes,
+                            do_gc=False, do_rmask=False)
+    record = dict(common, step='do_segmentation', mode=seg_method,
+                  bins=len(cnarr))
+    timed(record, segmentation.do_segmentation, cnarr, seg_method)
+    emit(record)
+
+
+def main():
+    AP = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    AP.add_argument('profiles', nargs='*', metavar='PROFILE',
+                    help="""Designs to benchmark: %s. [Default: all]"""
+                         % ', '.join(sorted(PROFILES)))
+    AP.add_argument('-s', '--scale', type=float, default=1.0,
+                    help="""Scale the genome size, number of targets and
+                    number of reads by this factor. [Default: %(default)s]""")
+    AP.add_argument('-n', '--normals', type=int, default=5,
+                    help="""Number of (simulated) normal samples to combine
+                    into a reference. [Default: %(default)s]""")
+    AP.add_argument('-m', '--seg-method', default='haar',
+                    help="Segmentation method. [Default: %(default)s]")
+    AP.add_argument('-d', '--workdir', default='build/benchmark',
+                    help="""Directory for the generated data, which is reused
+                    if it already exists. [Default: %(default)s]""")
+    AP.add_argument('-o', '--output',
+                    help="Append results to this file. [Default: stdout]")
+    args = AP.parse_args()
+    for profile in args.profiles:
+        if profile not in PROFILES:
+            AP.error("Unknown profile %r" % profile)
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    out_handle = open(args.output, 'a') if args.output else sys.stdout
+
+    def emit(record):
+        out_handle.write(json.dumps(record, sort_keys=True) + '\n')
+        out_handle.flush()
+
+    for profile in (args.profiles or sorted(PROFILES)):
+        run_profile(profile, args.scale, args.workdir, args.normals,
+                    args.seg_method, emit)
+    if args.output:
+        out_handle.close()
+
+
+if __name__ == '__main__':
+    main()
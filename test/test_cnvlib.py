@@ -3,18 +3,40 @@
 """Unit tests for the CNVkit library, cnvlib."""
 from __future__ import absolute_import, division, print_function
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
+import pandas as pd
 # from Bio._py3k import StringIO
 
 import cnvlib
 # Import all modules as a smoke test
-from cnvlib import (access, antitarget, commands, core, coverage, diagram,
-                    export, fix, importers, metrics, ngfrills, params, plots,
+from cnvlib import (access, antitarget, commands, core, covcache, coverage,
+                    diagram, export, fix, importers, metrics, ngfrills,
+                    params, plots,
                     reference, reports, segmentation, smoothing,
                     gary, cnary, vary, rary)
 
+# Scratch directory for the files written by tests
+TMPDIR = None
+
+
+def setUpModule():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp(prefix='cnvkit-test-')
+
+
+def tearDownModule():
+    shutil.rmtree(TMPDIR)
+
+
+def make_tmpdir():
+    """Create an empty directory for a test, removed after all tests."""
+    return tempfile.mkdtemp(dir=TMPDIR)
+
 
 class GaryTests(unittest.TestCase):
 
@@ -43,6 +65,52 @@ class GaryTests(unittest.TestCase):
         self.ex_cnr[3, 'log2'] = -10.0
         self.assertNotEqual(tuple(self.ex_cnr[3]), tuple(dupe[3]))
 
+    def test_views(self):
+        """Slices share data with the original until written."""
+        orig_log2 = self.ex_cnr['log2'].copy()
+        view = self.ex_cnr[10:20]
+        self.assertEqual(list(view['log2']), list(orig_log2[10:20]))
+        view['log2'] = 0.0
+        self.assertTrue((view['log2'] == 0).all())
+        self.assertEqual(list(self.ex_cnr['log2']), list(orig_log2))
+        for _chrom, subarr in self.ex_cnr.by_chromosome():
+            subarr['log2'] -= 1
+        self.assertEqual(list(self.ex_cnr['log2']), list(orig_log2))
+        wider = self.ex_cnr.add_columns(weight=1.0)
+        wider['log2'] = 0.0
+        self.assertNotIn('weight', self.ex_cnr)
+        self.assertEqual(list(self.ex_cnr['log2']), list(orig_log2))
+        # Shared columns are read-only, and reading them doesn't copy
+        view = self.ex_cnr[10:20]
+        self.assertTrue(np.may_share_memory(view['log2'].values,
+                                            self.ex_cnr['log2'].values))
+        with self.assertRaises(ValueError):
+            view['log2'].values[0] = 1.0
+        with self.assertRaises(ValueError):
+            view.start.values[0] = 1
+        # Writing through the data table copies it
+        view.data.loc[:, 'log2'] = 1.0
+        self.assertEqual(list(self.ex_cnr['log2']), list(orig_log2))
+        # Writing to the original array doesn't change its views either
+        view = self.ex_cnr[10:20]
+        chrom, chrom_arr = next(iter(self.ex_cnr.by_chromosome()))
+        chrom_log2 = list(chrom_arr['log2'])
+        region = self.ex_cnr.in_range(chrom, 0, chrom_arr.end.iat[-1])
+        self.ex_cnr['log2'] += 5
+        self.assertEqual(list(view['log2']), list(orig_log2[10:20]))
+        view = self.ex_cnr[10:20]
+        self.ex_cnr['log2'] = np.zeros(len(self.ex_cnr))
+        self.assertEqual(list(view['log2']), list(orig_log2[10:20] + 5))
+        view = self.ex_cnr[10:20]
+        self.ex_cnr.data['log2'] += 1
+        self.assertTrue((view['log2'] == 0).all())
+        self.assertEqual(list(chrom_arr['log2']), chrom_log2)
+        self.assertEqual(list(region['log2']), chrom_log2)
+        self.assertTrue((self.ex_cnr['log2'] == 1).all())
+        # Once the views are gone, the original no longer shares its data
+        del view, chrom_arr, region
+        self.assertFalse(self.ex_cnr._shared)
+
     def test_autosomes(self):
         """Test selection of autosomes."""
         len_all = len(self.ex_cnr)
@@ -64,6 +132,25 @@ class GaryTests(unittest.TestCase):
             for _chrom, rows in cnarr.by_chromosome():
                 row_count += len(rows)
             self.assertEqual(row_count, len(cnarr))
+        # Sorted: the chromosome index gives views of each chromosome's rows
+        chroms = list(pd.unique(cnarr.chromosome))
+        for chrom, rows in cnarr.by_chromosome():
+            self.assertTrue((rows.chromosome == chrom).all())
+            self.assertEqual(rows[0, 'start'],
+                             cnarr.in_range(chrom)[0, 'start'])
+            self.assertTrue(np.may_share_memory(rows['end'].values,
+                                                cnarr['end'].values))
+        self.assertEqual([c for c, _r in cnarr.by_chromosome()], chroms)
+        # Unsorted: the index is rebuilt, and rows are grouped as before
+        cnarr.shuffle()
+        row_counts = dict((chrom, len(rows))
+                          for chrom, rows in cnarr.by_chromosome())
+        self.assertEqual(sorted(row_counts), sorted(chroms))
+        self.assertEqual(sum(row_counts.values()), len(cnarr))
+        cnarr.sort()
+        self.assertEqual([c for c, _r in cnarr.by_chromosome()], chroms)
+        cnarr['chromosome'] = 'chrZ'
+        self.assertEqual([c for c, _r in cnarr.by_chromosome()], ['chrZ'])
 
     # def test_concat(self):
 
@@ -100,6 +187,60 @@ class GaryTests(unittest.TestCase):
                 subarr.in_ranges(starts=subsegarr['start'],
                                  ends=subsegarr['end'], mode="trim")))
 
+    def test_ranges_idx(self):
+        """Vectorized range matching agrees with by_ranges."""
+        cnarr = cnvlib.read("formats/amplicon.cnr")
+        segarr = cnvlib.read("formats/amplicon.cns")
+        for mode in ('inner', 'outer'):
+            seg_idx, bin_idx = cnarr.ranges_idx(segarr, mode)
+            expect = [list(bins.start)
+                      for _seg, bins in cnarr.by_ranges(segarr, mode)]
+            bounds = seg_idx.searchsorted(np.arange(len(segarr) + 1))
+            got = [list(cnarr.start.values[bin_idx[lo:hi]])
+                   for lo, hi in zip(bounds[:-1], bounds[1:])]
+            self.assertEqual(got, expect)
+        # Only the rows are matched, so there's nothing to trim
+        with self.assertRaises(ValueError):
+            cnarr.ranges_idx(segarr, 'trim')
+        seg_ids = cnarr.segment_ids(segarr)
+        self.assertEqual(len(seg_ids), len(cnarr))
+        self.assertEqual(list(np.bincount(seg_ids[seg_ids >= 0],
+                                          minlength=len(segarr))),
+                         list(segarr['probes']))
+
+    def test_overlaps(self):
+        """Overlap queries are exact when the intervals overlap each other."""
+        rng = np.random.RandomState(0)
+        starts = np.sort(rng.randint(0, 10000, 300))
+        ends = starts + rng.randint(1, 2000, 300)
+        regions = gary.GenomicArray.from_columns({"chromosome": "chr1",
+                                                  "start": starts,
+                                                  "end": ends})
+        query_starts = rng.randint(0, 10000, 50)
+        query_ends = query_starts + rng.randint(0, 1000, 50)
+        for mode in ('inner', 'outer'):
+            query_idx, row_idx = regions.overlaps_idx("chr1", query_starts,
+                                                      query_ends, mode)
+            for i, (qs, qe) in enumerate(zip(query_starts, query_ends)):
+                if mode == 'inner':
+                    expect = (starts >= qs) & (ends <= qe)
+                else:
+                    expect = (starts < qe) & (ends > qs)
+                self.assertEqual(list(row_idx[query_idx == i]),
+                                 list(np.flatnonzero(expect)))
+        # Bins with several overlapping values get the median
+        bins = gary.GenomicArray.from_columns({"chromosome": "chr1",
+                                               "start": query_starts,
+                                               "end": query_ends})
+        regions["value"] = np.arange(len(regions), dtype=float)
+        values = bins.match_to_bins(regions, "value", np.nan)
+        for i, (qs, qe) in enumerate(zip(query_starts, query_ends)):
+            hits = np.flatnonzero((starts < qe) & (ends > qs))
+            if len(hits):
+                self.assertEqual(values[i], np.median(hits))
+            else:
+                self.assertTrue(np.isnan(values[i]))
+
     def test_select(self):
         """Test sugary selection of a subset of the data array."""
         num_bg_rows = len(self.ex_cnr[self.ex_cnr['gene'] == 'Background'])
@@ -107,6 +248,21 @@ class GaryTests(unittest.TestCase):
                          num_bg_rows)
         selector = lambda row: row['gene'] == 'Background'
         self.assertEqual(len(self.ex_cnr.select(selector)), num_bg_rows)
+        self.assertEqual(len(self.ex_cnr.select("gene == 'Background'")),
+                         num_bg_rows)
+        # Row-wise only
+        selector = lambda row: row['gene'] in ('Background',)
+        self.assertEqual(len(self.ex_cnr.select(selector)), num_bg_rows)
+
+    def test_labels(self):
+        """Label rows by coordinates, optionally with other columns."""
+        labels = self.ex_cnr.labels()
+        self.assertEqual(labels.iat[0], self.ex_cnr.row2label(self.ex_cnr[0]))
+        self.assertEqual(list(labels[:50]),
+                         [self.ex_cnr.row2label(row)
+                          for row in self.ex_cnr[:50]])
+        self.assertEqual(self.ex_cnr.labels('gene').iat[0],
+                         labels.iat[0] + ':' + self.ex_cnr[0, 'gene'])
 
     def test_shuffle_sort(self):
         """Test shuffling and re-sorting the data array."""
@@ -116,6 +272,14 @@ class GaryTests(unittest.TestCase):
         self.assertNotEqual(tuple(self.ex_cnr['log2'][:10]), orig_cvg)
         self.ex_cnr.sort()
         self.assertEqual(tuple(self.ex_cnr['log2'][:10]), orig_cvg)
+        # Chromosomes in natural order, then by start and end
+        garr = gary.GenomicArray.from_rows(
+            [("chr10", 5, 9), ("chrX", 1, 2), ("chr2", 5, 6), ("chr2", 1, 8),
+             ("chr2", 1, 3)])
+        garr.sort()
+        self.assertEqual(list(garr.coords()),
+                         [("chr2", 1, 3), ("chr2", 1, 8), ("chr2", 5, 6),
+                          ("chr10", 5, 9), ("chrX", 1, 2)])
 
 
 
@@ -145,7 +309,35 @@ class CNATests(unittest.TestCase):
         self.assertEqual(tuple(self.ex_cnr[0]), tuple(same[0]))
         self.assertEqual(self.ex_cnr[3:6], same[3:6])
 
-    # def test_by_gene(self):
+    def test_by_gene(self):
+        """Group bins by gene, with Background bins between genes."""
+        cnarr = cnary.CopyNumArray.from_rows(
+            [("chr1", 0, 10, "Background", 0.0),
+             ("chr1", 10, 20, "A", 1.0),
+             ("chr1", 20, 30, "Background", 0.0),
+             ("chr1", 30, 40, "A", 3.0),
+             ("chr1", 40, 50, "B", 2.0),
+             ("chr1", 50, 60, "Background", 0.0),
+             ("chr2", 0, 10, "B", 1.0),
+             ("chr2", 10, 20, "Background", 0.0),
+             ("chr2", 20, 30, "Background", 0.0)])
+        self.assertEqual([(name, len(rows)) for name, rows in cnarr.by_gene()],
+                         [("Background", 1), ("A", 3), ("B", 1),
+                          ("Background", 1), ("B", 1), ("Background", 2)])
+        squashed = cnarr.squash_genes(summary_func=np.median)
+        self.assertEqual(list(squashed['gene']),
+                         ["Background", "A", "B", "Background", "B",
+                          "Background", "Background"])
+        self.assertEqual(list(squashed['end']), [10, 40, 50, 60, 10, 20, 30])
+        self.assertEqual(list(squashed['log2']),
+                         [0.0, 1.0, 2.0, 0.0, 1.0, 0.0, 0.0])
+        squashed = cnarr.squash_genes(squash_background=True)
+        self.assertEqual(len(squashed), 6)
+        self.assertEqual(squashed[5, 'end'], 30)
+        # No named genes at all
+        bg_only = cnarr[cnarr['gene'] == "Background"]
+        self.assertEqual([(name, len(rows)) for name, rows in bg_only.by_gene()],
+                         [("Background", 3), ("Background", 2)])
 
     def test_center_all(self):
         """Test recentering."""
@@ -202,6 +394,104 @@ class CNATests(unittest.TestCase):
 
     # def test_squash_genes(self):
 
+    def test_npz(self):
+        """Write and read back the binary format."""
+        fname = os.path.join(make_tmpdir(), "reference-tr.cnn.npz")
+        self.ex_cnr.meta['mapped_reads'] = 12345
+        self.ex_cnr.write(fname, 'npz')
+        cnarr = cnvlib.read(fname)
+        self.assertEqual(len(cnarr), len(self.ex_cnr))
+        self.assertEqual(list(cnarr.data.columns),
+                         list(self.ex_cnr.data.columns))
+        for col in cnarr.data.columns:
+            self.assertEqual(list(cnarr[col]), list(self.ex_cnr[col]))
+        self.assertEqual(cnarr.meta['mapped_reads'], 12345)
+        self.assertEqual(cnarr.sample_id, "reference-tr")
+        self.assertEqual(cnarr.chromosome.unique().tolist(),
+                         [c for c, _arr in cnarr.by_chromosome()])
+        # The loaded table is writable and independent of the file
+        cnarr['log2'] = 0.0
+        self.assertEqual(list(cnvlib.read(fname)['log2']),
+                         list(self.ex_cnr['log2']))
+        # Empty arrays too
+        self.ex_cnr[:0].write(fname, 'npz')
+        self.assertEqual(len(cnvlib.read(fname)), 0)
+        # File names need the .npz extension
+        with self.assertRaises(ValueError):
+            self.ex_cnr.write(fname[:-4], 'npz')
+        self.assertEqual(commands._cna_fname("x.cnr", 'npz'), "x.cnr.npz")
+        self.assertEqual(commands._cna_fname("x.cnr.npz", 'npz'), "x.cnr.npz")
+        self.assertEqual(commands._cna_fname("x.cnr", 'tab'), "x.cnr")
+
+    def test_read_region(self):
+        """Read selected columns and regions."""
+        tmpdir = make_tmpdir()
+        full = cnvlib.read("formats/amplicon.cnr")
+        tab_fname = os.path.join(tmpdir, "amplicon.cnr")
+        npz_fname = os.path.join(tmpdir, "amplicon.npz")
+        shutil.copy("formats/amplicon.cnr", tab_fname)
+        full.write(npz_fname, 'npz')
+        for fname in (tab_fname, npz_fname):
+            cnarr = cnvlib.cnary.CopyNumArray.read(fname, columns=['weight'])
+            self.assertEqual(list(cnarr.data.columns),
+                             ['chromosome', 'start', 'end', 'gene',
+                              'log2', 'weight'])
+            for region in ('chr7', ('chr7', 55000000, 56000000),
+                           ('chr17', None, 8000000), 'chrFake'):
+                expect = (full.in_range(region, mode='outer')
+                          if isinstance(region, str) else
+                          full.in_range(*region, mode='outer'))
+                cnarr = cnvlib.cnary.CopyNumArray.read(fname, region=region)
+                self.assertEqual(cnarr.sample_id, "amplicon")
+                self.assertEqual(list(cnarr.start), list(expect.start))
+                self.assertEqual(list(cnarr.log2), list(expect.log2))
+        # Only writing the text file with `index` saves an index
+        self.assertFalse(os.path.isfile(tab_fname + '.idx'))
+        full.write(tab_fname)
+        self.assertFalse(os.path.isfile(tab_fname + '.idx'))
+        full.write(tab_fname, index=True)
+        self.assertTrue(os.path.isfile(tab_fname + '.idx'))
+        cnarr = cnvlib.cnary.CopyNumArray.read(tab_fname, region='chr7')
+        self.assertEqual(list(cnarr.start),
+                         list(full.in_range('chr7', mode='outer').start))
+
+    def test_compact(self):
+        """Compact dtypes on request, kept through operations."""
+        cnarr = cnvlib.read('formats/reference-tr.cnn', compact=True)
+        self.assertEqual(cnarr['start'].dtype, np.int32)
+        self.assertEqual(cnarr['log2'].dtype, np.float32)
+        self.assertTrue(hasattr(cnarr['gene'], 'cat'))
+        full = self.ex_cnr
+        self.assertEqual(full['start'].dtype, np.int64)
+        self.assertEqual(full['log2'].dtype, np.float64)
+        self.assertTrue(np.allclose(full['log2'], cnarr['log2']))
+        self.assertEqual(list(full['gene']), list(cnarr['gene']))
+        joined = cnarr.concat([cnarr[:10], cnarr[-10:]])
+        self.assertTrue(hasattr(joined['gene'], 'cat'))
+        self.assertEqual(joined['end'].dtype, np.int32)
+        weighted = cnarr.add_columns(weight=np.ones(len(cnarr)))
+        self.assertEqual(weighted['weight'].dtype, np.float32)
+        # Coordinates taken from rows are 32-bit scalars
+        row = cnarr[100]
+        self.assertEqual(len(cnarr.in_range(row.chromosome, row.start,
+                                            row.end, mode='outer')), 1)
+        # Grouped, selected and sorted by chromosome name, as at full precision
+        self.assertEqual([(chrom, len(arr))
+                          for chrom, arr in cnarr.by_chromosome()],
+                         [(chrom, len(arr))
+                          for chrom, arr in full.by_chromosome()])
+        self.assertEqual(len(cnarr.in_range('chr7', 140000000, 150000000)),
+                         len(full.in_range('chr7', 140000000, 150000000)))
+        cnarr.shuffle()
+        self.assertEqual(sorted((chrom, len(arr))
+                                for chrom, arr in cnarr.by_chromosome()),
+                         sorted((chrom, len(arr))
+                                for chrom, arr in full.by_chromosome()))
+        cnarr.sort()
+        full.sort()
+        self.assertEqual(list(cnarr.chromosome), list(full.chromosome))
+        self.assertEqual(list(cnarr.start), list(full.start))
+
 
 
 class RATests(unittest.TestCase):
@@ -232,6 +522,26 @@ class RATests(unittest.TestCase):
 class ImporterTests(unittest.TestCase):
     """Tests for importers functionality."""
 
+    def test_import_depth(self):
+        """Test summarizing a bedGraph of read depths in bins."""
+        bed_fnames = ("formats/synthetic.target.bed",
+                      "formats/synthetic.antitarget.bed")
+        # Per-base depths from 'samtools depth -a' on the same BAM
+        imported = importers.import_depth("formats/synthetic.bedGraph.gz",
+                                          bed_fnames)
+        expected = commands.do_coverages(bed_fnames, "formats/synthetic.bam")
+        for cnarr, expect in zip(imported, expected):
+            self.assertEqual(cnarr.sample_id, expect.sample_id)
+            self.assertEqual(list(cnarr["gene"]), list(expect["gene"]))
+            self.assertTrue(np.allclose(cnarr["log2"], expect["log2"]))
+        # Partial overlaps, gaps, empty and unsorted bins
+        counts = importers.depth_basecounts(np.array([10, 20, 40]),
+                                            np.array([20, 30, 50]),
+                                            np.array([1., 2., 4.]),
+                                            np.array([40, 0, 15, 25, 35]),
+                                            np.array([45, 100, 15, 45, 60]))
+        self.assertEqual(list(counts), [20, 70, 0, 30, 40])
+
     def test_import_picard(self):
         """Test loading a Picard targetcoverage file."""
         fname = 'picard/p2-5_5.antitargetcoverage.csv'
@@ -343,6 +653,118 @@ class CommandTests(unittest.TestCase):
                               is_sample_female=sample_is_f)
             test_chrom_means(cns_p99)
 
+    def test_coverage(self):
+        """The 'coverage' command."""
+        bam_fname = "formats/synthetic.bam"
+        bed_fnames = ("formats/synthetic.target.bed",
+                      "formats/synthetic.antitarget.bed")
+        for by_count in (False, True):
+            # One pass over both BEDs matches separate runs
+            multi = commands.do_coverages(bed_fnames, bam_fname, by_count)
+            self.assertEqual(len(multi), 2)
+            self.assertEqual(multi[0].meta["mapped_reads"], 3666)
+            self.assertEqual(multi[1].meta["unmapped_reads"], 0)
+            for bed_fname, cnarr in zip(bed_fnames, multi):
+                single = commands.do_coverage(bed_fname, bam_fname, by_count)
+                self.assertEqual(len(cnarr), len(single))
+                self.assertEqual(list(cnarr["gene"]), list(single["gene"]))
+                self.assertEqual(list(cnarr.start), list(single.start))
+                self.assertTrue((cnarr["log2"] == single["log2"]).all())
+                # Sharded across processes matches serial
+                sharded = commands.do_coverage(bed_fname, bam_fname, by_count,
+                                               processes=2)
+                self.assertEqual(list(sharded.end), list(single.end))
+                self.assertTrue((sharded["log2"] == single["log2"]).all())
+
+    def test_coverage_cram(self):
+        """The 'coverage' command on a CRAM file."""
+        import pysam
+        bam_fname = "formats/synthetic.bam"
+        bed_fname = "formats/synthetic.target.bed"
+        tmpdir = make_tmpdir()
+        # Make up a reference genome and convert the BAM to CRAM
+        fa_fname = os.path.join(tmpdir, "ref.fa")
+        bases = np.array(list("ACGT"))
+        rng = np.random.RandomState(0)
+        with open(fa_fname, 'w') as handle:
+            for chrom, length in (("chr1", 60000), ("chr2", 40000)):
+                seq = ''.join(bases[rng.randint(0, 4, length)])
+                handle.write(">%s\n" % chrom)
+                for i in range(0, length, 60):
+                    handle.write(seq[i:i+60] + "\n")
+        cram_fname = os.path.join(tmpdir, "synthetic.cram")
+        pysam.view("-C", "-T", fa_fname, "-o", cram_fname, bam_fname,
+                   catch_stdout=False)
+        for by_count in (False, True):
+            expect = commands.do_coverage(bed_fname, bam_fname, by_count)
+            cnarr = commands.do_coverage(bed_fname, cram_fname, by_count,
+                                         fasta=fa_fname)
+            self.assertTrue((cnarr["log2"] == expect["log2"]).all())
+        # Decode with the shared cache of reference sequences
+        cache_dir = os.path.join(tmpdir, "refcache")
+        ngfrills.ensure_ref_cache(fa_fname, cache_dir)
+        os.rename(fa_fname, fa_fname + ".moved")
+        orig_env = [os.environ.get(key) for key in ngfrills.REF_VARS]
+        cnarr = commands.do_coverage(bed_fname, cram_fname, True,
+                                     processes=2, ref_cache=cache_dir)
+        self.assertTrue((cnarr["log2"] == expect["log2"]).all())
+        # The environment is only changed while reading the CRAM file
+        self.assertEqual([os.environ.get(key) for key in ngfrills.REF_VARS],
+                         orig_env)
+
+    def test_coverage_subsample(self):
+        """The 'coverage' command with read subsampling."""
+        bam_fname = "formats/synthetic.bam"
+        bed_fname = "formats/synthetic.antitarget.bed"
+        full = commands.do_coverage(bed_fname, bam_fname, by_count=True)
+        same = commands.do_coverage(bed_fname, bam_fname, subsample=1.0)
+        self.assertTrue((full["log2"] == same["log2"]).all())
+        half = commands.do_coverage(bed_fname, bam_fname, subsample=.5)
+        self.assertEqual(len(half), len(full))
+        # Deterministic, and close to the full-depth estimate
+        self.assertTrue((half["log2"] == commands.do_coverage(
+            bed_fname, bam_fname, subsample=.5)["log2"]).all())
+        self.assertLess(np.abs(half["log2"] - full["log2"]).max(), .5)
+        self.assertRaises(ValueError, commands.do_coverage, bed_fname,
+                          bam_fname, subsample=0)
+
+    def test_coverage_cache(self):
+        """The 'coverage' command with a coverage cache."""
+        bam_fname = "formats/synthetic.bam"
+        bed_fnames = ("formats/synthetic.target.bed",
+                      "formats/synthetic.antitarget.bed")
+        cache_dir = make_tmpdir()
+        fresh = commands.do_coverages(bed_fnames, bam_fname,
+                                      cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        cached = commands.do_coverages(bed_fnames, bam_fname,
+                                       cache_dir=cache_dir)
+        for cnarr, cached_arr in zip(fresh, cached):
+            self.assertEqual(cached_arr.sample_id, "synthetic")
+            # Stored exactly
+            self.assertEqual(cnarr.data.to_dict('list'),
+                             cached_arr.data.to_dict('list'))
+        # A damaged entry is recalculated
+        entry_fname = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        with open(entry_fname, 'r+b') as handle:
+            handle.truncate(100)
+        recalc = commands.do_coverages(bed_fnames, bam_fname,
+                                       cache_dir=cache_dir)
+        self.assertEqual([len(cnarr) for cnarr in recalc],
+                         [len(cnarr) for cnarr in fresh])
+        self.assertGreater(os.path.getsize(entry_fname), 100)
+        # Different options are cached separately
+        commands.do_coverage(bed_fnames[0], bam_fname, by_count=True,
+                             cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+        # Only the most recently used entry fits in a tiny cache
+        os.environ[covcache.CACHE_SIZE_VAR] = '1e-9'
+        try:
+            covcache.evict(cache_dir)
+        finally:
+            del os.environ[covcache.CACHE_SIZE_VAR]
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
     def test_export(self):
         """Run the 'export' command with each format."""
         # SEG
@@ -398,6 +820,17 @@ class CommandTests(unittest.TestCase):
         segs = cnvlib.read("formats/amplicon.cns")
         rows = commands.do_gainloss(probes, segs, True, 0.3, 4)
         self.assertGreater(len(rows), 0)
+        # Genes are grouped within each segment past the threshold
+        expect = []
+        for segment, bins in probes.by_ranges(segs):
+            if abs(segment.log2) >= 0.3:
+                expect.extend((gene, start, end, segment.log2, nprobes)
+                              for gene, _chrom, start, end, _mean, nprobes
+                              in reports.group_by_genes(bins, False))
+        got = [(gene, start, end, log2, nprobes)
+               for gene, _chrom, start, end, log2, nprobes
+               in reports.gainloss_by_segment(probes, segs, 0.3)]
+        self.assertEqual(got, expect)
 
     def test_import_theta(self):
         """The 'import-theta' command."""
@@ -415,17 +848,110 @@ class CommandTests(unittest.TestCase):
         values = metrics.ests_of_scale(resids)
         for val in values:
             self.assertGreater(val, 0)
+        # Column-wise estimators match the 1-D versions
+        table = np.random.RandomState(0).normal(size=(20, 50))
+        table[3, 7] = 50.0
+        for func in (metrics.biweight_location, metrics.biweight_midvariance,
+                     metrics.median_absolute_deviation):
+            self.assertTrue(np.allclose(
+                func(table, axis=0),
+                [func(table[:, i]) for i in range(table.shape[1])]))
+        centers, spreads = reference.summarize_bin_coverages(table,
+                                                             chunk_bins=16)
+        self.assertTrue(np.allclose(centers,
+                                    metrics.biweight_location(table, axis=0)))
+        self.assertTrue(np.allclose(spreads,
+                                    metrics.biweight_midvariance(table,
+                                                                 axis=0)))
 
     def test_reference(self):
         """The 'reference' command."""
         # Empty antitargets
         ref = commands.do_reference(["formats/amplicon.cnr"], ["formats/empty"])
         self.assertGreater(len(ref), 0)
+        in_mem = commands.do_reference(["formats/amplicon.cnr"] * 3,
+                                       ["formats/empty"] * 3)
+        # Samples loaded and corrected in parallel: same result
+        parallel = commands.do_reference(["formats/amplicon.cnr"] * 3,
+                                         ["formats/empty"] * 3, processes=2)
+        self.assertTrue((in_mem['log2'] == parallel['log2']).all())
+        self.assertTrue((in_mem['spread'] == parallel['spread']).all())
+        # Out-of-core: same result from a disk-backed matrix, in bin chunks
+        on_disk = commands.do_reference(["formats/amplicon.cnr"] * 3,
+                                        ["formats/empty"] * 3,
+                                        max_memory=1000)
+        self.assertTrue((in_mem['log2'] == on_disk['log2']).all())
+        self.assertTrue((in_mem['spread'] == on_disk['spread']).all())
         # Empty antitargets, flat reference
         ref = commands.do_reference_flat("formats/amplicon.bed",
                                          "formats/empty")
         self.assertGreater(len(ref), 0)
 
+    def test_fasta_stats(self):
+        """GC and RepeatMasker content of bins, from a FASTA file."""
+        tmpdir = make_tmpdir()
+        bases = np.array(list("ACGTacgtN"))
+        rng = np.random.RandomState(0)
+        seqs = {}
+        for chrom, length in (("chr1", 10007), ("chr2", 4980)):
+            seqs[chrom] = ''.join(bases[rng.randint(0, 9, length)])
+        starts = np.arange(0, 4900, 70)
+        bins = cnary.CopyNumArray.from_columns({
+            "chromosome": ["chr1"] * len(starts) + ["chr2"] * len(starts),
+            "start": np.concatenate([starts, starts]),
+            "end": np.concatenate([starts + 100, starts + 100]),
+            "gene": "-",
+            "log2": 0.0})
+        # Whole last line, with and without the final EOL
+        for last_eol in ("\n", ""):
+            fa_fname = os.path.join(tmpdir, "ref%d.fa" % len(last_eol))
+            with open(fa_fname, 'w') as handle:
+                for chrom in ("chr1", "chr2"):
+                    lines = [seqs[chrom][i:i+60]
+                             for i in range(0, len(seqs[chrom]), 60)]
+                    handle.write(">%s\n" % chrom + "\n".join(lines))
+                    handle.write("\n" if chrom == "chr1" else last_eol)
+            for processes in (1, 2):
+                gc, rmask = reference.get_fasta_stats(bins, fa_fname,
+                                                      processes)
+                for i, row in enumerate(bins):
+                    expect = reference.calculate_gc_lo(
+                        seqs[row.chromosome][row.start:row.end])
+                    self.assertAlmostEqual(gc[i], expect[0])
+                    self.assertAlmostEqual(rmask[i], expect[1])
+            index = ngfrills.read_fasta_index(fa_fname)
+            blocks = ngfrills.fasta_chrom_blocks(fa_fname, index["chr2"],
+                                                 block_size=1000)
+            self.assertEqual(''.join(block.tostring().decode()
+                                     for _pos, block in blocks),
+                             seqs["chr2"])
+
+    def test_reference_update(self):
+        """Add and remove samples in a reference via its store."""
+        tmpdir = make_tmpdir()
+        store_dir = os.path.join(tmpdir, "ref.store")
+        ref = commands.do_reference(["formats/amplicon.cnr"],
+                                    ["formats/empty"], store_dir=store_dir)
+        new_tgt = os.path.join(tmpdir, "other.targetcoverage.cnn")
+        new_anti = os.path.join(tmpdir, "other.antitargetcoverage.cnn")
+        shutil.copy("formats/amplicon.cnr", new_tgt)
+        shutil.copy("formats/empty", new_anti)
+        added = commands.do_reference_update(store_dir, [new_tgt], [new_anti])
+        # Same as building the reference from all the samples at once
+        scratch = commands.do_reference(["formats/amplicon.cnr", new_tgt],
+                                        ["formats/empty", new_anti])
+        self.assertEqual(list(added['gene']), list(scratch['gene']))
+        for col in ('log2', 'spread'):
+            self.assertTrue((added[col] == scratch[col]).all())
+        # Can't add the same sample twice
+        with self.assertRaises(ValueError):
+            commands.do_reference_update(store_dir, [new_tgt], [new_anti])
+        # Removing the new sample restores the original reference
+        removed = commands.do_reference_update(store_dir,
+                                               remove_ids=["other"])
+        for col in ('log2', 'spread'):
+            self.assertTrue((removed[col] == ref[col]).all())
+
     def test_segment(self):
         """The 'segment' command."""
         cnarr = cnvlib.read("formats/amplicon.cnr")
@@ -440,11 +966,22 @@ class CommandTests(unittest.TestCase):
         """The 'segmetrics' command."""
         cnarr = cnvlib.read("formats/amplicon.cnr")
         segarr = cnvlib.read("formats/amplicon.cns")
-        for func in (
-            lambda x: metrics.confidence_interval_bootstrap(x, 0.05, 100),
-            lambda x: metrics.prediction_interval(x, 0.05),
-        ):
-            lo, hi = commands._segmetric_interval(segarr, cnarr, func)
+        seg_idx, bin_idx = cnarr.ranges_idx(segarr)
+        log2s = cnarr['log2'].values[bin_idx]
+        weights = cnarr['weight'].values[bin_idx]
+        intervals = (
+            metrics.grouped_confidence_interval_bootstrap(
+                log2s, seg_idx, len(segarr), 0.05, 100, weights),
+            metrics.grouped_prediction_interval(log2s, seg_idx, len(segarr),
+                                                0.05),
+        )
+        # Same as the per-segment prediction intervals
+        for i, (_seg, bins) in enumerate(cnarr.by_ranges(segarr)):
+            if len(bins):
+                self.assertTrue(np.allclose(
+                    metrics.prediction_interval(bins, 0.05),
+                    [intervals[1][0][i], intervals[1][1][i]]))
+        for lo, hi in intervals:
             self.assertEqual(len(lo), len(segarr))
             self.assertEqual(len(hi), len(segarr))
             sensible_segs_mask = (np.asarray(segarr['probes']) > 3)
@@ -488,6 +1025,62 @@ class OtherTests(unittest.TestCase):
         self.assertAlmostEqual(fix.edge_losses(target_size, insert_size),
                         2 * fix.edge_gains(target_size, gap_size, insert_size))
 
+    def test_region_depth_counts(self):
+        """Vectorized read counting matches the per-region counts."""
+        import pysam
+        bamfile = pysam.Samfile("formats/synthetic.bam", 'rb')
+        # Overlapping, adjacent, unsorted and empty regions
+        starts = np.array([4900, 5000, 5300, 30000, 100, 11950, 11950, 700])
+        ends = np.array([5300, 5600, 5700, 39000, 250, 11950, 12050, 20000])
+        for min_mapq in (0, 10):
+            counts = coverage.region_depth_counts(bamfile, "chr1", starts,
+                                                  ends, min_mapq)
+            expect = [coverage.region_depth_count(bamfile, "chr1", start, end,
+                                                  min_mapq)[0]
+                      for start, end in zip(starts, ends)]
+            self.assertEqual(list(counts), expect)
+
+    def test_parse_bedcov(self):
+        """Parse bedcov output, with or without region names."""
+        table = coverage.parse_bedcov("chr1\t100\t200\tBRAF\t3000\n"
+                                      "chr1\t300\t400\t-\t0\n")
+        self.assertEqual(list(table.columns),
+                         ["chromosome", "start", "end", "gene", "basecount"])
+        self.assertEqual(list(table['gene']), ["BRAF", "-"])
+        self.assertEqual(list(table['basecount']), [3000, 0])
+        self.assertEqual(table['start'].dtype, np.int64)
+        table = coverage.parse_bedcov("chr2\t100\t200\t42\n")
+        self.assertEqual(list(table['gene']), ["-"])
+        self.assertEqual(list(table['basecount']), [42])
+        for bad_text in ("chr1\t100\n",
+                         "chr1\t100\t200\tBRAF\tmany\n",
+                         "chr1\t100\t200\tBRAF\t30\nchr1\t1\t2\n"):
+            with self.assertRaises(RuntimeError):
+                coverage.parse_bedcov(bad_text)
+
+    def test_grouped_metrics(self):
+        """Grouped reductions match the per-group statistics."""
+        rng = np.random.RandomState(0)
+        groups = np.sort(rng.randint(0, 20, 500))
+        groups[groups == 7] = 8  # Leave one group empty
+        values = rng.standard_normal(500)
+        for grouped_func, func in (
+            (metrics.grouped_mean, np.mean),
+            (metrics.grouped_std, np.std),
+            (metrics.grouped_median, np.median),
+            (metrics.grouped_mad, metrics.median_absolute_deviation),
+            (metrics.grouped_biweight_location, metrics.biweight_location),
+            (metrics.grouped_biweight_midvariance,
+             metrics.biweight_midvariance),
+        ):
+            result = grouped_func(values, groups, 20)
+            self.assertTrue(np.isnan(result[7]))
+            for i in (0, 8, 19):
+                self.assertAlmostEqual(result[i], func(values[groups == i]))
+        self.assertEqual(metrics.grouped_unique(['a', 'b', 'a', 'c'],
+                                                [0, 0, 0, 2], 3),
+                         [['a', 'b'], [], ['c']])
+
     # call
     # Test: convert_clonal(x, 1, 2) == convert_diploid(x)
 